@@ -0,0 +1,88 @@
+import os
+import time
+
+from myrm import bucket, settings
+
+__all__ = (
+    "SHAPES",
+    "make_tree",
+    "make_history",
+)
+
+
+# The count of nested directories in every chain of the deep tree.
+DEEP_LEVELS = 64
+# The count of files in every directory of the tree with many small files.
+SMALL_FANOUT = 100
+SMALL_CONTENT = b"x" * 1024
+
+
+def _make_wide(root: str, count: int) -> None:
+    # All items are files in the same directory.
+    os.makedirs(root)
+    for number in range(count):
+        with open(os.path.join(root, f"file-{number}"), "wb"):
+            pass
+
+
+def _make_deep(root: str, count: int) -> None:
+    # Every level of the chain has the directory and the file, so the paths stay short enough.
+    os.makedirs(root)
+    for chain in range(max(count // (DEEP_LEVELS * 2), 1)):
+        path = os.path.join(root, f"chain-{chain}")
+        for level in range(DEEP_LEVELS):
+            path = os.path.join(path, str(level))
+            os.makedirs(path)
+            with open(os.path.join(path, "file"), "wb"):
+                pass
+
+
+def _make_small(root: str, count: int) -> None:
+    # The files with content are split into two levels of directories.
+    for number in range(count):
+        directory = os.path.join(
+            root,
+            str(number // (SMALL_FANOUT * SMALL_FANOUT)),
+            str(number // SMALL_FANOUT % SMALL_FANOUT),
+        )
+        if number % SMALL_FANOUT == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file-{number}"), "wb") as stream_out:
+            stream_out.write(SMALL_CONTENT)
+
+
+SHAPES = {
+    "wide": _make_wide,
+    "deep": _make_deep,
+    "small": _make_small,
+}
+
+
+def make_tree(root: str, shape: str, count: int) -> str:
+    SHAPES[shape](root, count)
+    return root
+
+
+def make_history(bucket_instance: bucket.Bucket, count: int, expired: float = 0.0) -> None:
+    bucket_instance.create()
+    origin = os.path.join(os.path.dirname(bucket_instance.path), "origin")
+    os.makedirs(origin, exist_ok=True)
+    now = time.time()
+
+    with bucket_instance.history.transaction():
+        for number in range(count):
+            name = f"entry-{number}"
+            with open(os.path.join(bucket_instance.path, name), "wb"):
+                pass
+
+            # The first part of the entries is older than the store time of the bucket.
+            timestamp = now - bucket_instance.storetime - 1 if number < count * expired else now
+            bucket_instance.history[name] = bucket.Entry(
+                status=bucket.Status.CORRECT.value,
+                index=number + 1,
+                name=name,
+                origin=os.path.join(origin, name),
+                date=time.strftime(settings.DEFAULT_TIME_FORMAT, time.localtime(timestamp)),
+                size=0,
+                timestamp=timestamp,
+            )
@@ -0,0 +1,303 @@
+import argparse
+import collections
+import importlib
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from myrm import __version__, bucket, rmlib, stats
+
+from .generate import SHAPES, make_history, make_tree
+
+# The modules which are imported by the first operation that uses them.
+LAZY_MODULES = ("concurrent.futures", "csv", "sqlite3", "subprocess", "tabulate", "uuid")
+
+# The count of items which are removed within one transaction, the same as the command-line tool.
+BATCH_SIZE = 1024
+# The count of items which are restored by the restore benchmark.
+RESTORE_COUNT = 100
+# The count of items to display by the show benchmarks.
+PAGE_SIZE = 10
+
+Setup = Callable[[str, int, argparse.Namespace], Any]
+Operation = Callable[[Any], None]
+
+
+class Probe:
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = collections.Counter()
+        self.lock = threading.Lock()
+
+    def account(self, name: str) -> None:
+        with self.lock:
+            self.calls[name] += 1
+
+    def patch(self) -> ContextManager[None]:
+        # The system calls are counted the same way as by the statistics of the tool.
+        return stats.count_syscalls(self.account)
+
+
+def read_io() -> Dict[str, int]:
+    # Only Linux counts the bytes written by the process, the other systems report nothing.
+    try:
+        with open("/proc/self/io", "rt", encoding="utf-8") as stream_in:
+            return {
+                name: int(value)
+                for name, value in (line.split(": ") for line in stream_in.read().splitlines())
+            }
+    except OSError:
+        return {}
+
+
+def measure(operation: Operation, state: Any) -> Dict[str, Any]:
+    probe = Probe()
+    before = read_io()
+
+    with probe.patch():
+        start = time.perf_counter()
+        operation(state)
+        seconds = time.perf_counter() - start
+
+    after = read_io()
+    return {
+        "seconds": seconds,
+        "syscalls": dict(sorted(probe.calls.items())),
+        # The items are renamed within one file system, so these are the writes of the history.
+        "bytes_written": after["wchar"] - before["wchar"] if after else None,
+        "write_calls": after["syscw"] - before["syscw"] if after else None,
+    }
+
+
+def get_bucket(root: str, arguments: argparse.Namespace) -> bucket.Bucket:
+    return bucket.Bucket(
+        path=os.path.join(root, "bucket"),
+        history_path=os.path.join(root, f"history.{arguments.history}"),
+        maxsize=sys.maxsize,
+        workers=arguments.workers,
+    )
+
+
+def setup_tree(root: str, count: int, arguments: argparse.Namespace) -> Tuple[Any, ...]:
+    bucket_instance = get_bucket(root, arguments)
+    bucket_instance.create()
+    return bucket_instance, make_tree(os.path.join(root, "tree"), arguments.shape, count)
+
+
+def setup_files(root: str, count: int, arguments: argparse.Namespace) -> Tuple[Any, ...]:
+    bucket_instance, tree = setup_tree(root, count, arguments)
+    paths = [entry.path for entry in rmlib.scantree(tree) if not entry.is_dir()]
+    return bucket_instance, paths
+
+
+def setup_history(
+    root: str, count: int, arguments: argparse.Namespace, expired: float = 0.0
+) -> bucket.Bucket:
+    make_history(get_bucket(root, arguments), count, expired)
+    # The history is read from the disk by the benchmark like by the command-line tool.
+    return get_bucket(root, arguments)
+
+
+def setup_loaded(root: str, count: int, arguments: argparse.Namespace) -> bucket.Bucket:
+    bucket_instance = setup_history(root, count, arguments)
+    len(bucket_instance.history)
+    return bucket_instance
+
+
+def setup_unknown(root: str, count: int, arguments: argparse.Namespace) -> bucket.Bucket:
+    bucket_instance = setup_loaded(root, count, arguments)
+    # Every tenth item of the bucket is added by hand and isn't known to the history.
+    for number in range(max(count // 10, 1)):
+        with open(os.path.join(bucket_instance.path, f"unknown-{number}"), "wb"):
+            pass
+
+    return bucket_instance
+
+
+def setup_expired(root: str, count: int, arguments: argparse.Namespace) -> bucket.Bucket:
+    bucket_instance = setup_history(root, count, arguments, expired=0.5)
+    len(bucket_instance.history)
+    return bucket_instance
+
+
+def run_rm(state: Tuple[bucket.Bucket, str]) -> None:
+    bucket_instance, tree = state
+    with bucket_instance.history.transaction():
+        bucket_instance.rm(tree)
+
+
+def run_rm_files(state: Tuple[bucket.Bucket, List[str]]) -> None:
+    bucket_instance, paths = state
+    files = iter(paths)
+    for batch in iter(lambda: list(itertools.islice(files, BATCH_SIZE)), []):
+        with bucket_instance.history.transaction():
+            for path in batch:
+                bucket_instance.rm(path)
+
+
+def run_rm_force(state: Tuple[bucket.Bucket, str]) -> None:
+    bucket_instance, tree = state
+    bucket_instance.rm(tree, force=True)
+
+
+def run_load(bucket_instance: bucket.Bucket) -> None:
+    len(bucket_instance.history)
+
+
+def run_restore(bucket_instance: bucket.Bucket) -> None:
+    indexes = bucket_instance.history.get_indexes()[-RESTORE_COUNT:]
+    bucket_instance.restore_many(indexes)
+
+
+def run_show_first(bucket_instance: bucket.Bucket) -> None:
+    bucket_instance.history.show(PAGE_SIZE, 1)
+
+
+def run_show_last(bucket_instance: bucket.Bucket) -> None:
+    page = max((len(bucket_instance.history) - 1) // PAGE_SIZE + 1, 1)
+    bucket_instance.history.show(PAGE_SIZE, page)
+
+
+def run_show_after(bucket_instance: bucket.Bucket) -> None:
+    after = max(len(bucket_instance.history) - PAGE_SIZE, 1)
+    bucket_instance.history.show(PAGE_SIZE, after=after)
+
+
+def run_export(bucket_instance: bucket.Bucket) -> None:
+    with open(os.devnull, "wt", encoding="utf-8") as stream_out:
+        bucket_instance.history.export(stream_out, "jsonl")
+
+
+def run_check(bucket_instance: bucket.Bucket) -> None:
+    with bucket_instance.history.transaction():
+        bucket_instance.check()
+
+
+def run_expiry(bucket_instance: bucket.Bucket) -> None:
+    with bucket_instance.history.transaction():
+        bucket_instance.timeout_cleanup()
+
+
+# The operations which depend on the shape of the tree are measured for every shape.
+TREE_BENCHMARKS: Dict[str, Tuple[Setup, Operation]] = {
+    "rm": (setup_tree, run_rm),
+    "rm-files": (setup_files, run_rm_files),
+    "rm-force": (setup_tree, run_rm_force),
+}
+
+HISTORY_BENCHMARKS: Dict[str, Tuple[Setup, Operation]] = {
+    "load": (setup_history, run_load),
+    "restore": (setup_loaded, run_restore),
+    "show-first": (setup_loaded, run_show_first),
+    "show-last": (setup_loaded, run_show_last),
+    "show-after": (setup_loaded, run_show_after),
+    "export": (setup_loaded, run_export),
+    "check": (setup_unknown, run_check),
+    "expiry": (setup_expired, run_expiry),
+}
+
+BENCHMARKS = {**TREE_BENCHMARKS, **HISTORY_BENCHMARKS}
+
+
+def run(arguments: argparse.Namespace) -> Dict[str, Any]:
+    results = []
+
+    for name, count in itertools.product(arguments.benchmarks, arguments.sizes):
+        shapes = arguments.shapes if name in TREE_BENCHMARKS else [None]
+        for shape in shapes:
+            arguments.shape = shape
+            setup, operation = BENCHMARKS[name]
+
+            root = tempfile.mkdtemp(prefix="myrm-bench-", dir=arguments.dir)
+            try:
+                result = measure(operation, setup(root, count, arguments))
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+
+            result = {"benchmark": name, "shape": shape, "count": count, **result}
+            print(
+                f"{name:<12} {shape or '-':<6} {count:>8} {result['seconds']:>10.4f}s",
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "history": arguments.history,
+        "workers": arguments.workers,
+        "time": time.time(),
+        "results": results,
+    }
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> Iterator[str]:
+    def get_key(result: Dict[str, Any]) -> Tuple[Any, ...]:
+        return result["benchmark"], result["shape"], result["count"]
+
+    baseline = {get_key(result): result for result in old["results"]}
+    for result in new["results"]:
+        previous: Optional[Dict[str, Any]] = baseline.get(get_key(result))
+        if previous is None:
+            continue
+
+        ratio = result["seconds"] / previous["seconds"] if previous["seconds"] else float("inf")
+        name, shape, count = get_key(result)
+        yield (
+            f"{name:<12} {shape or '-':<6} {count:>8} "
+            f"{previous['seconds']:>10.4f}s {result['seconds']:>10.4f}s {ratio:>7.2f}x"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure how the operations of myrm scale.")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[1000, 10000],
+        help="counts of the generated items, up to a million",
+    )
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=tuple(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("--shapes", nargs="+", choices=tuple(SHAPES), default=list(SHAPES))
+    parser.add_argument("--history", choices=("pkl", "db"), default="pkl")
+    parser.add_argument("--workers", type=int, default=rmlib.WORKERS)
+    parser.add_argument("--dir", default=None, help="directory for the generated items")
+    parser.add_argument("--output", default=None, help="save the results as JSON to this file")
+    parser.add_argument(
+        "--compare", default=None, metavar="PATH", help="compare the results with the saved ones"
+    )
+    arguments = parser.parse_args()
+
+    # The messages of every removed item would be measured as well.
+    logging.getLogger("myrm").setLevel(logging.CRITICAL)
+    # The modules which are imported on the first use aren't measured as a part of the operations.
+    for module in LAZY_MODULES:
+        importlib.import_module(module)
+
+    results = run(arguments)
+    if arguments.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(arguments.output, "wt", encoding="utf-8") as stream_out:
+            json.dump(results, stream_out, indent=2)
+
+    if arguments.compare is not None:
+        with open(arguments.compare, "rt", encoding="utf-8") as stream_in:
+            for line in compare(json.load(stream_in), results):
+                print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1 @@
-from . import logger
-
 __version__ = "0.0.1"
-
-
-logger.setup()
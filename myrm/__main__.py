@@ -1,16 +1,24 @@
 import argparse
+import contextlib
 import errno
-import glob
+import io
+import itertools
 import logging
 import os
 import sys
-from typing import Any
+from typing import Any, Callable, ContextManager, Iterator, Optional
 
-from . import __version__, bucket, settings
+from . import __version__, bucket, daemon, pattern, settings
+from .logger import setup as setup_logging
 
 # Create a new instance of the preferred reporting system for this program.
 logger = logging.getLogger("myrm")
 
+# The count of items which are moved to the bucket within a single history transaction.
+BATCH_SIZE = 1024
+# The count of bytes read from the list of items at once.
+READ_CHUNK_SIZE = 64 * 1024
+
 
 class SettingsArgumentsWrapper:
     def __init__(self) -> None:
@@ -26,6 +34,11 @@ class SettingsArgumentsWrapper:
             ("bucket_history_path", settings.DEFAULT_HISTORY_PATH),
             ("bucket_size", settings.DEFAULT_BUCKET_SIZE),
             ("bucket_timeout_cleanup", settings.DEFAULT_STORETIME),
+            ("workers", settings.DEFAULT_WORKERS),
+            ("bucket_dedup", settings.DEFAULT_DEDUP),
+            ("bucket_compress_after", settings.DEFAULT_COMPRESS_AFTER),
+            ("bucket_eviction", settings.DEFAULT_EVICTION),
+            ("bucket_per_device", settings.DEFAULT_PER_DEVICE),
         ):
             if getattr(arguments, name) == value:
                 continue
@@ -43,35 +56,137 @@ def abspath(path: str) -> str:
     return os.path.normpath(os.path.join(os.getcwd(), normpath))
 
 
+def read_files(path: str, null: bool = False) -> Iterator[str]:
+    separator = b"\0" if null else b"\n"
+
+    try:
+        with contextlib.ExitStack() as stack:
+            if path == "-":
+                stream = sys.stdin.buffer
+            else:
+                stream = stack.enter_context(io.open(path, mode="rb"))
+
+            # Read the list by chunks, so its length doesn't matter.
+            tail = b""
+            for chunk in iter(lambda: stream.read1(READ_CHUNK_SIZE), b""):  # type: ignore
+                *names, tail = (tail + chunk).split(separator)
+                for name in names:
+                    if name:
+                        yield abspath(os.fsdecode(name))
+
+            if tail:
+                yield abspath(os.fsdecode(tail))
+    except OSError as err:
+        logger.error("It's impossible to read the list of items on the current machine.")
+        logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+        # Stop this program runtime and return the exit status code.
+        sys.exit(getattr(err, "errno", errno.EIO))
+
+
 def remove(arguments: argparse.Namespace, bucket_instance: bucket.Bucket) -> None:
-    if arguments.force and not (arguments.confirm or confirmation("delete item(s)")):
+    if arguments.force and not confirmed(arguments, "delete item(s)"):
         return None
 
-    for file in arguments.FILES:
-        if arguments.regex:
-            for reg_file in glob.glob(os.path.join(file, arguments.regex)):
-                bucket_instance.rm(path=reg_file, force=arguments.force, dry_run=arguments.dry_run)
-        else:
-            bucket_instance.rm(file, force=arguments.force, dry_run=arguments.dry_run)
+    # The permanently deleted items never touch the bucket or its history.
+    transaction: Callable[[], ContextManager[Any]] = contextlib.ExitStack
+    if not arguments.force:
+        bucket_instance.startup()
+        transaction = bucket_instance.history.transaction
+
+    files: Iterator[str] = iter(arguments.FILES)
+    if arguments.from_file is not None:
+        files = itertools.chain(files, read_files(arguments.from_file, arguments.null))
+
+    matcher = pattern.Matcher(arguments.regex, arguments.glob, arguments.include, arguments.exclude)
+    if matcher:
+        # Remove the matched items of every determined directory as soon as they are found.
+        files = itertools.chain.from_iterable(pattern.find(file, matcher) for file in files)
+
+    # Save the history once per batch of items instead of keeping the whole list in memory.
+    for batch in iter(lambda: list(itertools.islice(files, BATCH_SIZE)), []):
+        if not (arguments.force or arguments.dry_run):
+            bucket_instance.hash_files(batch)
+
+        with transaction():
+            for file in batch:
+                bucket_instance.rm(
+                    file, force=arguments.force, dry_run=arguments.dry_run, defer=arguments.defer
+                )
 
     return None
 
 
 def show(arguments: argparse.Namespace, bucket_instance: bucket.Bucket) -> None:
-    print(bucket_instance.history.show(count=arguments.limit, page=arguments.page))
+    bucket_instance.startup()
+    options = {"after": arguments.after, "sort": arguments.sort, "reverse": arguments.reverse}
+
+    if arguments.format in bucket.FORMATS:
+        # The zero limit writes the whole history for the scripts.
+        bucket_instance.history.export(
+            sys.stdout, arguments.format, arguments.limit or None, arguments.page, **options
+        )
+    else:
+        print(bucket_instance.history.show(arguments.limit, arguments.page, **options))
 
 
 def restore(arguments: argparse.Namespace, bucket_instance: bucket.Bucket) -> None:
-    for index in arguments.INDICES:
-        bucket_instance.restore(index=index, dry_run=arguments.dry_run)
+    bucket_instance.startup()
+    failed = bucket_instance.restore_many(arguments.INDICES, dry_run=arguments.dry_run)
+    if failed:
+        logger.error("The items with indexes %s can't be restored.", ", ".join(map(str, failed)))
+        # Stop this program runtime and return the exit status code.
+        sys.exit(errno.EPERM)
 
 
 def maintain_bucket(arguments: argparse.Namespace, bucket_instance: bucket.Bucket) -> None:
     if arguments.create:
         bucket_instance.create(dry_run=arguments.dry_run)
 
-    if arguments.cleanup and (arguments.confirm or confirmation("cleanup the bucket")):
-        bucket_instance.cleanup(dry_run=arguments.dry_run)
+    if arguments.cleanup and confirmed(arguments, "cleanup the bucket"):
+        bucket_instance.startup(maintain=False)
+        bucket_instance.cleanup(dry_run=arguments.dry_run, defer=arguments.defer)
+
+    if arguments.compress:
+        bucket_instance.startup()
+        with bucket_instance.history.transaction():
+            bucket_instance.compress(dry_run=arguments.dry_run)
+
+    if arguments.purge and not arguments.dry_run:
+        bucket_instance.purge()
+
+
+@contextlib.contextmanager
+def instrument(arguments: argparse.Namespace) -> Iterator[None]:
+    # Nothing is imported or wrapped unless the measurements are requested.
+    if not (arguments.stats or arguments.profile):
+        yield None
+        return None
+
+    from . import stats  # pylint: disable=import-outside-toplevel
+
+    with contextlib.ExitStack() as stack:
+        if arguments.profile:
+            stack.enter_context(stats.profile(arguments.profile, arguments.profile_memory))
+        if arguments.stats:
+            # The statistics don't mix with the output of the command, e.g. the JSON history.
+            stack.enter_context(stats.collect(sys.stderr, arguments.stats))
+        yield None
+
+    return None
+
+
+def run_daemon(arguments: argparse.Namespace, bucket_instance: bucket.Bucket) -> None:
+    app_settings = arguments.get_settings.settings
+    daemon.serve(bucket_instance, app_settings.dump(), COMMANDS, arguments.socket)
+
+
+# The commands which can be executed by the daemon instead of this process.
+COMMANDS = {
+    "rm": remove,
+    "show": show,
+    "restore": restore,
+    "bucket": maintain_bucket,
+}
 
 
 def confirmation(question: str) -> bool:
@@ -83,7 +198,33 @@ def confirmation(question: str) -> bool:
     return False
 
 
+def confirmed(arguments: argparse.Namespace, question: str) -> bool:
+    # The answer might be already given by the user to the client of the daemon.
+    if getattr(arguments, "answer", None) is None:
+        arguments.answer = arguments.confirm or confirmation(question)
+
+    return bool(arguments.answer)
+
+
+def send(arguments: argparse.Namespace, app_settings: settings.AppSettings) -> Optional[int]:
+    # The daemon has no terminal, so the questions are asked before the command is sent.
+    if arguments.command == "rm" and arguments.force:
+        confirmed(arguments, "delete item(s)")
+    elif arguments.command == "bucket" and arguments.cleanup:
+        confirmed(arguments, "cleanup the bucket")
+
+    payload = {
+        name: value
+        for name, value in vars(arguments).items()
+        if name not in ("func", "get_settings")
+    }
+    return daemon.request(arguments.command, payload, app_settings.dump(), arguments.socket)
+
+
 def main() -> None:  # pylint: disable=too-many-statements
+    # Configure the reporting system only when this program is executed, not when it's imported.
+    setup_logging()
+
     setting_parser = argparse.ArgumentParser(add_help=False)
     setting_parser.add_argument(
         "--settings",
@@ -115,6 +256,69 @@ def main() -> None:  # pylint: disable=too-many-statements
         default=settings.DEFAULT_STORETIME,
         help="the maximum days to store items in bucket on the current machine",
     )
+    setting_parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.DEFAULT_WORKERS,
+        help="the count of threads that remove or move directory trees in parallel",
+    )
+    setting_parser.add_argument(
+        "--bucket-dedup",
+        action="store_true",
+        default=settings.DEFAULT_DEDUP,
+        help="keep the same content of the removed files in the bucket only once",
+    )
+    setting_parser.add_argument(
+        "--bucket-compress-after",
+        type=lambda day: int(day) * settings.SECONDS_IN_DAY,
+        default=settings.DEFAULT_COMPRESS_AFTER,
+        help="the days after which the items in bucket are compressed, zero disables it",
+    )
+    setting_parser.add_argument(
+        "--bucket-eviction",
+        choices=settings.EVICTION_POLICIES,
+        default=settings.DEFAULT_EVICTION,
+        help="the items to remove from the full bucket instead of refusing to remove more items",
+    )
+    setting_parser.add_argument(
+        "--bucket-per-device",
+        action="store_true",
+        default=settings.DEFAULT_PER_DEVICE,
+        help="keep the items of every other file system in the bucket at its mount point",
+    )
+    setting_parser.add_argument(
+        "--socket",
+        type=abspath,
+        default=daemon.DEFAULT_SOCKET_PATH,
+        help="the path of the socket where the daemon waits for the commands",
+    )
+    setting_parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        default=False,
+        help="execute the command by this process even if the daemon is running",
+    )
+    setting_parser.add_argument(
+        "--stats",
+        nargs="?",
+        const="table",
+        default=None,
+        choices=("table", "json"),
+        help="print the time, calls, written bytes and system calls of every phase",
+    )
+    setting_parser.add_argument(
+        "--profile",
+        type=abspath,
+        default=None,
+        metavar="PATH",
+        help="save the cProfile statistics of this program runtime to the determined path",
+    )
+    setting_parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        default=False,
+        help="save the tracemalloc snapshot next to the profile as well",
+    )
     setting_parser.set_defaults(get_settings=SettingsArgumentsWrapper())
 
     logger_parser = argparse.ArgumentParser(add_help=False)
@@ -173,15 +377,45 @@ def main() -> None:  # pylint: disable=too-many-statements
     rm_parser = subparsers.add_parser("rm", parents=[setting_parser, logger_parser])
     rm_parser.add_argument(
         "FILES",
-        nargs="+",
+        nargs="*",
         type=abspath,
         help="items to remove to the bucket on the current machine",
     )
+    rm_parser.add_argument(
+        "--from-file",
+        type=lambda path: path if path == "-" else abspath(path),
+        help="the file with the list of items to remove, '-' to read the list from stdin",
+    )
+    rm_parser.add_argument(
+        "-0",
+        "--null",
+        action="store_true",
+        default=False,
+        help="the items of the list are separated by the null character instead of the new line",
+    )
     rm_parser.add_argument(
         "-r",
         "--regex",
         type=str,
-        help="regular expression to remove items to the bucket on the current machine",
+        help="regular expression to remove the matched items inside the determined directories",
+    )
+    rm_parser.add_argument(
+        "-g",
+        "--glob",
+        type=str,
+        help="glob pattern with '**' support to remove the matched items inside the directories",
+    )
+    rm_parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        help="glob pattern of the items to remove inside the determined directories",
+    )
+    rm_parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="glob pattern of the items and directories to skip inside the determined directories",
     )
     rm_parser.add_argument(
         "-f",
@@ -190,7 +424,13 @@ def main() -> None:  # pylint: disable=too-many-statements
         default=False,
         help="permanently delete the specified items from the current machine",
     )
-    rm_parser.set_defaults(func=remove)
+    rm_parser.add_argument(
+        "--defer",
+        action="store_true",
+        default=False,
+        help="finish the permanent deletion in the background after this command returns",
+    )
+    rm_parser.set_defaults(func=remove, command="rm")
 
     # subcommand show
     show_parser = subparsers.add_parser("show", parents=[setting_parser, logger_parser])
@@ -198,14 +438,39 @@ def main() -> None:  # pylint: disable=too-many-statements
         "--limit", type=int, default=10, help="set the count of items to display per page"
     )
     show_parser.add_argument("--page", type=int, default=1, help="set page to display")
-    show_parser.set_defaults(func=show)
+    show_parser.add_argument(
+        "--after",
+        type=int,
+        default=None,
+        metavar="INDEX",
+        help="display the items which follow the item with the determined index",
+    )
+    show_parser.add_argument(
+        "--sort",
+        choices=tuple(bucket.SORT_KEYS),
+        default="index",
+        help="set the order of the items to display",
+    )
+    show_parser.add_argument(
+        "--reverse",
+        action="store_true",
+        default=False,
+        help="display the items in the reverse order",
+    )
+    show_parser.add_argument(
+        "--format",
+        choices=("table", *bucket.FORMATS),
+        default="table",
+        help="set the format of the items to display, zero limit displays all of them",
+    )
+    show_parser.set_defaults(func=show, command="show")
 
     # subcommand restore
     restore_parser = subparsers.add_parser("restore", parents=[setting_parser, logger_parser])
     restore_parser.add_argument(
         "INDICES", nargs="+", type=int, help="indices of the items to restore"
     )
-    restore_parser.set_defaults(func=restore)
+    restore_parser.set_defaults(func=restore, command="restore")
 
     # subcommand bucket
     bucket_parser = subparsers.add_parser("bucket", parents=[setting_parser, logger_parser])
@@ -221,10 +486,36 @@ def main() -> None:  # pylint: disable=too-many-statements
         default=False,
         help="cleanup bucket on the current machine",
     )
-    bucket_parser.set_defaults(func=maintain_bucket)
+    bucket_parser.add_argument(
+        "--defer",
+        action="store_true",
+        default=False,
+        help="finish the cleanup in the background after this command returns",
+    )
+    bucket_parser.add_argument(
+        "--purge",
+        action="store_true",
+        default=False,
+        help="remove the items left by the deferred deletion on the current machine",
+    )
+    bucket_parser.add_argument(
+        "--compress",
+        action="store_true",
+        default=False,
+        help="compress the items which are older than --bucket-compress-after days",
+    )
+    bucket_parser.set_defaults(func=maintain_bucket, command="bucket")
+
+    # subcommand daemon
+    daemon_parser = subparsers.add_parser("daemon", parents=[setting_parser, logger_parser])
+    daemon_parser.set_defaults(func=run_daemon, command="daemon")
 
     try:
         arguments = parser.parse_args()
+        if getattr(arguments, "command", None) == "rm" and not (
+            arguments.FILES or arguments.from_file
+        ):
+            rm_parser.error("the following arguments are required: FILES or --from-file")
 
         # Set a new logging level of the preferred reporting system.
         logger.setLevel(arguments.logging_level)
@@ -240,11 +531,25 @@ def main() -> None:  # pylint: disable=too-many-statements
                 history_path=app_settings.bucket_history_path,
                 maxsize=app_settings.bucket_size,
                 storetime=app_settings.bucket_timeout_cleanup,
+                workers=app_settings.workers,
+                dedup=app_settings.bucket_dedup,
+                compress_after=app_settings.bucket_compress_after,
+                eviction=app_settings.bucket_eviction,
+                per_device=app_settings.bucket_per_device,
             )
-            app_bucket.startup()
-
             if hasattr(arguments, "func"):
-                arguments.func(arguments, app_bucket)
+                # The daemon can't read the standard input of this process or measure it.
+                local = arguments.no_daemon or arguments.stats or arguments.profile
+                stdin = getattr(arguments, "from_file", None) == "-"
+                if arguments.command in COMMANDS and not (local or stdin):
+                    code = send(arguments, app_settings)
+                    if code is not None:
+                        # Stop this program runtime and return the exit status code of the daemon.
+                        sys.exit(code)
+
+                with instrument(arguments):
+                    arguments.func(arguments, app_bucket)
+                    app_bucket.shutdown()
     except KeyboardInterrupt as err:
         logger.error("Stop this program runtime on the current machine.")
         logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
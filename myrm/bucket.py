@@ -1,17 +1,32 @@
 import collections
-import datetime
+import collections.abc
+import contextlib
 import enum
 import errno
+import fcntl
+import heapq
 import io
+import itertools
+import json
 import logging
 import os
 import pickle
+import stat
 import sys
 import time
-import uuid
-from typing import Any, Hashable, List
-
-from tabulate import tabulate
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from . import rmlib, settings
 
@@ -21,97 +36,1130 @@ logger = logging.getLogger("myrm")
 __all__ = (
     "Status",
     "BucketHistory",
+    "SQLiteBucketHistory",
     "Bucket",
+    "load_history",
+    "write_entries",
+    "get_mount_point",
+    "is_private",
+)
+
+
+# The suffix of the append-only file that records every change of the history.
+JOURNAL_SUFFIX = ".journal"
+# The minimal count of journal records before they are folded into the history snapshot.
+JOURNAL_THRESHOLD = 1024
+
+JOURNAL_SET = 1
+JOURNAL_DELETE = 2
+
+# The suffix of the file which serializes the changes of the history made by several processes.
+LOCK_SUFFIX = ".lock"
+# The count of seconds to wait for another process which changes the SQLite history.
+LOCK_TIMEOUT = 60.0
+
+# The version of the history snapshot layout, the legacy snapshots contain the plain dictionary.
+SNAPSHOT_VERSION = 1
+
+# The placeholder for the items that didn't exist before the transaction changed them.
+MISSING = object()
+
+# The history paths with these suffixes are stored in the SQLite database.
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+# The suffix of the file that records when the bucket was maintained the last time.
+STAMP_SUFFIX = ".stamp"
+# The minimal count of seconds between two searches of the expired items.
+MAINTENANCE_INTERVAL = 60 * 60
+
+# The hidden directory next to the bucket where the items are kept until they are removed.
+STAGING_NAME = ".myrm-staging"
+# The hidden directory next to the bucket where the shared content is kept by its digest.
+STORE_NAME = ".myrm-store"
+# The suffix of the compressed items in the bucket.
+ARCHIVE_SUFFIX = ".tar.xz"
+# The hidden directory at the root of every other file system where the items of a user are kept,
+# it's followed by the user ID.
+DEVICE_BUCKET_NAME = ".myrm-bucket"
+
+
+Entry = collections.namedtuple(
+    "Entry",
+    ("status", "index", "name", "origin", "date", "size", "timestamp", "digest", "metadata"),
 )
+# The size and the removal time of the items from the legacy history are unknown, the size is
+# calculated when the bucket is reconciled and the time is parsed from the date once. Only the
+# files which share their content with the other items have the digest and their own metadata.
+Entry.__new__.__defaults__ = (None, None, None, None)
 
+# The keys to sort the entries of the history by, the index keeps the order of the equal ones.
+SORT_KEYS: Dict[str, Callable[[Entry], Any]] = {
+    "index": lambda value: value.index,
+    "name": lambda value: value.name,
+    "date": lambda value: get_removed_time(value) or 0.0,
+    "size": lambda value: value.size or 0,
+}
 
-Entry = collections.namedtuple("Entry", ("status", "index", "name", "origin", "date"))
+# The formats of the history which can be read by the other programs.
+FORMATS = ("json", "jsonl", "csv")
 
 
 class Status(enum.Enum):
     CORRECT: str = "OK"
     UNKNOWN: str = "UNKNOWN"
+    COMPRESSED: str = "COMPRESSED"
+    INCOMPRESSIBLE: str = "INCOMPRESSIBLE"
+    PARTIAL: str = "PARTIAL"
+    PENDING: str = "PENDING"
 
 
 class BucketHistory(collections.UserDict):
     def __init__(
         self, *args: Any, path: str = settings.DEFAULT_HISTORY_PATH, **kwargs: Any
     ) -> None:
+        self.path = path
+        # Every mutation is appended to this journal and folded into the snapshot from time to time.
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.journal_records = 0
+        self.snapshot_records = 0
+        # The journal records which aren't saved yet and the previous values of the current
+        # transaction, whether some of its records were already seen by the other processes.
+        self.pending: List[Tuple[int, Hashable, Any]] = []
+        self.undo: Optional[List[Tuple[Hashable, Any]]] = None
+        self.published = False
+        # The state of the saved history which was merged into this one at last.
+        self.snapshot_state: Optional[Tuple[int, int, int]] = None
+        self.journal_offset = 0
+        # The file which is locked by the process that saves its changes of the history.
+        self.lock_path = path + LOCK_SUFFIX
+        self.lock_fd: Optional[int] = None
+        self.locks = 0
+        # The secondary index of the history and the last index that was given to an item.
+        self.indexes: Dict[int, Hashable] = {}
+        self.counter = 0
+        # The heap of the removal times, the items which were changed since are skipped lazily.
+        self.expiry: List[Tuple[float, Hashable]] = []
+        # The total size of the items and the count of items which size is unknown yet.
+        self.total = 0
+        self.unsized = 0
+        # The count of items which refer to every shared content.
+        self.references: Dict[str, int] = {}
+        # The heap of the negative sizes, it's built only when the items are evicted at first.
+        self.sizes: Optional[List[Tuple[int, Hashable]]] = None
+
         super().__init__(*args, **kwargs)
 
-        self.path = path
         # Get the required data and update this container.
-        if os.path.isfile(self.path):
+        if os.path.isfile(self.path) or os.path.isfile(self.journal_path):
             self._read()
 
     def _read(self) -> None:
         try:
-            with io.open(self.path, mode="rb") as stream_in:
-                # Load and de-serialize the required data structure.
-                self.update(pickle.load(stream_in))
+            # Another process might be writing the history right now.
+            with self._lock():
+                try:
+                    with io.open(self.path, mode="rb") as stream_in:
+                        # Load and de-serialize the required data structure.
+                        state = pickle.load(stream_in)
+                except FileNotFoundError:
+                    # The history was never compacted, so only the journal exists.
+                    state = (SNAPSHOT_VERSION, {"data": {}})
+
+                if isinstance(state, dict):
+                    state = (SNAPSHOT_VERSION, {"data": state})
+                self._load(state[1])
+
+                self.snapshot_records = len(self.data)
+                self.snapshot_state = self._get_snapshot_state()
+                self.journal_records = 0
+                self._replay(0)
         except (IOError, OSError) as err:
             logger.error("It's impossible to restore the history state on the current machine.")
             logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
             # Stop this program runtime and return the exit status code.
             sys.exit(getattr(err, "errno", errno.EIO))
 
+    def _replay(self, offset: int) -> Set[Hashable]:
+        keys: Set[Hashable] = set()
+        self.journal_offset = offset
+
+        if not os.path.isfile(self.journal_path):
+            return keys
+
+        with io.open(self.journal_path, mode="r+b") as stream_in:
+            stream_in.seek(offset)
+            while True:
+                try:
+                    operation, key, value = pickle.load(stream_in)
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                    break
+
+                if operation == JOURNAL_SET:
+                    self._insert(key, value)
+                elif key in self.data:
+                    self._remove(key)
+
+                keys.add(key)
+                offset = stream_in.tell()
+                self.journal_records += 1
+
+            if stream_in.seek(0, io.SEEK_END) > offset:
+                # Drop the torn record left by an interrupted write, so new records stay readable.
+                logger.warning("The history journal was truncated on the current machine.")
+                stream_in.truncate(offset)
+
+        self.journal_offset = offset
+        return keys
+
+    def _get_snapshot_state(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        return info.st_ino, info.st_mtime_ns, info.st_size
+
+    @contextlib.contextmanager
+    def _lock(self) -> Iterator[None]:
+        if self.locks:
+            self.locks += 1
+            try:
+                yield None
+            finally:
+                self.locks -= 1
+            return
+
+        if self.lock_fd is None:
+            try:
+                self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                # The history can't be saved next to the lock either, so it's read without it.
+                logger.debug("Can't lock the history on the current machine.", exc_info=True)
+
+        if self.lock_fd is not None:
+            # Wait for the other processes, they hold the lock only while their changes are saved.
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+        self.locks = 1
+        try:
+            yield None
+        finally:
+            self.locks = 0
+            if self.lock_fd is not None:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def locked(self, sync: bool = False) -> Iterator["BucketHistory"]:
+        if self.locks:
+            yield self
+            return
+
+        with self._lock():
+            self._sync()
+            yield self
+
+            # Publish the changes before the lock is released, so the other processes see them.
+            if self.pending or sync:
+                records, self.pending = self.pending, []
+                self.published = self.published or (self.undo is not None and bool(records))
+                self._flush(records, sync)
+
+    def _sync(self) -> None:
+        try:
+            journal_size = os.stat(self.journal_path).st_size
+        except FileNotFoundError:
+            journal_size = 0
+
+        # Merge the changes which were saved by the other processes since this history was read.
+        if self._get_snapshot_state() != self.snapshot_state or journal_size < self.journal_offset:
+            # The history was compacted by another process, so it's read again from scratch.
+            previous = self.data
+            self._read()
+            foreign = {key for key, value in self.data.items() if previous.get(key) != value}
+        elif journal_size > self.journal_offset:
+            foreign = self._replay(self.journal_offset)
+        else:
+            return None
+
+        # Apply the own changes again, the items of the other processes keep their indexes.
+        pending, self.pending = self.pending, []
+        for operation, key, value in pending:
+            if operation == JOURNAL_SET:
+                owner = self.indexes.get(value.index)
+                if owner is not None and owner != key and owner in foreign:
+                    value = value._replace(index=self.counter + 1)
+                self._insert(key, value)
+            elif key in self.data:
+                self._remove(key)
+
+            self.pending.append((operation, key, value))
+
+        return None
+
+    def _append(self, operation: int, key: Hashable, value: Any = None) -> None:
+        self.pending.append((operation, key, value))
+
+        # Save the change at once outside of the transactions and the locked sections.
+        if self.undo is None and not self.locks:
+            with self.locked():
+                pass
+
+    def _flush(self, records: List[Tuple[int, Hashable, Any]], sync: bool = False) -> None:
+        try:
+            with io.open(self.journal_path, mode="ab") as stream_out:
+                # Save only the determined changes instead of the whole data structure.
+                for record in records:
+                    pickle.dump(record, stream_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+                stream_out.flush()
+                if sync:
+                    os.fsync(stream_out.fileno())
+                # Nobody else appends to the journal while it's locked by this process.
+                self.journal_offset = stream_out.tell()
+        except (IOError, OSError) as err:
+            logger.error("It's impossible to save the history state on the current machine.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            # Stop this program runtime and return the exit status code.
+            sys.exit(getattr(err, "errno", errno.EIO))
+
+        self.journal_records += len(records)
+        # Fold the journal into the snapshot once it outgrows the last snapshot, so the cost of
+        # rewriting the whole history is amortized over the appended records.
+        if self.journal_records > max(JOURNAL_THRESHOLD, self.snapshot_records):
+            self._write()
+
+    def _commit(self) -> None:
+        if self.pending or self.published:
+            with self.locked(sync=True):
+                pass
+
+    def _rollback(self) -> None:
+        undo = self.undo or []
+        for key, value in reversed(undo):
+            if key in self.data:
+                self._remove(key)
+            if value is not MISSING:
+                self._insert(key, value)
+
+        self.pending = []
+        if not self.published:
+            return None
+
+        # The other processes might have read the published changes, so they are reverted by new
+        # records instead.
+        for key in dict.fromkeys(key for key, _ in undo):
+            if key in self.data:
+                self.pending.append((JOURNAL_SET, key, self.data[key]))
+            else:
+                self.pending.append((JOURNAL_DELETE, key, None))
+
+        with self.locked(sync=True):
+            pass
+
+        return None
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator["BucketHistory"]:
+        if self.undo is not None:
+            # Join the outer transaction, it will commit all changes at once.
+            yield self
+            return
+
+        self.undo, self.published = [], False
+        try:
+            yield self
+        except Exception:
+            self._rollback()
+            raise
+        except BaseException:
+            # The determined items were already moved or removed on the current machine before the
+            # program runtime was stopped, so the history must keep the changes made so far.
+            self._commit()
+            raise
+        else:
+            self._commit()
+        finally:
+            self.undo, self.published = None, False
+
     def _write(self) -> None:
+        path = self.path + ".tmp"
+
         try:
-            with io.open(self.path, mode="wb") as stream_out:
-                # Serialize the required data structure and save it on the current machine.
-                pickle.dump(self.data, stream_out, protocol=pickle.HIGHEST_PROTOCOL)
+            with self._lock():
+                with io.open(path, mode="wb") as stream_out:
+                    # Serialize the required data structure and save it on the current machine.
+                    pickle.dump(
+                        (SNAPSHOT_VERSION, self._dump()),
+                        stream_out,
+                        protocol=pickle.HIGHEST_PROTOCOL,
+                    )
+
+                # Replace the snapshot atomically and drop the changes that it already contains.
+                os.replace(path, self.path)
+                if os.path.isfile(self.journal_path):
+                    os.remove(self.journal_path)
+
+                self.snapshot_state = self._get_snapshot_state()
+                self.journal_offset = 0
+
+            # The pending changes of the current transaction are the part of the snapshot now.
+            self.pending = []
+            self.published = False
+            if self.undo is not None:
+                self.undo.clear()
         except (IOError, OSError) as err:
             logger.error("It's impossible to save the history state on the current machine.")
             logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
             # Stop this program runtime and return the exit status code.
             sys.exit(getattr(err, "errno", errno.EIO))
 
+        self.journal_records = 0
+        self.snapshot_records = len(self.data)
+
+    def _load(self, state: Dict[str, Any]) -> None:
+        self.data = dict(state["data"])
+        self.counter = state.get("counter", 0)
+
+        self.indexes = {}
+        self.references = {}
+        self.sizes = None
+        self.total = self.unsized = 0
+        for key, value in self.data.items():
+            if value.timestamp is None:
+                # Parse the date of the legacy item only once, the next snapshot keeps the time.
+                value = self.data[key] = value._replace(timestamp=get_timestamp(value.date))
+
+            self.indexes[value.index] = key
+            self.counter = max(self.counter, value.index)
+            self._account(value, 1)
+
+        if "expiry" in state:
+            self.expiry = list(state["expiry"])
+        else:
+            self.expiry = self._get_expiry()
+
+    def _dump(self) -> Dict[str, Any]:
+        # Drop the outdated removal times, the snapshot is rewritten from scratch anyway.
+        self.expiry = self._get_expiry()
+        self.sizes = None
+        return {"data": self.data, "counter": self.counter, "expiry": self.expiry}
+
+    def _get_expiry(self) -> List[Tuple[float, Hashable]]:
+        expiry = [
+            (removed_time, key)
+            for key, removed_time in zip(self.data, map(get_removed_time, self.data.values()))
+            if removed_time is not None
+        ]
+        heapq.heapify(expiry)
+        return expiry
+
+    def _insert(self, key: Hashable, value: Entry) -> None:
+        if key in self.data:
+            self._remove(key)
+
+        self.data[key] = value
+        # Keep the secondary index and the counter up to date with the history.
+        self.indexes[value.index] = key
+        self.counter = max(self.counter, value.index)
+        self._account(value, 1)
+
+        removed_time = get_removed_time(value)
+        if removed_time is not None:
+            heapq.heappush(self.expiry, (removed_time, key))
+        if self.sizes is not None and value.size is not None:
+            heapq.heappush(self.sizes, (-value.size, key))
+
+    def _remove(self, key: Hashable) -> Entry:
+        value = self.data.pop(key)
+        if self.indexes.get(value.index) == key:
+            del self.indexes[value.index]
+
+        self._account(value, -1)
+        return value
+
+    def _account(self, value: Entry, sign: int) -> None:
+        shared = False
+        if value.digest is not None:
+            count = self.references.get(value.digest, 0) + sign
+            if count:
+                self.references[value.digest] = count
+            else:
+                del self.references[value.digest]
+
+            # The shared content takes the space only once, whatever the count of items is.
+            shared = count != (1 if sign > 0 else 0)
+
+        if value.size is None:
+            self.unsized += sign
+        elif not shared:
+            self.total += sign * value.size
+
     def __getitem__(self, key: Hashable) -> Entry:
         return self.data[key]
 
     def __setitem__(self, key: Hashable, value: Entry) -> None:
-        self.data[key] = value
+        if self.undo is not None:
+            self.undo.append((key, self.data.get(key, MISSING)))
+
+        self._insert(key, value)
         # Save the required data on the current machine.
-        self._write()
+        self._append(JOURNAL_SET, key, value)
 
     def __delitem__(self, key: Hashable) -> None:
-        del self.data[key]
+        value = self._remove(key)
+        if self.undo is not None:
+            self.undo.append((key, value))
+
         # Save the required data on the current machine.
-        self._write()
+        self._append(JOURNAL_DELETE, key)
 
-    def show(self, count: int, page: int) -> str:
-        values = list(self.values())
-        if not values:
+    def show(
+        self,
+        count: int,
+        page: int = 1,
+        after: Optional[int] = None,
+        sort: str = "index",
+        reverse: bool = False,
+    ) -> str:
+        values = []
+        if count > 0 and page > 0:
+            values = list(self.get_entries(count, (page - 1) * count, after, sort, reverse))
+        if not values and not self:
             logger.warning("History is empty.")
             # Stop this program runtime and return the exit status code.
             sys.exit(errno.EPERM)
 
-        try:
-            res = [values[index : index + count] for index in range(0, len(values), count)][  # noqa
-                page - 1
-            ]
-        except IndexError as err:
+        if not values:
             logger.error("It's impossible to show the provided page number.")
-            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
             # Stop this program runtime and return the exit status code.
-            sys.exit(getattr(err, "errno", errno.EPERM))
+            sys.exit(errno.EPERM)
+
+        # Load the table renderer only for the commands which display the table.
+        from tabulate import tabulate  # pylint: disable=import-outside-toplevel
 
         header = ("Status", "Index", "Name", "Origin", "Removed on")
-        return tabulate(list(map(list, res)), headers=header)
+        rows = [
+            [value.status, value.index, value.name, value.origin, value.date] for value in values
+        ]
+        return tabulate(rows, headers=header)
+
+    def export(
+        self,
+        stream: IO[str],
+        fmt: str,
+        count: Optional[int] = None,
+        page: int = 1,
+        after: Optional[int] = None,
+        sort: str = "index",
+        reverse: bool = False,
+    ) -> None:
+        if page <= 0 or (count is not None and count < 0):
+            logger.error("It's impossible to show the provided page number.")
+            # Stop this program runtime and return the exit status code.
+            sys.exit(errno.EPERM)
+
+        # The empty page is written as well, so the scripts know when to stop.
+        offset = (page - 1) * count if count else 0
+        write_entries(self.get_entries(count, offset, after, sort, reverse), stream, fmt)
+
+    def get_entries(
+        self,
+        count: Optional[int] = None,
+        offset: int = 0,
+        after: Optional[int] = None,
+        sort: str = "index",
+        reverse: bool = False,
+    ) -> Iterator[Entry]:
+        sort_key = SORT_KEYS[sort]
+
+        def get_position(value: Entry) -> Tuple[Any, int]:
+            return sort_key(value), value.index
+
+        values: Iterable[Entry] = self.values()
+        if after is not None:
+            # Continue from the determined entry instead of counting the previous pages.
+            bound = self._get_bound(after, sort)
+            values = (
+                value
+                for value in values
+                if (get_position(value) < bound if reverse else get_position(value) > bound)
+            )
+
+        # Keep only the requested entries in memory instead of sorting the whole history.
+        if count is None:
+            ordered = sorted(values, key=get_position, reverse=reverse)
+        elif reverse:
+            ordered = heapq.nlargest(offset + count, values, key=get_position)
+        else:
+            ordered = heapq.nsmallest(offset + count, values, key=get_position)
+
+        return itertools.islice(ordered, offset, None)
+
+    def _get_bound(self, index: int, sort: str) -> Tuple[Any, int]:
+        key = self.get_key(index)
+        if key is not None:
+            return SORT_KEYS[sort](self.data[key]), index
+
+        # The entry might be restored while the history is read page by page.
+        if sort == "index":
+            return index, index
+
+        logger.error("The determined index don't exist in history.")
+        # Stop this program runtime and return the exit status code.
+        sys.exit(errno.EPERM)
+
+    def get_key(self, index: int) -> Optional[str]:
+        return self.indexes.get(index)  # type: ignore
+
+    def get_expired(self, timestamp: float) -> List[str]:
+        due: List[Tuple[float, Hashable]] = []
+
+        # Pop only the due removal times, the outdated ones are dropped on the way.
+        while self.expiry and self.expiry[0][0] <= timestamp:
+            removed_time, key = heapq.heappop(self.expiry)
+            value = self.data.get(key)
+            if value is not None and get_removed_time(value) == removed_time:
+                due.append((removed_time, key))
+
+        # The same removal time might be pushed again when the item was updated or rolled back.
+        due = list(dict.fromkeys(due))
+
+        # The items are still stored until the caller removes them.
+        for item in due:
+            heapq.heappush(self.expiry, item)
+
+        return [key for _, key in due]  # type: ignore
+
+    def _iter_oldest(self) -> Iterator[Tuple[float, Hashable]]:
+        seen = set()
+        for removed_time, key in iter_heap(self.expiry):
+            value = self.data.get(key)
+            # The outdated removal times are skipped like by the search of the expired items.
+            if key in seen or value is None or get_removed_time(value) != removed_time:
+                continue
+
+            seen.add(key)
+            yield removed_time, key
+
+    def _iter_largest(self) -> Iterator[Tuple[int, Hashable]]:
+        if self.sizes is None:
+            self.sizes = [
+                (-value.size, key) for key, value in self.data.items() if value.size is not None
+            ]
+            heapq.heapify(self.sizes)
+
+        seen = set()
+        for size, key in iter_heap(self.sizes):
+            value = self.data.get(key)
+            if key in seen or value is None or value.size != -size:
+                continue
+
+            seen.add(key)
+            yield -size, key
+
+    def _iter_scored(self, timestamp: float) -> Iterator[Hashable]:
+        oldest, largest = self._iter_oldest(), self._iter_largest()
+        seen = set()
+        candidates: List[Tuple[float, Hashable]] = []
+
+        # Read both orders in turn until no unseen item can have a higher score than the seen ones.
+        while True:
+            removed_time, key = next(oldest, (None, None))
+            size, other = next(largest, (None, None))
+            for item in (key, other):
+                if item is not None and item not in seen:
+                    seen.add(item)
+                    heapq.heappush(candidates, (-get_score(self[item], timestamp), item))
+
+            if removed_time is None or size is None:
+                break
+
+            # The unseen items are newer and smaller than the last seen ones.
+            threshold = max(timestamp - removed_time, 0.0) * size
+            while candidates and -candidates[0][0] >= threshold:
+                yield heapq.heappop(candidates)[1]
+
+        # Every item with the known size was seen once either order is read.
+        while candidates:
+            yield heapq.heappop(candidates)[1]
+
+    def get_victims(self, policy: str, timestamp: float) -> Iterator[str]:
+        if policy == "oldest":
+            return (key for _, key in self._iter_oldest())  # type: ignore
+        if policy == "largest":
+            return (key for _, key in self._iter_largest())  # type: ignore
+
+        return self._iter_scored(timestamp)  # type: ignore
+
+    def get_size(self) -> Optional[int]:
+        return None if self.unsized else self.total
+
+    def get_unsized(self) -> List[str]:
+        if not self.unsized:
+            return []
+
+        return [key for key, value in self.items() if value.size is None]
+
+    def get_references(self, digest: str) -> int:
+        return self.references.get(digest, 0)
 
     def get_indexes(self) -> List[int]:
-        return [value.index for value in self.values()]
+        return list(self.indexes)
 
     def get_next_index(self) -> int:
-        return max(self.get_indexes(), default=0) + 1
+        return self.counter + 1
 
     def cleanup(self, dry_run: bool = False) -> None:
         if not dry_run:
-            self.data = {}
+            self._load({"data": {}})
             # Save the required data on the current machine.
             self._write()
 
 
+class SQLiteStorage(collections.abc.MutableMapping):
+    COLUMNS = "status, idx, name, origin, date, size, removed, digest, metadata"
+
+    def __init__(self, connection: Any) -> None:
+        self.connection = connection
+
+    @staticmethod
+    def get_entry(row: Tuple[Any, ...]) -> Entry:
+        # The metadata is kept as the text, so the layout doesn't depend on its length.
+        metadata = None if row[-1] is None else tuple(map(int, row[-1].split(",")))
+        return Entry._make((*row[:-1], metadata))
+
+    def __getitem__(self, key: Hashable) -> Entry:
+        row = self.connection.execute(
+            f"SELECT {self.COLUMNS} FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+
+        return self.get_entry(row)
+
+    def __setitem__(self, key: Hashable, value: Entry) -> None:
+        self._discard(key)
+        metadata = None if value.metadata is None else ",".join(map(str, value.metadata))
+        self.connection.execute(
+            f"INSERT INTO entries (key, {self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, *value[:6], get_removed_time(value), value.digest, metadata),
+        )
+        self.connection.execute(
+            "UPDATE meta SET value = MAX(value, ?) WHERE name = 'counter'", (value.index,)
+        )
+        self._account(value.size, 1, value.digest)
+
+    def __delitem__(self, key: Hashable) -> None:
+        if not self._discard(key):
+            raise KeyError(key)
+
+    def _discard(self, key: Hashable) -> bool:
+        query = "SELECT size, digest FROM entries WHERE key = ?"
+        row = self.connection.execute(query, (key,)).fetchone()
+        if row is None:
+            return False
+
+        self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._account(row[0], -1, row[1])
+        return True
+
+    def get_references(self, digest: str) -> int:
+        query = "SELECT COUNT(*) FROM entries WHERE digest = ?"
+        return self.connection.execute(query, (digest,)).fetchone()[0]
+
+    def _account(self, size: Optional[int], sign: int, digest: Optional[str] = None) -> None:
+        # The shared content takes the space only once, whatever the count of items is.
+        if size is not None and digest is not None:
+            if self.get_references(digest) != (1 if sign > 0 else 0):
+                return None
+
+        if size is None:
+            query, value = "UPDATE meta SET value = value + ? WHERE name = 'unsized'", sign
+        else:
+            query, value = "UPDATE meta SET value = value + ? WHERE name = 'size'", sign * size
+
+        self.connection.execute(query, (value,))
+
+    def __contains__(self, key: Any) -> bool:
+        query = "SELECT 1 FROM entries WHERE key = ?"
+        return self.connection.execute(query, (key,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for (key,) in self.connection.execute("SELECT key FROM entries ORDER BY idx"):
+            yield key
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def clear(self) -> None:
+        self.connection.execute("DELETE FROM entries")
+        self.connection.execute("UPDATE meta SET value = 0")
+
+
+class SQLiteBucketHistory(BucketHistory):
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries ("
+        "key PRIMARY KEY, status TEXT, idx INTEGER, name TEXT, origin TEXT, date TEXT, removed REAL"
+        ")",
+        "CREATE INDEX IF NOT EXISTS entries_idx ON entries (idx)",
+        "CREATE INDEX IF NOT EXISTS entries_origin ON entries (origin)",
+        "CREATE INDEX IF NOT EXISTS entries_removed ON entries (removed)",
+        "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)",
+        "INSERT OR IGNORE INTO meta SELECT 'counter', COALESCE(MAX(idx), 0) FROM entries",
+        "ALTER TABLE entries ADD COLUMN size INTEGER",
+        "INSERT OR IGNORE INTO meta VALUES ('size', 0)",
+        "INSERT OR IGNORE INTO meta SELECT 'unsized', COUNT(*) FROM entries",
+        "ALTER TABLE entries ADD COLUMN digest TEXT",
+        "CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)",
+        "CREATE INDEX IF NOT EXISTS entries_size ON entries (size)",
+        "ALTER TABLE entries ADD COLUMN metadata TEXT",
+    )
+    # The columns to sort the entries by, they match the keys of the history in the memory.
+    SORT_COLUMNS = {
+        "index": "idx",
+        "name": "name",
+        "date": "COALESCE(removed, 0)",
+        "size": "COALESCE(size, 0)",
+    }
+
+    def __init__(
+        self, *args: Any, path: str = settings.DEFAULT_HISTORY_PATH, **kwargs: Any
+    ) -> None:
+        self.connection: Any = None
+        # The changes of the current transaction which were made out of the locked sections, they
+        # are saved with the next locked section or the commit, so the database isn't locked.
+        self.deferred: Dict[Hashable, Any] = {}
+        super().__init__(*args, path=path, **kwargs)
+
+        # Create a new database if it doesn't exist on the current machine.
+        if self.connection is None:
+            self._read()
+
+    def _read(self) -> None:
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        try:
+            # Wait for the other processes which change the history instead of failing at once.
+            self.connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+            # Every locked section is committed, the log is synced only when it's checkpointed.
+            self.connection.execute("PRAGMA synchronous = NORMAL")
+            # Upgrade the database layout only when it is older than the current one.
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < len(self.SCHEMA):
+                self.connection.execute("PRAGMA journal_mode = WAL")
+                # The other process might upgrade it first, so the version is read again locked.
+                self.connection.execute("BEGIN IMMEDIATE")
+                version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+                for statement in self.SCHEMA[version:]:
+                    self.connection.execute(statement)
+                self.connection.execute(f"PRAGMA user_version = {len(self.SCHEMA)}")
+                self.connection.commit()
+        except sqlite3.Error as err:
+            logger.error("It's impossible to restore the history state on the current machine.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            # Stop this program runtime and return the exit status code.
+            sys.exit(getattr(err, "errno", errno.EIO))
+
+        # The rows are fetched on demand instead of loading the whole history into memory.
+        self.data = SQLiteStorage(self.connection)  # type: ignore
+
+    def _write(self) -> None:
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        try:
+            self.connection.commit()
+        except sqlite3.Error as err:
+            logger.error("It's impossible to save the history state on the current machine.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            # Stop this program runtime and return the exit status code.
+            sys.exit(getattr(err, "errno", errno.EIO))
+
+        # The other processes might read the changes of the current transaction from now on.
+        self.published = self.published or bool(self.undo)
+
+    def _commit(self) -> None:
+        if self.deferred:
+            with self.locked():
+                pass
+        else:
+            self._write()
+
+    def _rollback(self) -> None:
+        self.deferred.clear()
+        self.connection.rollback()
+        if not self.published:
+            return None
+
+        # The committed changes are reverted by the new ones, like the published journal records.
+        with self.locked():
+            for key, value in reversed(self.undo or []):
+                if value is not MISSING:
+                    self.data[key] = value
+                elif key in self.data:
+                    del self.data[key]
+
+        return None
+
+    @contextlib.contextmanager
+    def locked(self, sync: bool = False) -> Iterator["BucketHistory"]:
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        if self.locks:
+            yield self
+            return
+
+        # The database is locked for writing only until the end of this section, not the batch.
+        try:
+            if self.connection.in_transaction:
+                self.connection.commit()
+            self.connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as err:
+            logger.error("It's impossible to save the history state on the current machine.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            # Stop this program runtime and return the exit status code.
+            sys.exit(getattr(err, "errno", errno.EIO))
+
+        self.locks = 1
+        try:
+            # Save the deferred changes of the current transaction along with this section.
+            deferred, self.deferred = self.deferred, {}
+            for key, value in deferred.items():
+                self._save(key, value)
+
+            yield self
+        finally:
+            self.locks = 0
+            self._write()
+
+    def _save(self, key: Hashable, value: Any) -> None:
+        if value is not MISSING:
+            self.data[key] = value
+        elif key in self.data:
+            del self.data[key]
+
+    def _change(self, key: Hashable, value: Any) -> None:
+        if self.undo is not None:
+            self.undo.append((key, self.get(key, MISSING)))
+
+        if self.locks:
+            self._save(key, value)
+        elif self.undo is not None:
+            # Keep the database unlocked until the next locked section or the commit.
+            self.deferred[key] = value
+        else:
+            # Save the change at once outside of the transactions and the locked sections.
+            self._save(key, value)
+            self._write()
+
+    def __getitem__(self, key: Hashable) -> Entry:
+        if key not in self.deferred:
+            return self.data[key]
+
+        value = self.deferred[key]
+        if value is MISSING:
+            raise KeyError(key)
+
+        return value
+
+    def __contains__(self, key: Any) -> bool:
+        if key in self.deferred:
+            return self.deferred[key] is not MISSING
+
+        return key in self.data
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for key in self.data:
+            if self.deferred.get(key) is not MISSING:
+                yield key
+
+        for key, value in list(self.deferred.items()):
+            if value is not MISSING and key not in self.data:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self) if self.deferred else len(self.data)
+
+    def __setitem__(self, key: Hashable, value: Entry) -> None:
+        self._change(key, value)
+
+    def __delitem__(self, key: Hashable) -> None:
+        if key not in self:
+            raise KeyError(key)
+
+        self._change(key, MISSING)
+
+    def get_entries(
+        self,
+        count: Optional[int] = None,
+        offset: int = 0,
+        after: Optional[int] = None,
+        sort: str = "index",
+        reverse: bool = False,
+    ) -> Iterator[Entry]:
+        column = self.SORT_COLUMNS[sort]
+        order, operator = ("DESC", "<") if reverse else ("ASC", ">")
+
+        query = f"SELECT {SQLiteStorage.COLUMNS} FROM entries"
+        parameters: List[Any] = []
+        if after is not None:
+            # Continue from the determined entry, so the previous pages aren't read again.
+            bound, _ = self._get_bound(after, sort)
+            if sort == "index":
+                query += f" WHERE idx {operator} ?"
+                parameters.append(after)
+            else:
+                query += f" WHERE {column} {operator} ? OR ({column} = ? AND idx {operator} ?)"
+                parameters.extend((bound, bound, after))
+
+        query += f" ORDER BY {column} {order}, idx {order} LIMIT ? OFFSET ?"
+        parameters.extend((-1 if count is None else count, offset))
+
+        return map(SQLiteStorage.get_entry, self.connection.execute(query, parameters))
+
+    def _get_bound(self, index: int, sort: str) -> Tuple[Any, int]:
+        query = f"SELECT {self.SORT_COLUMNS[sort]} FROM entries WHERE idx = ?"
+        row = self.connection.execute(query, (index,)).fetchone()
+        if row is not None:
+            return row[0], index
+
+        return super()._get_bound(index, sort)
+
+    def get_key(self, index: int) -> Optional[str]:
+        row = self.connection.execute("SELECT key FROM entries WHERE idx = ?", (index,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_expired(self, timestamp: float) -> List[str]:
+        query = "SELECT key FROM entries WHERE removed <= ? ORDER BY removed"
+        return [key for (key,) in self.connection.execute(query, (timestamp,))]
+
+    def _iter_oldest(self) -> Iterator[Tuple[float, Hashable]]:
+        query = "SELECT removed, key FROM entries WHERE removed IS NOT NULL ORDER BY removed"
+        return iter(self.connection.execute(query))
+
+    def _iter_largest(self) -> Iterator[Tuple[int, Hashable]]:
+        query = "SELECT size, key FROM entries WHERE size IS NOT NULL ORDER BY size DESC"
+        return iter(self.connection.execute(query))
+
+    def get_size(self) -> Optional[int]:
+        query = "SELECT name, value FROM meta WHERE name IN ('size', 'unsized')"
+        meta = dict(self.connection.execute(query).fetchall())
+        return None if meta["unsized"] else meta["size"]
+
+    def get_unsized(self) -> List[str]:
+        query = "SELECT key FROM entries WHERE size IS NULL"
+        return [key for (key,) in self.connection.execute(query)]
+
+    def get_references(self, digest: str) -> int:
+        return self.data.get_references(digest)  # type: ignore
+
+    def get_indexes(self) -> List[int]:
+        return [index for (index,) in self.connection.execute("SELECT idx FROM entries")]
+
+    def get_next_index(self) -> int:
+        query = "SELECT value FROM meta WHERE name = 'counter'"
+        return self.connection.execute(query).fetchone()[0] + 1
+
+    def cleanup(self, dry_run: bool = False) -> None:
+        if not dry_run:
+            self.deferred.clear()
+            self.data.clear()
+            # Save the required data on the current machine.
+            self._write()
+
+
+def get_timestamp(date: str) -> Optional[float]:
+    try:
+        return time.mktime(time.strptime(date, settings.DEFAULT_TIME_FORMAT))
+    except ValueError:
+        return None
+
+
+def get_removed_time(entry: Entry) -> Optional[float]:
+    return entry.timestamp if entry.timestamp is not None else get_timestamp(entry.date)
+
+
+def get_score(entry: Entry, timestamp: float) -> float:
+    # The large items which are kept for a long time are evicted first.
+    return max(timestamp - (get_removed_time(entry) or timestamp), 0.0) * (entry.size or 0)
+
+
+def iter_heap(heap: List[Any]) -> Iterator[Any]:
+    # Walk the heap in the sorted order without changing it, only the visited part is sorted.
+    pending = [(heap[0], 0)] if heap else []
+    while pending:
+        item, position = heapq.heappop(pending)
+        yield item
+
+        for child in (2 * position + 1, 2 * position + 2):
+            if child < len(heap):
+                heapq.heappush(pending, (heap[child], child))
+
+
+def write_entries(entries: Iterable[Entry], stream: IO[str], fmt: str = "jsonl") -> None:
+    import csv  # pylint: disable=import-outside-toplevel
+
+    # Every entry is written as soon as it's read, so the whole history is never kept in memory.
+    records = (dict(value._asdict(), timestamp=get_removed_time(value)) for value in entries)
+
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, Entry._fields, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(records)
+    elif fmt == "json":
+        stream.write("[")
+        for number, record in enumerate(records):
+            stream.write(("," if number else "") + "\n" + json.dumps(record))
+        stream.write("\n]\n")
+    else:
+        for record in records:
+            stream.write(json.dumps(record) + "\n")
+
+
+def get_metadata(info: os.stat_result) -> Tuple[int, ...]:
+    return info.st_mode, info.st_uid, info.st_gid, info.st_mtime_ns
+
+
+def set_metadata(path: str, metadata: Tuple[int, ...]) -> None:
+    mode, uid, gid, mtime_ns = metadata
+    try:
+        if (os.getuid(), os.getgid()) != (uid, gid):
+            os.chown(path, uid, gid)
+        os.chmod(path, stat.S_IMODE(mode))
+        os.utime(path, ns=(os.lstat(path).st_atime_ns, mtime_ns))
+    except OSError:
+        logger.warning("The metadata of the item '%s' can't be restored.", path)
+        logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+
+
+def get_mount_point(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+def is_private(path: str) -> bool:
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+
+    # Nobody else may put the items into the directory or replace them.
+    return (
+        stat.S_ISDIR(info.st_mode)
+        and info.st_uid == os.getuid()
+        and not stat.S_IMODE(info.st_mode) & 0o077
+    )
+
+
+def load_history(path: str = settings.DEFAULT_HISTORY_PATH) -> BucketHistory:
+    if os.path.splitext(path)[1] in SQLITE_SUFFIXES:
+        return SQLiteBucketHistory(path=path)
+
+    return BucketHistory(path=path)
+
+
 class Bucket:
     def __init__(
         self,
@@ -119,33 +1167,134 @@ class Bucket:
         history_path: str = settings.DEFAULT_HISTORY_PATH,
         maxsize: int = settings.DEFAULT_BUCKET_SIZE,
         storetime: int = settings.DEFAULT_STORETIME,
+        workers: int = settings.DEFAULT_WORKERS,
+        dedup: bool = settings.DEFAULT_DEDUP,
+        compress_after: int = settings.DEFAULT_COMPRESS_AFTER,
+        eviction: str = settings.DEFAULT_EVICTION,
+        per_device: bool = settings.DEFAULT_PER_DEVICE,
     ) -> None:
         self.path = path
         self.maxsize = maxsize
         self.storetime = storetime
-        self.history = BucketHistory(path=history_path)
+        self.workers = workers
+        self.dedup = dedup
+        self.compress_after = compress_after
+        self.eviction = eviction
+        self.per_device = per_device
+        # The buckets of the other file systems by their devices, if they can be created there.
+        self.devices: Dict[int, Optional[str]] = {}
+        self.history_path = history_path
+        self.stamp_path = history_path + STAMP_SUFFIX
+        # Whether the history is known to match the bucket content.
+        self.synced = False
+        # Whether some items are waiting in the staging directory to be removed.
+        self.staged = False
+        self.staging_path = os.path.join(os.path.dirname(os.path.abspath(path)), STAGING_NAME)
+        # The staging directories of the other file systems with the items waiting to be removed.
+        self.stagings: Set[str] = set()
+        self.store_path = os.path.join(os.path.dirname(os.path.abspath(path)), STORE_NAME)
+        # The items which were evicted from the history, but aren't removed from the bucket yet.
+        self.evicted: List[str] = []
+        # The digests of the files which were read before they are moved to the bucket and their
+        # state at that time.
+        self.digests: Dict[str, Tuple[str, os.stat_result]] = {}
+        self._history: Optional[BucketHistory] = None
+
+    @property
+    def history(self) -> BucketHistory:
+        # The history is loaded only by the commands that really need it.
+        if self._history is None:
+            self._history = load_history(self.history_path)
+
+        return self._history
+
+    def reload(self) -> None:
+        # Drop the loaded history, it will be read again by the next command that needs it.
+        self._history = None
+        self.synced = False
 
     def create(self, dry_run: bool = False) -> None:
         rmlib.mkdir(self.path, dry_run)
 
+    def _get_path(self, key: str) -> str:
+        # The items of the other file systems are known by their absolute paths.
+        return os.path.join(self.path, key)
+
+    def _get_device_bucket(self, path: str) -> Optional[str]:
+        if not self.per_device:
+            return None
+
+        # The item is renamed within its parent directory, so the device of this one matters.
+        parent = os.path.dirname(os.path.abspath(path))
+        try:
+            device = os.stat(parent).st_dev
+            if device == os.stat(self.path).st_dev:
+                return None
+        except OSError:
+            return None
+
+        if device not in self.devices:
+            name = f"{DEVICE_BUCKET_NAME}-{os.getuid()}"
+            bucket = os.path.join(get_mount_point(parent), name)
+            try:
+                os.makedirs(bucket, mode=0o700, exist_ok=True)
+                self.devices[device] = bucket
+            except OSError:
+                # The item is moved to the main bucket across the file systems as before.
+                logger.debug("Can't create the bucket '%s'.", bucket, exc_info=True)
+                self.devices[device] = None
+
+            if self.devices[device] is not None and not is_private(bucket):
+                logger.warning("The bucket '%s' isn't private, it isn't used.", bucket)
+                self.devices[device] = None
+
+        return self.devices[device]
+
+    def _get_staging(self, path: str) -> str:
+        bucket = self._get_device_bucket(path)
+        if bucket is None:
+            return self.staging_path
+
+        # The staging directory of the other file system is kept next to its bucket.
+        staging = os.path.join(os.path.dirname(bucket), f"{STAGING_NAME}-{os.getuid()}")
+        try:
+            os.makedirs(staging, mode=0o700, exist_ok=True)
+        except OSError:
+            logger.debug("Can't create the staging directory '%s'.", staging, exc_info=True)
+            return self.staging_path
+
+        if not is_private(staging):
+            logger.warning("The staging directory '%s' isn't private, it isn't used.", staging)
+            return self.staging_path
+
+        return staging
+
+    def get_device_buckets(self) -> List[str]:
+        buckets = {os.path.dirname(key) for key in self.history if os.path.isabs(key)}
+        buckets.update(bucket for bucket in self.devices.values() if bucket is not None)
+        return sorted(buckets)
+
     def _get_size(self, path: str) -> int:
         size = 0
 
-        if os.path.isfile(path) and not os.path.islink(path):
-            try:
-                return os.path.getsize(path)
-            except (OSError, IOError) as err:
-                logger.error("It's impossible to calculate size of the determined path.")
-                logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
-                # Stop this program runtime and return the exit status code.
-                sys.exit(getattr(err, "errno", errno.EIO))
+        try:
+            info = os.lstat(path)
+        except FileNotFoundError:
+            return size
+        except (OSError, IOError) as err:
+            logger.error("It's impossible to calculate size of the determined path.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            # Stop this program runtime and return the exit status code.
+            sys.exit(getattr(err, "errno", errno.EIO))
+
+        if not stat.S_ISDIR(info.st_mode):
+            # The links don't take the space of the items they point to.
+            return info.st_size if stat.S_ISREG(info.st_mode) else size
 
         try:
-            for top, _, nondirs in os.walk(path):
-                for name in nondirs:
-                    abspath = os.path.join(top, name)
-                    if not os.path.islink(abspath):
-                        size += os.path.getsize(abspath)
+            for entry in rmlib.scantree(path):
+                if entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
         except OSError as err:
             logger.error("The determined path don't exist on the current machine.")
             logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
@@ -154,124 +1303,583 @@ class Bucket:
 
         return size
 
-    def cleanup(self, dry_run: bool = False) -> None:
-        rmlib.rmdir(self.path, dry_run)
+    def cleanup(self, dry_run: bool = False, defer: bool = False) -> None:
+        if not (defer and self._stage(self.path, dry_run)):
+            rmlib.rmdir(self.path, dry_run, self.workers)
+        # The buckets of the other file systems are created again by the next removed items.
+        for bucket in self.get_device_buckets():
+            if is_private(bucket):
+                rmlib.rmdir(bucket, dry_run, self.workers)
+        self.devices.clear()
+        # The shared content isn't referred by any item now.
+        if os.path.isdir(self.store_path) and not (defer and self._stage(self.store_path, dry_run)):
+            rmlib.rmdir(self.store_path, dry_run, self.workers)
         rmlib.mkdir(self.path, dry_run)
         self.history.cleanup(dry_run)
 
     def get_size(self) -> int:
-        return self._get_size(self.path)
+        size = self.history.get_size()
+        if size is None:
+            self.reconcile()
+            size = self.history.get_size()
+
+        return size or 0
+
+    def reconcile(self, full: bool = False) -> None:
+        keys = list(self.history) if full else self.history.get_unsized()
+
+        with self.history.transaction():
+            for key in keys:
+                entry = self.history[key]
+                # The item is still moved to the bucket by another process.
+                if entry.status == Status.PENDING.value:
+                    continue
+
+                size = self._get_size(self._get_path(key))
+                if entry.size != size:
+                    self.history[key] = entry._replace(size=size)
+
+    def _stage(self, path: str, dry_run: bool = False) -> bool:
+        if dry_run:
+            logger.info("Item '%s' was staged to be removed from the current machine.", path)
+            return True
+
+        staging = self._get_staging(path)
+        if rmlib.stage(path, staging) is None:
+            logger.debug("Can't stage the item '%s', removing it at once.", path)
+            return False
+
+        if staging == self.staging_path:
+            self.staged = True
+        else:
+            self.stagings.add(staging)
+        return True
+
+    def _rm(self, path: str, dry_run: bool = False, defer: bool = False) -> None:
+        if defer and self._stage(path, dry_run):
+            return None
 
-    def _rm(self, path: str, dry_run: bool = False) -> None:
         if os.path.isfile(path) or os.path.islink(path):
             rmlib.rm(path, dry_run)
         else:
-            rmlib.rmdir(path, dry_run)
+            rmlib.rmdir(path, dry_run, self.workers)
 
-    def _mv(self, path: str, dry_run: bool = False) -> None:
-        name = str(uuid.uuid4())
+    def purge(self) -> None:
+        rmlib.purge(self.staging_path, self.workers)
+        self.staged = False
 
-        abspath = os.path.join(self.path, name)
-        if os.path.isfile(path) or os.path.islink(path):
-            rmlib.mv(path, abspath, dry_run)
+        # The items left on the other file systems by the interrupted processes are removed too.
+        for bucket in self.get_device_buckets():
+            staging = os.path.join(os.path.dirname(bucket), f"{STAGING_NAME}-{os.getuid()}")
+            if is_private(staging):
+                self.stagings.add(staging)
+
+        while self.stagings:
+            rmlib.purge(self.stagings.pop(), self.workers)
+
+    def hash_files(self, paths: Iterable[str]) -> None:
+        if not self.dedup:
+            return None
+
+        files = {}
+        for path in paths:
+            with contextlib.suppress(OSError):
+                info = os.lstat(path)
+                if stat.S_ISREG(info.st_mode):
+                    files[path] = info
+
+        # Read the content of the next items in parallel before they are moved one by one.
+        for path, digest in rmlib.hash_files(files, self.workers).items():
+            self.digests[path] = (digest, files[path])
+        return None
+
+    def _get_digest(
+        self, path: str, dry_run: bool = False
+    ) -> Tuple[Optional[str], Optional[os.stat_result]]:
+        if not self.dedup or dry_run:
+            return None, None
+        if path in self.digests:
+            return self.digests.pop(path)
+
+        try:
+            info = os.lstat(path)
+        except OSError:
+            return None, None
+        if not stat.S_ISREG(info.st_mode):
+            return None, None
+
+        return rmlib.hash_file(path), info
+
+    def _get_object_path(self, digest: str) -> str:
+        return os.path.join(self.store_path, digest[:2], digest)
+
+    def _share(self, path: str, digest: str, info: os.stat_result) -> Optional[Tuple[int, ...]]:
+        stored = self._get_object_path(digest)
+        link = os.path.join(os.path.dirname(stored), os.path.basename(path))
+
+        try:
+            # The file might be changed after it was hashed, the renamed one keeps its inode too.
+            moved = os.lstat(path)
+            if (moved.st_size, moved.st_mtime_ns) != (info.st_size, info.st_mtime_ns):
+                return None
+            if moved.st_dev == info.st_dev and moved.st_ino != info.st_ino:
+                return None
+
+            if not os.path.lexists(stored):
+                # The first item with this content keeps it for the next ones.
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                os.link(path, stored)
+            else:
+                os.link(stored, link)
+                os.replace(link, path)
+        except OSError:
+            logger.debug("The content of the item '%s' can't be shared.", path, exc_info=True)
+            with contextlib.suppress(OSError):
+                os.remove(link)
+            return None
+
+        # The shared content has the metadata of its first item, so every item keeps its own.
+        return get_metadata(moved)
+
+    def _release(self, entry: Entry) -> None:
+        # The shared content is removed together with the last item that refers to it.
+        if entry.digest is not None and not self.history.get_references(entry.digest):
+            with contextlib.suppress(OSError):
+                os.remove(self._get_object_path(entry.digest))
+
+    def _sweep(self) -> None:
+        if not os.path.isdir(self.store_path):
+            return None
+
+        # Remove the shared content which isn't linked to any item of the bucket anymore.
+        for entry in rmlib.scantree(self.store_path, onerror=lambda err: None):
+            if entry.is_file(follow_symlinks=False):
+                with contextlib.suppress(OSError):
+                    if entry.stat(follow_symlinks=False).st_nlink == 1:
+                        os.remove(entry.path)
+
+        return None
+
+    def _reserve(
+        self,
+        path: str,
+        size: Optional[int],
+        digest: Optional[str] = None,
+        bucket: Optional[str] = None,
+    ) -> str:
+        import uuid  # pylint: disable=import-outside-toplevel
+
+        # The item which was moved partly by the interrupted run is moved to the same place again,
+        # so the items which are already copied to another file system aren't copied twice.
+        name = str(uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(path)))
+        if bucket is not None:
+            name = os.path.join(bucket, name)
+
+        previous = self.history.get(name)
+        if previous is None:
+            pass
+        elif previous.status == Status.PARTIAL.value and previous.origin == path:
+            # The size of the whole item is calculated lazily when the bucket quota is checked.
+            size = None
         else:
-            rmlib.mvdir(path, abspath, dry_run)
+            name = os.path.join(os.path.dirname(name), str(uuid.uuid4()))
 
+        timestamp = time.time()
+        # The other processes account the space and the index of the item before it's moved.
         self.history[name] = Entry(
-            status=Status.CORRECT.value,
+            status=Status.PENDING.value,
             index=self.history.get_next_index(),
             name=os.path.basename(path),
             origin=path,
-            date=datetime.datetime.now().strftime(settings.DEFAULT_TIME_FORMAT),
+            date=time.strftime(settings.DEFAULT_TIME_FORMAT, time.localtime(timestamp)),
+            size=size,
+            timestamp=timestamp,
+            digest=digest,
+            metadata=None,
         )
+        return name
 
-    def rm(self, path: str, force: bool = False, dry_run: bool = False) -> None:
-        if self._get_size(path) + self.get_size() >= self.maxsize:
-            logger.error("It's impossible to move item to bucket because the bucket is full.")
-            # Stop this program runtime and return the exit status code.
-            sys.exit(errno.EPERM)
+    def _mv(
+        self,
+        path: str,
+        name: str,
+        dry_run: bool = False,
+        info: Optional[os.stat_result] = None,
+        shared: bool = False,
+    ) -> None:
+        entry = self.history[name]
+        abspath = self._get_path(name)
+
+        try:
+            if os.path.isfile(path) or os.path.islink(path):
+                rmlib.mv(path, abspath, dry_run)
+            else:
+                rmlib.mvdir(path, abspath, dry_run, self.workers)
+        except BaseException:
+            # Release the reserved space unless a part of the item was already moved, the next run
+            # moves the rest of it to the same place.
+            if os.path.lexists(abspath):
+                self.history[name] = entry._replace(status=Status.PARTIAL.value, size=None)
+            else:
+                del self.history[name]
+            raise
+
+        digest, metadata = entry.digest, None
+        if digest is not None:
+            metadata = None if info is None else self._share(abspath, digest, info)
+            if metadata is None:
+                digest = None
+
+        entry = entry._replace(digest=digest, metadata=metadata)
+        if shared and (digest is None or self.history.get_references(digest) < 2):
+            # The space wasn't reserved for the item which content isn't shared in the end.
+            self._charge(path, name, entry, dry_run)
+
+        self.history[name] = entry._replace(status=Status.CORRECT.value)
 
+    def _charge(self, path: str, name: str, entry: Entry, dry_run: bool = False) -> None:
+        with self.history.locked():
+            self.history[name] = entry
+            excess = self.get_size() - self.maxsize + 1
+            if excess > 0 and not self.evict(excess, dry_run):
+                # The item is put back, so it doesn't overfill the bucket.
+                self._move_back(name, entry._replace(origin=path), dry_run)
+                del self.history[name]
+                self._release(entry)
+                logger.error("It's impossible to move item to bucket because the bucket is full.")
+                # Stop this program runtime and return the exit status code.
+                sys.exit(errno.EPERM)
+
+        # The evicted items are removed without blocking the other processes.
+        while self.evicted:
+            self._rm(self.evicted.pop(), dry_run)
+
+    def rm(
+        self, path: str, force: bool = False, dry_run: bool = False, defer: bool = False
+    ) -> None:
         if force:
-            self._rm(path, dry_run)
-        else:
-            self._mv(path, dry_run)
+            # The permanently deleted items don't take any space in the bucket.
+            self._rm(path, dry_run, defer)
+            return None
 
-    def check(self) -> None:
-        try:
-            content = os.listdir(self.path)
-        except OSError as err:
-            logger.error("The determined path don't exist on the current machine.")
-            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
-            # Stop this program runtime and return the exit status code.
-            sys.exit(getattr(err, "errno", errno.EPERM))
+        size = self._get_size(path)
+        # The item on another file system is renamed into the bucket of the same file system.
+        bucket = self._get_device_bucket(path)
+        # The shared content is kept next to the main bucket, so it can't be linked from others.
+        digest, info = self._get_digest(path, dry_run) if bucket is None else (None, None)
 
-        items = (name for name in content if name not in self.history.keys())
-        # Step - 1.
-        for name in items:
-            self.history[name] = Entry(
-                status=Status.UNKNOWN.value,
-                index=self.history.get_next_index(),
-                name=os.path.basename(name),
-                origin=Status.UNKNOWN.value,
-                date=datetime.datetime.now().strftime(settings.DEFAULT_TIME_FORMAT),
-            )
+        # Check the quota and reserve the space at once, so the parallel runs don't overfill it.
+        with self.history.locked():
+            # The content which is already kept in the bucket doesn't take any more space.
+            charge = 0 if digest is not None and self.history.get_references(digest) else size
 
-        # Step - 2.
-        for key in list(self.history):
-            if key not in content:
-                del self.history[key]
+            # Only the items which size is unknown yet are walked, the rest sizes are accounted.
+            excess = charge + self.get_size() - self.maxsize + 1
+            if excess > 0 and not self.evict(excess, dry_run):
+                logger.error("It's impossible to move item to bucket because the bucket is full.")
+                # Stop this program runtime and return the exit status code.
+                sys.exit(errno.EPERM)
 
-    def timeout_cleanup(self) -> None:
-        try:
-            content = os.listdir(self.path)
-        except OSError as err:
-            logger.error("The determined path don't exist on the current machine.")
-            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
-            # Stop this program runtime and return the exit status code.
-            sys.exit(getattr(err, "errno", errno.EPERM))
+            name = self._reserve(path, size, digest, bucket)
+
+        # The evicted items are removed without blocking the other processes.
+        while self.evicted:
+            self._rm(self.evicted.pop(), dry_run)
 
-        current_time = time.time()
-        for name in content:
-            abspath = os.path.join(self.path, name)
+        self._mv(path, name, dry_run, info, shared=charge < size)
+        return None
 
+    def check(self) -> None:
+        # Compare the content with the history which includes the items of the other processes,
+        # the content is read locked as well, so the items moved meanwhile aren't missed.
+        with self.history.transaction(), self.history.locked():
             try:
-                removed_time = time.mktime(
-                    time.strptime(self.history[name].date, settings.DEFAULT_TIME_FORMAT)
-                )
+                content = os.listdir(self.path)
             except OSError as err:
-                logger.error("It's impossible to get removed time for the determined path.")
+                logger.error("The determined path don't exist on the current machine.")
                 logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
                 # Stop this program runtime and return the exit status code.
                 sys.exit(getattr(err, "errno", errno.EPERM))
 
-            if removed_time <= current_time - self.storetime:
+            # The buckets which can't be read, like the ones of the unmounted file systems, are
+            # kept in the history as they are.
+            unreadable = set()
+            for bucket in self.get_device_buckets():
+                # The items which other users might have put into the bucket aren't adopted.
+                if not is_private(bucket):
+                    unreadable.add(bucket)
+                    continue
+
+                try:
+                    content.extend(os.path.join(bucket, name) for name in os.listdir(bucket))
+                except OSError:
+                    unreadable.add(bucket)
+
+            items = (name for name in content if name not in self.history)
+            timestamp = time.time()
+            # Step - 1.
+            for name in items:
+                self.history[name] = Entry(
+                    status=Status.UNKNOWN.value,
+                    index=self.history.get_next_index(),
+                    name=os.path.basename(name),
+                    origin=Status.UNKNOWN.value,
+                    date=time.strftime(settings.DEFAULT_TIME_FORMAT, time.localtime(timestamp)),
+                    # The size is calculated lazily when the bucket quota is checked.
+                    size=None,
+                    timestamp=timestamp,
+                    digest=None,
+                    metadata=None,
+                )
+
+            # Step - 2.
+            names = set(content)
+            for key in list(self.history):
+                if key in names or os.path.dirname(key) in unreadable:
+                    continue
+                # The reserved item might be still moved to the bucket by another process.
+                if self.history[key].status != Status.PENDING.value:
+                    self._release(self.history.pop(key))
+
+        self._sweep()
+
+    def timeout_cleanup(self) -> None:
+        for name in self.history.get_expired(time.time() - self.storetime):
+            abspath = self._get_path(name)
+
+            if os.path.lexists(abspath):
                 self._rm(abspath)
+            self._release(self.history.pop(name))
+
+    def evict(self, size: int, dry_run: bool = False) -> bool:
+        # The item which doesn't fit even into the empty bucket doesn't evict anything.
+        if self.eviction == "none" or size > (self.history.get_size() or 0):
+            return False
+
+        victims = []
+        freed = 0
+        shared: Dict[str, int] = collections.Counter()
+        for key in self.history.get_victims(self.eviction, time.time()):
+            entry = self.history[key]
+            if entry.status == Status.PENDING.value:
+                continue
+            victims.append(key)
+
+            if entry.digest is not None:
+                # The shared content is freed only together with its last item.
+                shared[entry.digest] += 1
+                if shared[entry.digest] < self.history.get_references(entry.digest):
+                    continue
+
+            freed += entry.size or 0
+            if freed >= size:
+                break
+        else:
+            return False
+
+        for key in victims:
+            logger.warning(
+                "Item '%s' was evicted from the bucket to free the space.", self.history[key].origin
+            )
+            abspath = self._get_path(key)
+            if os.path.lexists(abspath):
+                self.evicted.append(abspath)
+            if not dry_run:
+                self._release(self.history.pop(key))
+
+        return True
+
+    def compress(self, dry_run: bool = False) -> None:
+        if not self.compress_after:
+            return None
+
+        for key in self.history.get_expired(time.time() - self.compress_after):
+            entry = self.history[key]
+            # The shared content is kept only once already, so only the own items are compressed.
+            if entry.status != Status.CORRECT.value or entry.digest is not None:
+                continue
+
+            abspath = self._get_path(key)
+            archive = key + ARCHIVE_SUFFIX
+            size = rmlib.pack(abspath, self._get_path(archive), dry_run)
+            if size is None:
+                continue
+            if entry.size is not None and size >= entry.size:
+                # The item which doesn't get smaller is kept as it is and isn't packed again.
+                with contextlib.suppress(OSError):
+                    os.remove(self._get_path(archive))
+                self.history[key] = entry._replace(status=Status.INCOMPRESSIBLE.value)
+                continue
+
+            # The bucket quota is charged only for the compressed size of the item.
+            del self.history[key]
+            self.history[archive] = entry._replace(status=Status.COMPRESSED.value, size=size)
+            self._rm(abspath)
+
+        return None
+
+    def _move_back(self, name: str, entry: Entry, dry_run: bool = False) -> None:
+        abspath = self._get_path(name)
+        if entry.status == Status.COMPRESSED.value:
+            rmlib.unpack(abspath, entry.origin, dry_run)
+            rmlib.rm(abspath, dry_run)
+        elif os.path.isfile(abspath) or os.path.islink(abspath):
+            rmlib.mv(abspath, entry.origin, dry_run)
+        else:
+            rmlib.mvdir(abspath, entry.origin, dry_run, self.workers)
+
+    def _forget(self, name: str, entry: Entry) -> None:
+        del self.history[name]
+        self._release(entry)
+
+        # The restored file doesn't share its content with the items which are still kept.
+        if entry.digest is not None and os.lstat(entry.origin).st_nlink > 1:
+            rmlib.detach(entry.origin)
+        if entry.metadata is not None:
+            set_metadata(entry.origin, entry.metadata)
 
     def restore(self, index: int, dry_run: bool = False) -> None:
-        if index not in self.history.get_indexes():
+        # The item might be removed by another process since the history was read.
+        with self.history.locked():
+            name = self.history.get_key(index)
+        if name is None:
             logger.error("The determined index don't exist in history.")
             # Stop this program runtime and return the exit status code.
             sys.exit(errno.EPERM)
 
-        for name, entry in self.history.items():
-            if entry.index == index:
-                # Step - 1.
-                if os.path.exists(entry.origin) or entry.origin == Status.UNKNOWN.value:
-                    logger.error("The determined path can't be moved on the current machine.")
-                    # Stop this program runtime and return the exit status code.
-                    sys.exit(errno.EPERM)
+        # Step - 1.
+        entry = self.history[name]
+        if os.path.exists(entry.origin) or entry.origin == Status.UNKNOWN.value:
+            logger.error("The determined path can't be moved on the current machine.")
+            # Stop this program runtime and return the exit status code.
+            sys.exit(errno.EPERM)
+
+        # Step - 2.
+        self._move_back(name, entry, dry_run)
+
+        if not dry_run:
+            self._forget(name, entry)
+
+    def restore_many(self, indexes: Iterable[int], dry_run: bool = False) -> List[int]:
+        failed: List[int] = []
+        items: Dict[str, Tuple[int, str, Entry]] = {}
+
+        # Step - 1.
+        with self.history.locked():
+            for index in dict.fromkeys(indexes):
+                name = self.history.get_key(index)
+                if name is None:
+                    logger.warning("The index %d don't exist in history.", index)
+                    failed.append(index)
+                    continue
+
+                entry = self.history[name]
+                if entry.origin == Status.UNKNOWN.value or entry.origin in items:
+                    logger.warning("Item '%s' can't be restored to its origin.", entry.origin)
+                    failed.append(index)
+                    continue
+                items[entry.origin] = (index, name, entry)
+
+        # Step - 2.
+        restored: List[Tuple[str, Entry]] = []
+
+        def run(index: int, name: str, entry: Entry) -> None:
+            if os.path.exists(entry.origin):
+                logger.warning("Item '%s' can't be restored to its origin.", entry.origin)
+                failed.append(index)
+                return None
+
+            try:
+                self._move_back(name, entry, dry_run)
+            except SystemExit:
+                # The error is already reported, the other items are restored anyway.
+                failed.append(index)
+            else:
+                restored.append((name, entry))
+            return None
 
-                # Step - 2.
-                abspath = os.path.join(self.path, name)
-                if os.path.isfile(abspath) or os.path.islink(abspath):
-                    rmlib.mv(abspath, entry.origin, dry_run)
-                else:
-                    rmlib.mvdir(abspath, entry.origin, dry_run)
+        # The items of the same depth can't contain each other, so they are moved in parallel and
+        # the directories are restored before the items which were removed from them earlier.
+        def get_depth(item: Tuple[int, str, Entry]) -> int:
+            return item[2].origin.count(os.sep)
 
-        self.check()
+        for _, group in itertools.groupby(sorted(items.values(), key=get_depth), get_depth):
+            rmlib.parallel(run, group, self.workers)
 
-    def startup(self) -> None:
+        # Step - 3.
+        if not dry_run:
+            with self.history.transaction():
+                for name, entry in restored:
+                    self._forget(name, entry)
+
+        return sorted(failed)
+
+    def _read_stamp(self) -> Dict[str, int]:
+        try:
+            with io.open(self.stamp_path, mode="rt", encoding="utf-8") as stream_in:
+                stamp = json.load(stream_in)
+        except (OSError, ValueError):
+            return {}
+
+        return stamp if isinstance(stamp, dict) else {}
+
+    def _write_stamp(self, timestamp: int) -> None:
+        try:
+            stamp = {"mtime": os.stat(self.path).st_mtime_ns, "time": timestamp}
+
+            tmp_path = self.stamp_path + ".tmp"
+            with io.open(tmp_path, mode="wt", encoding="utf-8") as stream_out:
+                json.dump(stamp, stream_out)
+            os.replace(tmp_path, self.stamp_path)
+        except OSError:
+            # The bucket is just maintained once more by the next run without the stamp.
+            logger.debug("Can't save the maintenance stamp of the bucket.", exc_info=True)
+
+    def startup(self, maintain: bool = True) -> None:
         self.create()
-        self.check()
-        self.timeout_cleanup()
-        self.check()
+
+        # Resume the removal of the staged items if it was interrupted.
+        with contextlib.suppress(OSError):
+            self.staged = any(name != rmlib.STAGING_LOCK for name in os.listdir(self.staging_path))
+
+        if not maintain:
+            return None
+
+        stamp = self._read_stamp()
+        try:
+            changed = stamp.get("mtime") != os.stat(self.path).st_mtime_ns
+        except OSError:
+            changed = True
+
+        timestamp = int(time.time())
+        expired = timestamp - stamp.get("time", 0) >= MAINTENANCE_INTERVAL
+
+        # Walk the bucket only if it was changed by hand or some items might be expired.
+        if changed or expired:
+            with self.history.transaction():
+                # The change made within the precision of the modification time is found later.
+                self.check()
+                if expired:
+                    self.timeout_cleanup()
+                    # The accounted sizes of the items changed by hand are corrected once a while.
+                    self.reconcile(full=True)
+                    # The aged items are compressed by the same maintenance.
+                    self.compress()
+
+            self._write_stamp(timestamp if expired else stamp["time"])
+
+        self.synced = True
+        return None
+
+    def shutdown(self) -> None:
+        # Keep the stamp valid after the bucket was changed by this program.
+        if self.synced:
+            self._write_stamp(self._read_stamp().get("time", 0))
+
+        # Remove the staged items without blocking the user.
+        if self.staged:
+            rmlib.purge_in_background(self.staging_path, self.workers)
+            self.staged = False
+
+        while self.stagings:
+            rmlib.purge_in_background(self.stagings.pop(), self.workers)
@@ -0,0 +1,301 @@
+import argparse
+import contextlib
+import errno
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import time
+from typing import IO, Any, Callable, Dict, Mapping, Optional, Tuple
+
+from . import bucket
+from .logger import LOGGING_CONFIG
+
+# Create a new instance of the preferred reporting system for this program.
+logger = logging.getLogger("myrm")
+
+__all__ = (
+    "DEFAULT_SOCKET_PATH",
+    "Server",
+    "serve",
+    "request",
+)
+
+
+# Where the daemon waits for the commands of the current user.
+DEFAULT_SOCKET_PATH: str = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"myrm-{os.getuid()}.sock"
+)
+
+# The count of seconds to wait for the client that doesn't send its command.
+REQUEST_TIMEOUT = 60
+# The count of seconds between two checks whether the bucket maintenance is due.
+POLL_INTERVAL = 1.0
+
+Command = Callable[[argparse.Namespace, bucket.Bucket], None]
+
+
+class ResponseWriter(io.TextIOBase):
+    def __init__(self, stream: io.BufferedIOBase) -> None:
+        super().__init__()
+        self.stream = stream
+        self.broken = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if text:
+            self.send({"out": text})
+
+        return len(text)
+
+    def send(self, message: Dict[str, Any]) -> None:
+        if self.broken:
+            return None
+
+        try:
+            self.stream.write(json.dumps(message).encode("utf-8") + b"\n")
+            self.stream.flush()
+        except OSError:
+            # The client went away, but the command is finished anyway to keep the bucket valid.
+            self.broken = True
+            logger.debug("The client of the daemon was disconnected.", exc_info=True)
+
+        return None
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    timeout = REQUEST_TIMEOUT
+    server: "Server"
+
+    def handle(self) -> None:
+        writer = ResponseWriter(self.wfile)
+
+        try:
+            message = json.loads(self.rfile.readline().decode("utf-8"))
+            command = self.server.commands[message["command"]]
+            arguments = argparse.Namespace(**message["arguments"])
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.debug("The daemon received an invalid request.", exc_info=True)
+            writer.send({"exit": errno.EINVAL})
+            return None
+
+        # The client with other settings executes its command by itself.
+        if message.get("settings") != self.server.settings:
+            writer.send({"fallback": True})
+            return None
+
+        writer.send({"exit": self.server.execute(command, arguments, writer)})
+        return None
+
+
+class Server(socketserver.UnixStreamServer):
+    def __init__(
+        self,
+        path: str,
+        bucket_instance: bucket.Bucket,
+        settings: Dict[str, Any],
+        commands: Mapping[str, Command],
+    ) -> None:
+        self.bucket = bucket_instance
+        self.settings = settings
+        self.commands = commands
+        self.history_state = self.get_history_state()
+        self.next_maintenance = 0.0
+
+        super().__init__(path, RequestHandler)
+
+    def get_history_state(self) -> Tuple[Tuple[int, int], ...]:
+        state = []
+        for path in (self.bucket.history_path, self.bucket.history_path + bucket.JOURNAL_SUFFIX):
+            try:
+                info = os.stat(path)
+            except OSError:
+                state.append((0, 0))
+            else:
+                state.append((info.st_mtime_ns, info.st_size))
+
+        return tuple(state)
+
+    def refresh(self) -> None:
+        # Read the history again if it was changed by the program running without the daemon.
+        if self.get_history_state() != self.history_state:
+            self.bucket.reload()
+
+    def execute(
+        self, command: Command, arguments: argparse.Namespace, stream: io.TextIOBase
+    ) -> int:
+        config = LOGGING_CONFIG["formatters"]["default"]
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter(config["format"], config["datefmt"]))
+
+        level = logger.level
+        logger.setLevel(logging.INFO if arguments.dry_run else arguments.logging_level)
+        logger.addHandler(handler)
+
+        code = 0
+        try:
+            self.refresh()
+            with contextlib.redirect_stdout(stream):  # type: ignore
+                command(arguments, self.bucket)
+            self.bucket.shutdown()
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else errno.EPERM
+        except Exception:  # pylint: disable=broad-except
+            logger.error("An unexpected error occurred at this program runtime.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            code = errno.EPERM
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        if code:
+            # The failed command might leave the history which doesn't match the saved one.
+            self.bucket.reload()
+        self.history_state = self.get_history_state()
+
+        return code
+
+    def service_actions(self) -> None:
+        # Remove the expired items between the commands instead of before every command.
+        if time.monotonic() < self.next_maintenance:
+            return None
+
+        self.next_maintenance = time.monotonic() + bucket.MAINTENANCE_INTERVAL
+        try:
+            self.refresh()
+            # The aged items are compressed while nobody waits for the daemon.
+            self.bucket.startup()
+            self.bucket.shutdown()
+        except SystemExit:
+            logger.debug("The bucket maintenance was failed.", exc_info=True)
+            self.bucket.reload()
+        except Exception:  # pylint: disable=broad-except
+            logger.error("An unexpected error occurred at this program runtime.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            self.bucket.reload()
+        self.history_state = self.get_history_state()
+
+        return None
+
+
+def _connect(path: str) -> Optional[socket.socket]:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        return None
+
+    return connection
+
+
+def _is_trusted(connection: socket.socket, path: str) -> bool:
+    # The socket in the shared directory might be bound by another user before the daemon.
+    if hasattr(socket, "SO_PEERCRED"):
+        size = struct.calcsize("3i")
+        try:
+            _, uid, _ = struct.unpack(
+                "3i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size)
+            )
+        except (OSError, struct.error):
+            return False
+
+        return uid == os.getuid()
+
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+
+    return info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+def serve(
+    bucket_instance: bucket.Bucket,
+    settings: Dict[str, Any],
+    commands: Mapping[str, Command],
+    path: str = DEFAULT_SOCKET_PATH,
+) -> None:
+    if os.path.exists(path):
+        connection = _connect(path)
+        if connection is not None:
+            connection.close()
+            logger.error("The daemon is already running on the current machine.")
+            # Stop this program runtime and return the exit status code.
+            sys.exit(errno.EADDRINUSE)
+
+        # Remove the socket left by the daemon that was killed.
+        os.remove(path)
+
+    # Only the current user can connect to the daemon.
+    umask = os.umask(0o077)
+    try:
+        server = Server(path, bucket_instance, settings, commands)
+    except OSError as err:
+        logger.error("It's impossible to start the daemon on the current machine.")
+        logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+        # Stop this program runtime and return the exit status code.
+        sys.exit(getattr(err, "errno", errno.EPERM))
+    finally:
+        os.umask(umask)
+
+    # Stop the daemon the same way as by the keyboard interrupt, so the socket is removed.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    logger.info("The daemon is waiting for the commands on '%s'.", path)
+    try:
+        server.serve_forever(poll_interval=POLL_INTERVAL)
+    finally:
+        server.server_close()
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+def request(
+    command: str,
+    arguments: Dict[str, Any],
+    settings: Dict[str, Any],
+    path: str = DEFAULT_SOCKET_PATH,
+    stdout: Optional[IO[str]] = None,
+) -> Optional[int]:
+    connection = _connect(path)
+    if connection is None:
+        # The daemon isn't running, so the command is executed by the client itself.
+        return None
+
+    if not _is_trusted(connection, path):
+        connection.close()
+        logger.warning("The daemon socket '%s' belongs to another user, it isn't used.", path)
+        return None
+
+    message = {"command": command, "arguments": arguments, "settings": settings}
+    stdout = stdout or sys.stdout
+
+    with connection, connection.makefile(mode="rwb") as stream:
+        try:
+            stream.write(json.dumps(message).encode("utf-8") + b"\n")
+            stream.flush()
+
+            for line in stream:
+                response = json.loads(line.decode("utf-8"))
+                if "out" in response:
+                    stdout.write(response["out"])
+                    stdout.flush()
+                elif response.get("fallback"):
+                    return None
+                else:
+                    return int(response["exit"])
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+
+    logger.error("The daemon was stopped before the command was executed.")
+    return errno.EIO
@@ -1,6 +1,6 @@
 import logging
-import logging.config
 import os
+import sys
 import tempfile
 import types
 from typing import Any, Mapping
@@ -26,6 +26,8 @@ LOGGING_CONFIG: Mapping[str, Any] = types.MappingProxyType(
                 "filename": os.path.join(tempfile.gettempdir(), "myrm.log"),
                 "formatter": "default",
                 "mode": "at",
+                # Open the file only when the first record is written.
+                "delay": True,
             },
         },
         "loggers": {
@@ -40,4 +42,26 @@ LOGGING_CONFIG: Mapping[str, Any] = types.MappingProxyType(
 
 
 def setup() -> None:
-    logging.config.dictConfig(config=dict(LOGGING_CONFIG))
+    # Build the handlers of the configuration directly, logging.config is slow to import.
+    formatter_config = LOGGING_CONFIG["formatters"]["default"]
+    formatter = logging.Formatter(formatter_config["format"], formatter_config["datefmt"])
+
+    logfile_config = LOGGING_CONFIG["handlers"]["logfile"]
+    handlers = (
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler(
+            logfile_config["filename"],
+            mode=logfile_config["mode"],
+            encoding=logfile_config["encoding"],
+            delay=logfile_config["delay"],
+        ),
+    )
+
+    logger = logging.getLogger("myrm")
+    # Replace the handlers of the previous setup like the configuration does.
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
@@ -0,0 +1,212 @@
+import errno
+import logging
+import os
+import re
+import sys
+from typing import Callable, Iterable, Iterator, List, Optional, Pattern, Set
+
+from . import rmlib
+
+# Create a new instance of the preferred reporting system for this program.
+logger = logging.getLogger("myrm")
+
+__all__ = (
+    "Glob",
+    "Matcher",
+    "translate",
+    "find",
+)
+
+
+def translate(pattern: str) -> str:
+    parts = []
+    index, length = 0, len(pattern)
+
+    while index < length:
+        char = pattern[index]
+        index += 1
+
+        if char == "*" and pattern.startswith("*", index):
+            index += 1
+            if pattern.startswith("/", index):
+                # Match zero or more directories.
+                index += 1
+                parts.append("(?:.*/)?")
+            else:
+                parts.append(".*")
+        elif char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and pattern.find("]", index + 1) >= 0:
+            # Match the set of characters.
+            end = pattern.find("]", index + 1)
+            chars = pattern[index:end].replace("\\", "\\\\")
+            index = end + 1
+
+            if chars.startswith("!"):
+                chars = "^/" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            parts.append(f"[{chars}]")
+        else:
+            parts.append(re.escape(char))
+
+    return "".join(parts)
+
+
+class Glob:
+    def __init__(self, pattern: str, anchored: bool = True) -> None:
+        self.pattern = pattern.strip("/")
+        # The pattern without slashes might match the name of the item at any depth.
+        self.basename = not anchored and "/" not in self.pattern
+
+        self.regex = re.compile(f"(?s:{translate(self.pattern)})")
+        self.segments = [
+            None if "**" in segment else re.compile(f"(?s:{translate(segment)})")
+            for segment in self.pattern.split("/")
+        ]
+
+    def match(self, path: str) -> bool:
+        if self.basename:
+            path = path.rpartition("/")[2]
+
+        return self.regex.fullmatch(path) is not None
+
+    def contains(self, path: str) -> bool:
+        # Check whether the items inside the determined directory might match this pattern.
+        if self.basename:
+            return True
+
+        parts = path.split("/")
+        for part, segment in zip(parts, self.segments):
+            if segment is None:
+                return True
+            if segment.fullmatch(part) is None:
+                return False
+
+        return len(parts) < len(self.segments)
+
+
+class Matcher:
+    def __init__(
+        self,
+        regex: Optional[str] = None,
+        glob: Optional[str] = None,
+        include: Iterable[str] = (),
+        exclude: Iterable[str] = (),
+    ) -> None:
+        self.regexes: List[Pattern[str]] = []
+        self.globs: List[Glob] = []
+
+        if regex is not None:
+            try:
+                self.regexes.append(re.compile(regex))
+            except re.error:
+                logger.warning(
+                    "The determined pattern isn't a regular expression, it's used as the glob."
+                )
+                self.globs.append(Glob(regex))
+
+        if glob is not None:
+            self.globs.append(Glob(glob))
+
+        self.include = [Glob(pattern, anchored=False) for pattern in include]
+        self.exclude = [Glob(pattern, anchored=False) for pattern in exclude]
+
+    def __bool__(self) -> bool:
+        return bool(self.regexes or self.globs or self.include or self.exclude)
+
+    def excluded(self, path: str) -> bool:
+        return any(pattern.match(path) for pattern in self.exclude)
+
+    def match(self, path: str) -> bool:
+        return (
+            all(regex.fullmatch(path) for regex in self.regexes)
+            and all(pattern.match(path) for pattern in self.globs)
+            and (not self.include or any(pattern.match(path) for pattern in self.include))
+            and not self.excluded(path)
+        )
+
+    def descend(self, path: str) -> bool:
+        # The matched directory is removed as a whole, so its content isn't searched.
+        return (
+            not self.excluded(path)
+            and not self.match(path)
+            and all(pattern.contains(path) for pattern in self.globs)
+        )
+
+
+def _split(
+    path: str,
+    matcher: Matcher,
+    get_relpath: Callable[[os.DirEntry], str],
+    onerror: Callable[[OSError], None],
+) -> Iterator[str]:
+    # The directories which contain the excluded items and the items which can't be checked.
+    dirty: Set[str] = set()
+    kept: Set[str] = set()
+
+    def keep(item: str) -> None:
+        kept.add(item)
+        # Only the directories above the kept item are removed item by item.
+        while item != path:
+            item = os.path.dirname(item)
+            if item in dirty:
+                break
+            dirty.add(item)
+
+    def onerror_keep(err: OSError) -> None:
+        # The content which can't be checked isn't removed.
+        onerror(err)
+        if err.filename is not None:
+            keep(err.filename)
+
+    for entry in rmlib.scantree(
+        path, descend=lambda entry: not matcher.excluded(get_relpath(entry)), onerror=onerror_keep
+    ):
+        if matcher.excluded(get_relpath(entry)):
+            keep(entry.path)
+
+    if path in kept:
+        return None
+    if not dirty:
+        # Nothing inside the directory is excluded, so it's removed as a whole.
+        yield path
+        return None
+
+    # Yield the largest parts of the tree without the kept items while it's searched again.
+    for entry in rmlib.scantree(path, descend=lambda entry: entry.path in dirty, onerror=onerror):
+        if entry.path not in dirty and entry.path not in kept:
+            if not matcher.excluded(get_relpath(entry)):
+                yield entry.path
+
+    return None
+
+
+def find(path: str, matcher: Matcher) -> Iterator[str]:
+    if not os.path.isdir(path):
+        logger.error("The determined path don't exist on the current machine.")
+        # Stop this program runtime and return the exit status code.
+        sys.exit(errno.ENOENT)
+
+    prefix = len(os.path.join(path, ""))
+
+    def get_relpath(entry: os.DirEntry) -> str:
+        return entry.path[prefix:].replace(os.sep, "/")
+
+    def onerror(err: OSError) -> None:
+        logger.warning("The directory '%s' can't be searched on the current machine.", err.filename)
+
+    # Search the tree lazily, so the matched items are removed while the rest isn't read yet.
+    for entry in rmlib.scantree(
+        path, descend=lambda entry: matcher.descend(get_relpath(entry)), onerror=onerror
+    ):
+        if not matcher.match(get_relpath(entry)):
+            continue
+
+        # The matched directory is removed as a whole only if nothing inside it is excluded.
+        if matcher.exclude and entry.is_dir(follow_symlinks=False):
+            yield from _split(entry.path, matcher, get_relpath, onerror)
+        else:
+            yield entry.path
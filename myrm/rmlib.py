@@ -1,7 +1,14 @@
+import contextlib
 import errno
+import fcntl
+import io
+import itertools
 import logging
 import os
+import shutil
+import stat
 import sys
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 # Create a new instance of the preferred reporting system for this program.
 logger = logging.getLogger("myrm")
@@ -12,6 +19,56 @@ __all__ = (
     "mkdir",
     "mv",
     "mvdir",
+    "scantree",
+    "stage",
+    "purge",
+    "purge_in_background",
+    "hash_file",
+    "hash_files",
+    "detach",
+    "pack",
+    "unpack",
+    "parallel",
+    "WORKERS",
+)
+
+# The default count of threads that process the items of a directory tree in parallel.
+WORKERS: int = min(32, (os.cpu_count() or 1) + 4)
+
+# The maximal depth of the directories which are split into subtrees for the parallel removal.
+SPLIT_DEPTH: int = 3
+
+# The count of files of the same directory which are unlinked by a single worker task.
+UNLINK_BATCH: int = 256
+
+DIR_FLAGS: int = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+NOFOLLOW_FLAGS: int = getattr(os, "O_NOFOLLOW", 0)
+
+# Check whether the items can be removed relative to the opened directories on the current machine.
+DIR_FD_SUPPORTED: bool = {os.open, os.unlink, os.rmdir} <= os.supports_dir_fd and (
+    os.scandir in os.supports_fd
+)
+
+# The file that is locked by the process which removes the staged items.
+STAGING_LOCK: str = ".lock"
+
+# The maximal count of bytes copied by a single system call.
+COPY_CHUNK_SIZE: int = 8 * 1024 * 1024
+
+# The suffix of the file that is being copied to another file system.
+PARTIAL_SUFFIX: str = ".myrm-partial"
+# The suffix of the copy that replaces the file which shares its content with the other links.
+DETACHED_SUFFIX: str = ".myrm-detached"
+
+# The count of bytes read at once to calculate the digest of the file content.
+HASH_CHUNK_SIZE: int = 1024 * 1024
+
+# The compression level of the archives, the higher levels take much more memory and time.
+ARCHIVE_PRESET: int = 6
+
+# The errors which mean that the kernel can't copy the data between the determined files.
+COPY_FALLBACK_ERRORS = frozenset(
+    (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF)
 )
 
 
@@ -28,32 +85,186 @@ def rm(path: str, dry_run: bool = False) -> None:
         logger.info("Item '%s' was removed without errors.", path)
 
 
-def rmdir(path: str, dry_run: bool = False) -> None:
+def scantree(
+    path: str,
+    topdown: bool = True,
+    descend: Optional[Callable[[os.DirEntry], bool]] = None,
+    onerror: Optional[Callable[[OSError], None]] = None,
+) -> Iterator[os.DirEntry]:
+    # Only the directories which are still waiting to be scanned are kept, so the memory
+    # doesn't depend on the depth of the tree and only one directory is opened at a time.
+    stack: List[Tuple[str, Optional[os.DirEntry]]] = [(path, None)]
+
+    while stack:
+        top, done = stack.pop()
+        if done is not None:
+            # All the content of this directory was already yielded.
+            yield done
+            continue
+
+        try:
+            entries = os.scandir(top)
+        except OSError as err:
+            if onerror is None:
+                raise
+            onerror(err)
+            continue
+
+        with entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    yield entry
+                    continue
+
+                # Skip the subtrees the caller isn't interested in without scanning them.
+                if descend is not None and not descend(entry):
+                    yield entry
+                elif topdown:
+                    stack.append((entry.path, None))
+                    yield entry
+                else:
+                    stack.append((entry.path, entry))
+                    stack.append((entry.path, None))
+
+
+def _rmtree_walk(path: str, dry_run: bool = False) -> None:
     try:
-        content = os.walk(path, topdown=False)
+        for entry in scantree(path, topdown=False):
+            # Step — 1.
+            if not entry.is_dir(follow_symlinks=False):
+                rm(entry.path, dry_run)
+                continue
+
+            try:
+                # Step — 2.
+                if not dry_run:
+                    os.rmdir(entry.path)
+                logger.info("Directory '%s' was removed from the current machine.", entry.path)
+            except OSError as err:
+                logger.error("The determined path can't be removed from the current machine.")
+                logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+                # Stop this program runtime and return the exit status code.
+                sys.exit(getattr(err, "errno", errno.EPERM))
     except OSError as err:
         logger.error("The determined path don't exist on the current machine.")
         logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
         # Stop this program runtime and return the exit status code.
         sys.exit(getattr(err, "errno", errno.EPERM))
 
-    for top, dirs, nondirs in content:
-        # Step — 1.
-        for name in nondirs:
-            rm(os.path.join(top, name), dry_run)
 
+def _rmtree_at(dir_fd: int, name: str) -> None:
+    fd = os.open(name, DIR_FLAGS | NOFOLLOW_FLAGS, dir_fd=dir_fd)
+    stack = [(fd, name, dir_fd, os.scandir(fd))]
+
+    try:
+        while stack:
+            fd, name, dir_fd, entries = stack[-1]
+
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Go deeper before the rest of the current directory is removed.
+                    child = os.open(entry.name, DIR_FLAGS | NOFOLLOW_FLAGS, dir_fd=fd)
+                    stack.append((child, entry.name, fd, os.scandir(child)))
+                    break
+
+                os.unlink(entry.name, dir_fd=fd)
+            else:
+                stack.pop()
+                entries.close()
+                os.close(fd)
+                os.rmdir(name, dir_fd=dir_fd)
+    finally:
+        for fd, _, _, entries in stack:
+            entries.close()
+            os.close(fd)
+
+
+def _unlink_at(dir_fd: int, names: List[str]) -> None:
+    for name in names:
+        os.unlink(name, dir_fd=dir_fd)
+
+
+def _apply(func: Callable[..., None], *args: Any) -> None:
+    func(*args)
+
+
+def _scandir_at(
+    parents: List[int], workers: int, levels: List[List[Tuple[int, str]]], opened: List[int]
+) -> Iterator[Tuple[Callable[..., None], int, Any]]:
+    for depth in itertools.count():
+        head: List[Tuple[int, str]] = []
+        split = depth < SPLIT_DEPTH
+
+        for fd in parents:
+            names: List[str] = []
+            with os.scandir(fd) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        # The files of a flat directory are unlinked by all workers together.
+                        names.append(entry.name)
+                        if len(names) >= UNLINK_BATCH:
+                            yield _unlink_at, fd, names
+                            names = []
+                    elif not split:
+                        yield _rmtree_at, fd, entry.name
+                    else:
+                        head.append((fd, entry.name))
+                        # Split the tree into smaller subtrees until there are enough of them.
+                        if len(head) >= workers:
+                            split = False
+                            for dir_fd, name in head:
+                                yield _rmtree_at, dir_fd, name
+
+            if names:
+                yield _unlink_at, fd, names
+
+        if not split or not head:
+            return None
+
+        levels.append(head)
+        for dir_fd, name in head:
+            opened.append(os.open(name, DIR_FLAGS | NOFOLLOW_FLAGS, dir_fd=dir_fd))
+        parents = opened[-len(head) :]  # noqa
+
+
+def _rmtree(fd: int, workers: int) -> None:
+    levels: List[List[Tuple[int, str]]] = []
+    opened: List[int] = []
+
+    try:
+        parallel(_apply, _scandir_at([fd], workers, levels, opened), workers)
+
+        # Remove the directories the tree was split by, starting from the deepest ones.
+        for level in reversed(levels):
+            for dir_fd, name in level:
+                os.rmdir(name, dir_fd=dir_fd)
+    finally:
+        for dir_fd in opened:
+            os.close(dir_fd)
+
+
+def rmdir(path: str, dry_run: bool = False, workers: int = WORKERS) -> None:
+    if dry_run or not DIR_FD_SUPPORTED:
+        _rmtree_walk(path, dry_run)
+    else:
         try:
-            # Step — 2.
-            for name in dirs:
-                abspath = os.path.join(top, name)
-                if not dry_run:
-                    os.rmdir(abspath)
-                logger.info("Directory '%s' was removed from the current machine.", abspath)
+            fd = os.open(path, DIR_FLAGS)
+        except OSError as err:
+            logger.error("The determined path don't exist on the current machine.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            # Stop this program runtime and return the exit status code.
+            sys.exit(getattr(err, "errno", errno.EPERM))
+
+        try:
+            # Remove the content relative to the opened directories, so paths aren't resolved again.
+            _rmtree(fd, workers)
         except OSError as err:
             logger.error("The determined path can't be removed from the current machine.")
             logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
             # Stop this program runtime and return the exit status code.
             sys.exit(getattr(err, "errno", errno.EPERM))
+        finally:
+            os.close(fd)
 
     try:
         if not dry_run or not os.path.exists(path):
@@ -81,10 +292,140 @@ def mkdir(path: str, dry_run: bool = False) -> None:
             sys.exit(getattr(err, "errno", errno.EPERM))
 
 
+def _copy_data(fsrc: int, fdst: int, size: int) -> None:
+    copied = 0
+
+    for name in ("copy_file_range", "sendfile"):
+        if not hasattr(os, name):
+            continue
+
+        try:
+            while copied < size:
+                count = min(size - copied, COPY_CHUNK_SIZE)
+                if name == "copy_file_range":
+                    sent = os.copy_file_range(fsrc, fdst, count)  # type: ignore
+                else:
+                    sent = os.sendfile(fdst, fsrc, None, count)  # type: ignore
+                if not sent:
+                    break
+                copied += sent
+        except OSError as err:
+            # Try the next way only if nothing was copied by the previous one.
+            if copied or err.errno not in COPY_FALLBACK_ERRORS:
+                raise
+        else:
+            return None
+
+    # Copy the data through the user space buffers if the kernel can't do it by itself.
+    while True:
+        chunk = os.read(fsrc, COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(fdst, view) :]  # noqa
+
+    return None
+
+
+def _get_state(info: os.stat_result) -> Tuple[int, int]:
+    return info.st_size, info.st_mtime_ns
+
+
+def _same_content(src: str, dst: str, info: os.stat_result) -> bool:
+    import filecmp  # pylint: disable=import-outside-toplevel
+
+    if stat.S_ISLNK(info.st_mode):
+        return os.path.islink(dst) and os.readlink(src) == os.readlink(dst)
+
+    return stat.S_ISREG(info.st_mode) and filecmp.cmp(src, dst, shallow=False)
+
+
+def _copy(src: str, dst: str) -> None:
+    info = os.stat(src, follow_symlinks=False)
+
+    try:
+        done = os.stat(dst, follow_symlinks=False)
+    except FileNotFoundError:
+        pass
+    else:
+        # The item copied by the previous interrupted run is kept only if it has the same content,
+        # the other item with this path is replaced like by the rename.
+        if _get_state(done) == _get_state(info) and _same_content(src, dst, info):
+            return None
+
+    partial = dst + PARTIAL_SUFFIX
+    if os.path.lexists(partial):
+        os.remove(partial)
+
+    if stat.S_ISLNK(info.st_mode):
+        os.symlink(os.readlink(src), partial)
+    elif stat.S_ISREG(info.st_mode):
+        with open(src, mode="rb") as stream_in, open(partial, mode="wb") as stream_out:
+            _copy_data(stream_in.fileno(), stream_out.fileno(), info.st_size)
+    else:
+        raise OSError(errno.EXDEV, "The special file can't be copied to another file system.", src)
+
+    # Keep the permissions, the owner and the timestamps of the origin.
+    shutil.copystat(src, partial, follow_symlinks=False)
+    try:
+        os.chown(partial, info.st_uid, info.st_gid, follow_symlinks=False)
+    except PermissionError:
+        logger.debug("Can't keep the owner of the item '%s' on the current machine.", src)
+
+    # Verify the copy before the origin is removed, the origin might be changed while it's copied.
+    copied = os.stat(partial, follow_symlinks=False)
+    if stat.S_ISREG(info.st_mode) and not (
+        _get_state(copied) == _get_state(info) == _get_state(os.stat(src, follow_symlinks=False))
+    ):
+        os.remove(partial)
+        raise OSError(errno.EIO, "The copied item doesn't match its origin.", src)
+
+    os.replace(partial, dst)
+    return None
+
+
+def parallel(func: Callable[..., Any], tasks: Iterable[Tuple[Any, ...]], workers: int) -> None:
+    if workers <= 1:
+        for task in tasks:
+            func(*task)
+        return None
+
+    # Load the thread pool only when the work is actually shared between the workers.
+    import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = set()
+        for task in tasks:
+            futures.add(executor.submit(func, *task))
+
+            # Keep a bounded number of pending tasks, so huge trees don't take all memory.
+            if len(futures) >= workers * 4:
+                done, futures = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    return None
+
+
 def mv(src: str, dst: str, dry_run: bool = False) -> None:
     try:
         if not dry_run or not os.path.exists(src):
-            os.rename(src, dst)
+            try:
+                os.rename(src, dst)
+            except OSError as err:
+                if err.errno != errno.EXDEV:
+                    raise
+
+                # The destination is on another file system, so copy the item and remove its origin.
+                _copy(src, dst)
+                os.remove(src)
     except OSError as err:
         logger.error("Can't move the determined item to the destination path.")
         logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
@@ -94,28 +435,242 @@ def mv(src: str, dst: str, dry_run: bool = False) -> None:
         logger.info("Item '%s' was moved to '%s' as the destination path.", src, dst)
 
 
-def mvdir(src: str, dst: str, dry_run: bool = False) -> None:
+def mvdir(src: str, dst: str, dry_run: bool = False, workers: int = WORKERS) -> None:
+    # The items are copied in parallel only if they can't be renamed.
+    cross_device = False
+
+    if not dry_run:
+        try:
+            # Move the whole directory at once if both paths are on the same file system.
+            os.rename(src, dst)
+        except OSError as err:
+            # Only the directory on another file system or the existing destination is merged by
+            # its items, the missing or locked source isn't moved at all.
+            if err.errno not in (errno.EXDEV, errno.EEXIST, errno.ENOTEMPTY):
+                logger.error("Can't move the determined item to the destination path.")
+                logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+                # Stop this program runtime and return the exit status code.
+                sys.exit(err.errno or errno.EPERM)
+
+            logger.debug("Can't rename the determined directory, moving its items one by one.")
+            cross_device = err.errno == errno.EXDEV
+        else:
+            logger.info("Directory '%s' was moved to '%s' as a destination path.", src, dst)
+            return None
+
+    if not dry_run:
+        # Create a destination directory on the current machine.
+        mkdir(dst)
+        dirs_to_copy = [(src, dst)]
+
+        def get_tasks() -> Iterable[Tuple[str, str]]:
+            for entry in scantree(src):
+                path = os.path.join(dst, os.path.relpath(entry.path, src))
+
+                # Step — 1.
+                if entry.is_dir(follow_symlinks=False):
+                    mkdir(path, dry_run)
+                    dirs_to_copy.append((entry.path, path))
+                # Step — 2.
+                else:
+                    yield entry.path, path
+
+        try:
+            parallel(mv, get_tasks(), workers if cross_device else 1)
+        except OSError as err:
+            logger.error("The determined path don't exist on the current machine.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+            # Stop this program runtime and return the exit status code.
+            sys.exit(getattr(err, "errno", errno.EPERM))
+
+        # Keep the permissions and the timestamps of the copied directories.
+        if cross_device:
+            for path, copy in reversed(dirs_to_copy):
+                try:
+                    shutil.copystat(path, copy)
+                except OSError:
+                    logger.debug("Can't keep the metadata of the directory '%s'.", path)
+
+        # Remove determined directory from the current machine.
+        rmdir(src, dry_run)
+    logger.info("Directory '%s' was moved to '%s' as a destination path.", src, dst)
+    return None
+
+
+def stage(path: str, staging: str) -> Optional[str]:
+    import uuid  # pylint: disable=import-outside-toplevel
+
+    abspath = os.path.join(staging, uuid.uuid4().hex)
+
     try:
-        content = os.walk(src, topdown=False)
+        os.makedirs(staging, exist_ok=True)
+        # Hide the item at once, its content is removed later.
+        os.rename(path, abspath)
     except OSError as err:
-        logger.error("The determined path don't exist on the current machine.")
+        if err.errno == errno.EXDEV:
+            # The staging directory is on another file system, so the item can't be renamed there.
+            return None
+
+        logger.error("The determined path can't be removed from the current machine.")
         logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
         # Stop this program runtime and return the exit status code.
         sys.exit(getattr(err, "errno", errno.EPERM))
 
-    if not dry_run:
-        for top, dirs, nondirs in content:
-            # Create a destination directory on the current machine.
-            mkdir(dst)
+    logger.info("Item '%s' was staged to be removed from the current machine.", path)
+    return abspath
 
-            # Step — 1.
-            for name in dirs:
-                mkdir(os.path.join(dst, name), dry_run)
 
-            # Step — 2.
-            for name in nondirs:
-                mv(os.path.join(top, name), os.path.join(dst, name), dry_run)
+def purge(staging: str, workers: int = WORKERS) -> None:
+    try:
+        lock = os.open(os.path.join(staging, STAGING_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        logger.debug("There are no staged items on the current machine.", exc_info=True)
+        return None
 
-        # Remove determined directory from the current machine.
-        rmdir(src, dry_run)
-    logger.info("Directory '%s' was moved to '%s' as a destination path.", src, dst)
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another process is already removing the staged items.
+            return None
+
+        # The items left by the interrupted process are removed the same way.
+        for entry in scantree(staging, descend=lambda entry: False):
+            if entry.name == STAGING_LOCK:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                rmdir(entry.path, workers=workers)
+            else:
+                rm(entry.path)
+    finally:
+        os.close(lock)
+
+    return None
+
+
+def purge_in_background(staging: str, workers: int = WORKERS) -> None:
+    import subprocess  # pylint: disable=import-outside-toplevel
+
+    code = "import sys; from myrm import rmlib; rmlib.purge(sys.argv[1], int(sys.argv[2]))"
+
+    try:
+        # Detach the process, so it keeps removing the items after this program is stopped.
+        subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, "-c", code, staging, str(workers)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError:
+        logger.warning("The staged items will be removed by the next run of this program.")
+        logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+
+
+def hash_file(path: str) -> Optional[str]:
+    import hashlib  # pylint: disable=import-outside-toplevel
+
+    digest = hashlib.sha256()
+    try:
+        with io.open(path, mode="rb") as stream_in:
+            # Read the content by chunks, so the large files aren't loaded into memory.
+            for chunk in iter(lambda: stream_in.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    except OSError:
+        logger.debug("The content of the item '%s' can't be read.", path, exc_info=True)
+        return None
+
+    return digest.hexdigest()
+
+
+def hash_files(paths: Iterable[str], workers: int = WORKERS) -> Dict[str, str]:
+    digests = {}
+
+    def run(path: str) -> None:
+        digest = hash_file(path)
+        if digest is not None:
+            digests[path] = digest
+
+    # The digest is calculated without the global lock, so the files are read in parallel.
+    parallel(run, ((path,) for path in paths), workers)
+    return digests
+
+
+def detach(path: str) -> None:
+    copy = path + DETACHED_SUFFIX
+
+    try:
+        # Give the file its own content, so its changes don't reach the other links to it.
+        _copy(path, copy)
+        os.replace(copy, path)
+    except OSError as err:
+        with contextlib.suppress(OSError):
+            os.remove(copy)
+        logger.error("Can't move the determined item to the destination path.")
+        logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+        # Stop this program runtime and return the exit status code.
+        sys.exit(getattr(err, "errno", errno.EPERM))
+
+
+def pack(src: str, dst: str, dry_run: bool = False) -> Optional[int]:
+    import tarfile  # pylint: disable=import-outside-toplevel
+
+    if dry_run:
+        logger.info("Item '%s' was compressed to '%s' as the destination path.", src, dst)
+        return None
+
+    partial = dst + PARTIAL_SUFFIX
+    try:
+        # The content is streamed through the compressor, so the large items aren't loaded at once.
+        with tarfile.open(partial, mode="w:xz", preset=ARCHIVE_PRESET) as archive:  # type: ignore
+            archive.add(src, arcname=os.path.basename(src))
+        os.replace(partial, dst)
+        size = os.lstat(dst).st_size
+    except (OSError, tarfile.TarError):
+        # The item is kept as it is and compressed by the next run of this program.
+        logger.debug("Can't compress the item '%s'.", src, exc_info=True)
+        with contextlib.suppress(OSError):
+            os.remove(partial)
+        return None
+
+    logger.info("Item '%s' was compressed to '%s' as the destination path.", src, dst)
+    return size
+
+
+def unpack(src: str, dst: str, dry_run: bool = False) -> None:
+    import tarfile  # pylint: disable=import-outside-toplevel
+
+    if dry_run:
+        logger.info("Item '%s' was extracted to '%s' as the destination path.", src, dst)
+        return None
+
+    # Extract the item next to its destination, so it appears there at once.
+    partial = dst + PARTIAL_SUFFIX
+    # The newer versions of Python refuse the members which point outside the destination.
+    options = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+    try:
+        with tarfile.open(src, mode="r:xz") as archive:
+            member = archive.next()
+            if member is None:
+                raise OSError(errno.EIO, "The archive doesn't contain any item.", src)
+
+            os.makedirs(partial, exist_ok=True)
+            archive.extractall(partial, **options)  # type: ignore
+            if options:
+                # The filter drops the special bits of the modes, the items of the bucket keep them.
+                # The directories are changed last and the inner ones first, so all stay reachable.
+                for item in sorted(reversed(archive.getmembers()), key=tarfile.TarInfo.isdir):
+                    if not item.issym() and not item.islnk():
+                        os.chmod(os.path.join(partial, item.name), item.mode)
+        os.rename(os.path.join(partial, member.name), dst)
+        os.rmdir(partial)
+    except (OSError, tarfile.TarError) as err:
+        with contextlib.suppress(OSError):
+            shutil.rmtree(partial)
+        logger.error("Can't move the determined item to the destination path.")
+        logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
+        # Stop this program runtime and return the exit status code.
+        sys.exit(getattr(err, "errno", errno.EIO))
+
+    logger.info("Item '%s' was extracted to '%s' as the destination path.", src, dst)
+    return None
@@ -4,7 +4,7 @@ import json
 import logging
 import os
 import sys
-from typing import Any, Dict, Union
+from typing import Any, Dict, Tuple, Union
 
 from . import rmlib
 
@@ -23,6 +23,12 @@ __all__ = (
     "DEFAULT_BUCKET_SIZE",
     "DEFAULT_STORETIME",
     "DEFAULT_TIME_FORMAT",
+    "DEFAULT_WORKERS",
+    "DEFAULT_DEDUP",
+    "DEFAULT_COMPRESS_AFTER",
+    "EVICTION_POLICIES",
+    "DEFAULT_EVICTION",
+    "DEFAULT_PER_DEVICE",
     "ValidationError",
     "AppSettings",
     "generate",
@@ -48,6 +54,15 @@ BYTES_IN_MEGABYTES: int = 1024 * 1024
 DEFAULT_BUCKET_SIZE: int = 100 * BYTES_IN_MEGABYTES
 DEFAULT_STORETIME: int = 20 * SECONDS_IN_DAY
 DEFAULT_TIME_FORMAT: str = "%Y-%m-%d %I:%M:%S %p"
+DEFAULT_WORKERS: int = rmlib.WORKERS
+DEFAULT_DEDUP: bool = False
+# The items aren't compressed unless the age is determined.
+DEFAULT_COMPRESS_AFTER: int = 0
+# The order in which the items are evicted when the bucket is full, nothing is evicted by default.
+EVICTION_POLICIES: Tuple[str, ...] = ("none", "oldest", "largest", "score")
+DEFAULT_EVICTION: str = "none"
+# The items of the other file systems are moved to the single bucket unless it's enabled.
+DEFAULT_PER_DEVICE: bool = False
 
 
 class ValidationError(ValueError):
@@ -101,11 +116,33 @@ class BoolField:
         self.flag = flag
 
 
+class ChoiceField:
+    def __init__(self, choices: Tuple[str, ...]) -> None:
+        self.choices = choices
+        self.choice = choices[0]
+
+    def __get__(self, instance: Any, owner: Any) -> str:
+        return self.choice
+
+    def __set__(self, instance: Any, choice: str) -> None:
+        if choice not in self.choices:
+            raise ValidationError(
+                f"The field must be one of {', '.join(self.choices)} but received: {choice!r}."
+            )
+
+        self.choice = choice
+
+
 class AppSettings:
     bucket_path = PathField()
     bucket_history_path = PathField()
     bucket_size = PositiveIntegerField()
     bucket_timeout_cleanup = PositiveIntegerField()
+    workers = PositiveIntegerField()
+    bucket_dedup = BoolField()
+    bucket_compress_after = PositiveIntegerField()
+    bucket_eviction = ChoiceField(EVICTION_POLICIES)
+    bucket_per_device = BoolField()
 
     def __init__(
         self,
@@ -113,12 +150,22 @@ class AppSettings:
         bucket_history_path: str = DEFAULT_HISTORY_PATH,
         bucket_size: int = DEFAULT_BUCKET_SIZE,
         bucket_timeout_cleanup: int = DEFAULT_STORETIME,
+        workers: int = DEFAULT_WORKERS,
+        bucket_dedup: bool = DEFAULT_DEDUP,
+        bucket_compress_after: int = DEFAULT_COMPRESS_AFTER,
+        bucket_eviction: str = DEFAULT_EVICTION,
+        bucket_per_device: bool = DEFAULT_PER_DEVICE,
     ) -> None:
         try:
             self.bucket_path = bucket_path
             self.bucket_history_path = bucket_history_path
             self.bucket_size = bucket_size
             self.bucket_timeout_cleanup = bucket_timeout_cleanup
+            self.workers = workers
+            self.bucket_dedup = bucket_dedup
+            self.bucket_compress_after = bucket_compress_after
+            self.bucket_eviction = bucket_eviction
+            self.bucket_per_device = bucket_per_device
         except ValidationError as err:
             logger.error("The validation process was failed: %s", err)
             logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
@@ -128,12 +175,17 @@ class AppSettings:
     def __str__(self) -> str:
         return json.dumps(self.dump(), indent=2)
 
-    def dump(self) -> Dict[str, Union[str, int]]:
+    def dump(self) -> Dict[str, Union[str, int, bool]]:
         return {
             "bucket_path": self.bucket_path,
             "bucket_history_path": self.bucket_history_path,
             "bucket_size": self.bucket_size,
             "bucket_timeout_cleanup": self.bucket_timeout_cleanup,
+            "workers": self.workers,
+            "bucket_dedup": self.bucket_dedup,
+            "bucket_compress_after": self.bucket_compress_after,
+            "bucket_eviction": self.bucket_eviction,
+            "bucket_per_device": self.bucket_per_device,
         }
 
 
@@ -0,0 +1,299 @@
+import collections
+import contextlib
+import functools
+import io
+import json
+import logging
+import os
+import threading
+import time
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import bucket, rmlib
+
+# Create a new instance of the preferred reporting system for this program.
+logger = logging.getLogger("myrm")
+
+__all__ = (
+    "Stats",
+    "collect",
+    "count_syscalls",
+    "profile",
+)
+
+
+# The phases of this program which are measured as a whole.
+PHASES: Tuple[Tuple[type, Tuple[str, ...]], ...] = (
+    (
+        bucket.Bucket,
+        (
+            "startup",
+            "shutdown",
+            "check",
+            "timeout_cleanup",
+            "reconcile",
+            "cleanup",
+            "compress",
+            "evict",
+            "rm",
+            "restore",
+            "restore_many",
+            "_get_size",
+            "_mv",
+            "_rm",
+        ),
+    ),
+    (bucket.BucketHistory, ("_read", "_write", "_append", "_commit", "show", "export")),
+    (bucket.SQLiteBucketHistory, ("_read", "_write", "_commit", "get_entries")),
+)
+
+# The primitives which change the file system.
+PRIMITIVES = ("rm", "rmdir", "mkdir", "mv", "mvdir", "stage", "purge")
+
+# The functions of the os module which make a single system call each.
+SYSCALLS = (
+    "close",
+    "fsync",
+    "link",
+    "listdir",
+    "lstat",
+    "mkdir",
+    "open",
+    "remove",
+    "rename",
+    "replace",
+    "rmdir",
+    "scandir",
+    "stat",
+    "unlink",
+    "utime",
+)
+
+
+def _count(name: str, func: Callable[..., Any], account: Callable[[str], None]) -> Any:
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        account(name)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def count_syscalls(account: Callable[[str], None]) -> Iterator[None]:
+    # Every system call is passed to the callback by its name, the opened files as well.
+    originals = [(os, name, getattr(os, name)) for name in SYSCALLS if hasattr(os, name)]
+    originals.append((io, "open", io.open))
+    for owner, name, func in originals:
+        setattr(owner, name, _count(name, func, account))
+
+    try:
+        yield None
+    finally:
+        for owner, name, func in reversed(originals):
+            setattr(owner, name, func)
+
+
+class Record:
+    __slots__ = ("calls", "seconds", "written", "syscalls")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0
+        self.written = 0
+        self.syscalls: Dict[str, int] = collections.Counter()
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "written": self.written,
+            "syscalls": dict(self.syscalls),
+        }
+
+
+class CountingStream:
+    def __init__(self, stream: IO[Any], stats: "Stats") -> None:
+        self.stream = stream
+        self.stats = stats
+
+    def __enter__(self) -> "CountingStream":
+        self.stream.__enter__()
+        return self
+
+    def __exit__(self, *args: Any) -> Any:
+        return self.stream.__exit__(*args)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.stream, name)
+
+    def write(self, data: Any) -> int:
+        self.stats.account_written(len(data))
+        return self.stream.write(data)
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.records: Dict[str, Record] = collections.defaultdict(Record)
+        # Every thread measures its own phases, the one which enabled the measurements as well.
+        self.local = threading.local()
+        self.stack: List[Record] = []
+        self.patches: List[Tuple[Any, str, Any]] = []
+        self.counting = contextlib.ExitStack()
+        self.lock = threading.Lock()
+        self.start = 0.0
+
+    def _patch(self, owner: Any, name: str, wrapper: Callable[..., Any]) -> None:
+        self.patches.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, wrapper)
+
+    def _get_stack(self) -> List[Record]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+
+        return self.local.stack
+
+    def _get_active(self) -> Iterable[Record]:
+        # The worker threads account their calls to the phases of the main thread too.
+        stack = self._get_stack()
+        return stack if stack is self.stack else dict.fromkeys(self.stack + stack)
+
+    def _measure(self, name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        record = self.records[name]
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            stack = self._get_stack()
+            with self.lock:
+                record.calls += 1
+                # The recursive calls are measured once by the outermost one of the same thread.
+                nested = record in stack
+                if not nested:
+                    stack.append(record)
+            if nested:
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                with self.lock:
+                    record.seconds += seconds
+                    stack.pop()
+
+        return wrapper
+
+    def _open(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def wrapper(file: Any, mode: str = "r", *args: Any, **kwargs: Any) -> Any:
+            stream = func(file, mode, *args, **kwargs)
+            if any(char in mode for char in "wax+"):
+                return CountingStream(stream, self)
+            return stream
+
+        return wrapper
+
+    def account_syscall(self, name: str) -> None:
+        with self.lock:
+            for record in self._get_active():
+                record.syscalls[name] += 1
+
+    def account_written(self, size: int) -> None:
+        with self.lock:
+            for record in self._get_active():
+                record.written += size
+
+    def enable(self) -> None:
+        # Nothing is wrapped until the measurements are requested, so they cost nothing otherwise.
+        for owner, names in PHASES:
+            for name in names:
+                if name in vars(owner):
+                    wrapper = self._measure(f"{owner.__name__}.{name}", vars(owner)[name])
+                    self._patch(owner, name, wrapper)
+
+        for name in PRIMITIVES:
+            self._patch(rmlib, name, self._measure(f"rmlib.{name}", getattr(rmlib, name)))
+
+        self.counting.enter_context(count_syscalls(self.account_syscall))
+        self._patch(io, "open", self._open(io.open))
+
+        self.local.stack = self.stack
+        self.stack.append(self.records["total"])
+        self.records["total"].calls += 1
+        self.start = time.perf_counter()
+
+    def disable(self) -> None:
+        self.records["total"].seconds += time.perf_counter() - self.start
+        self.stack.clear()
+
+        while self.patches:
+            owner, name, value = self.patches.pop()
+            setattr(owner, name, value)
+        self.counting.close()
+
+    def dump(self) -> Dict[str, Any]:
+        return {name: record.dump() for name, record in self.records.items() if record.calls}
+
+    def write(self, stream: IO[str], fmt: str = "table") -> None:
+        records = self.dump()
+        if fmt == "json":
+            stream.write(json.dumps(records, indent=2) + "\n")
+            return None
+
+        from tabulate import tabulate  # pylint: disable=import-outside-toplevel
+
+        syscalls = sorted({name for record in records.values() for name in record["syscalls"]})
+        header = ("Phase", "Calls", "Seconds", "Written", *syscalls)
+        rows = [
+            [
+                name,
+                record["calls"],
+                f"{record['seconds']:.6f}",
+                record["written"],
+                *(record["syscalls"].get(syscall, 0) for syscall in syscalls),
+            ]
+            for name, record in sorted(records.items(), key=lambda item: -item[1]["seconds"])
+        ]
+        stream.write(tabulate(rows, headers=header) + "\n")
+        return None
+
+
+@contextlib.contextmanager
+def collect(stream: IO[str], fmt: str = "table") -> Iterator[Stats]:
+    stats = Stats()
+    stats.enable()
+    try:
+        yield stats
+    finally:
+        stats.disable()
+        stats.write(stream, fmt)
+
+
+@contextlib.contextmanager
+def profile(path: str, memory: bool = False) -> Iterator[None]:
+    import cProfile  # pylint: disable=import-outside-toplevel
+    import tracemalloc  # pylint: disable=import-outside-toplevel
+
+    profiler = cProfile.Profile()
+    if memory:
+        tracemalloc.start()
+    profiler.enable()
+
+    try:
+        yield None
+    finally:
+        profiler.disable()
+        snapshot: Optional[tracemalloc.Snapshot] = None
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        try:
+            profiler.dump_stats(path)
+            if snapshot is not None:
+                snapshot.dump(path + ".tracemalloc")
+        except OSError:
+            # The result of the command is more important than its profile.
+            logger.warning("It's impossible to save the profile on the current machine.")
+            logger.debug("An unexpected error occurred at this program runtime:", exc_info=True)
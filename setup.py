@@ -26,7 +26,7 @@ setup(
     install_requires=["tabulate>=0.8.1,<1.0.0"],
     python_requires=">=3.6",
     setup_requires=["setuptools", "wheel"],
-    packages=find_packages(exclude=["tests"]),
+    packages=find_packages(exclude=["benchmarks", "tests"]),
     classifiers=[
         "Intended Audience :: Developers",
         "Intended Audience :: System Administrators",
@@ -32,6 +32,11 @@ def fake_bucket_history(fs):
     return bucket.BucketHistory(path="history.pkl")
 
 
+@pytest.fixture()
+def fake_sqlite_history(tmp_path):
+    return bucket.SQLiteBucketHistory(path=str(tmp_path / "history.db"))
+
+
 @pytest.fixture()
 def fake_entry():
     return bucket.Entry(
@@ -70,3 +75,11 @@ def fake_bool_field():
         test = settings.BoolField()
 
     return A()
+
+
+@pytest.fixture()
+def fake_choice_field():
+    class A:
+        test = settings.ChoiceField(("a", "b"))
+
+    return A()
@@ -0,0 +1,31 @@
+import argparse
+import json
+
+import pytest
+
+from benchmarks import generate, run
+
+
+@pytest.mark.parametrize("shape", generate.SHAPES)
+def test_make_tree(tmp_path, shape):
+    root = generate.make_tree(str(tmp_path / "tree"), shape, 300)
+
+    assert sum(1 for _ in run.rmlib.scantree(root)) >= 256
+
+
+@pytest.mark.parametrize("history", ["pkl", "db"])
+def test_run(tmp_path, history):
+    arguments = argparse.Namespace(
+        sizes=[20],
+        benchmarks=list(run.BENCHMARKS),
+        shapes=["wide"],
+        history=history,
+        workers=2,
+        dir=str(tmp_path),
+    )
+    results = run.run(arguments)
+
+    assert [result["benchmark"] for result in results["results"]] == list(run.BENCHMARKS)
+    assert results["results"][0]["syscalls"]["rename"] == 1
+    assert not list(tmp_path.iterdir())
+    assert list(run.compare(results, json.loads(json.dumps(results))))
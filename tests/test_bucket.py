@@ -1,11 +1,20 @@
+import contextlib
+import csv
 import errno
+import heapq
 import io
+import json
 import os
 import pickle
+import random
+import sqlite3
+import stat
+import sys
+import time
 
 import pytest
 
-from myrm import bucket
+from myrm import bucket, settings
 
 
 def test_read_bucket_history_with_error(mocker, fake_bucket_history):
@@ -36,21 +45,117 @@ def test_write_bucket_history_with_error(mocker, fake_bucket_history):
     )
 
 
-def test_bucket_history_read(fs):
+def test_bucket_history_read(fs, fake_entry):
     path = "test.pkl"
-    data = {1: "a", 2: "b"}
+    data = {"a": fake_entry, "b": fake_entry._replace(index=3)}
     with io.open(path, mode="wb") as stream_out:
         pickle.dump(data, stream_out, protocol=pickle.HIGHEST_PROTOCOL)
 
-    assert bucket.BucketHistory(path=path) == data
+    history = bucket.BucketHistory(path=path)
+    assert history == data
+    assert history.get_key(3) == "b"
+    assert history.get_next_index() == 4
 
 
-def test_bucket_history_write(fake_bucket_history):
-    data = {1: "a", 2: "b"}
+def test_bucket_history_write(fake_bucket_history, fake_entry):
+    data = {"a": fake_entry, "b": fake_entry._replace(index=3)}
     fake_bucket_history.update(data)
 
+    assert bucket.BucketHistory(path=fake_bucket_history.path) == data
+
+
+def test_bucket_history_write_journal(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry
+
+    assert not os.path.exists(fake_bucket_history.path)
+    assert os.path.isfile(fake_bucket_history.journal_path)
+    assert fake_bucket_history.journal_records == 1
+
+
+def test_bucket_history_write_compaction(fake_bucket_history, fake_entry, mocker):
+    mocker.patch("myrm.bucket.JOURNAL_THRESHOLD", 2)
+
+    for index in range(3):
+        fake_bucket_history[str(index)] = fake_entry._replace(index=index)
+
+    assert not os.path.exists(fake_bucket_history.journal_path)
+    assert fake_bucket_history.journal_records == 0
+
     with io.open(fake_bucket_history.path, mode="rb") as stream_in:
-        assert pickle.load(stream_in) == data
+        assert pickle.load(stream_in) == (
+            bucket.SNAPSHOT_VERSION,
+            {"data": fake_bucket_history, "counter": 2, "expiry": []},
+        )
+
+
+def test_bucket_history_read_journal(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry
+    fake_bucket_history["other"] = fake_entry
+    del fake_bucket_history["test"]
+
+    history = bucket.BucketHistory(path=fake_bucket_history.path)
+    assert history == {"other": fake_entry}
+    assert history.journal_records == 3
+
+
+def test_bucket_history_read_torn_journal(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry
+
+    with io.open(fake_bucket_history.journal_path, mode="ab") as stream_out:
+        stream_out.write(pickle.dumps((bucket.JOURNAL_SET, "other", fake_entry))[:-3])
+
+    history = bucket.BucketHistory(path=fake_bucket_history.path)
+    assert history == {"test": fake_entry}
+
+    history["other"] = fake_entry
+    assert bucket.BucketHistory(path=fake_bucket_history.path) == history
+
+
+def test_bucket_history_transaction(fake_bucket_history, fake_entry, mocker):
+    fsync_mock = mocker.patch("myrm.bucket.os.fsync")
+
+    with fake_bucket_history.transaction():
+        fake_bucket_history["test"] = fake_entry
+        fake_bucket_history["other"] = fake_entry
+
+        with fake_bucket_history.transaction():
+            del fake_bucket_history["test"]
+
+        assert not os.path.exists(fake_bucket_history.journal_path)
+
+    fsync_mock.assert_called_once()
+    assert bucket.BucketHistory(path=fake_bucket_history.path) == {"other": fake_entry}
+
+
+def test_bucket_history_transaction_rollback(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry
+
+    with pytest.raises(ValueError):
+        with fake_bucket_history.transaction():
+            fake_bucket_history["test"] = fake_entry._replace(index=3)
+            fake_bucket_history["other"] = fake_entry
+            del fake_bucket_history["test"]
+            raise ValueError()
+
+    assert fake_bucket_history == {"test": fake_entry}
+    assert bucket.BucketHistory(path=fake_bucket_history.path) == {"test": fake_entry}
+
+
+def test_bucket_history_transaction_exit(fake_bucket_history, fake_entry):
+    with pytest.raises(SystemExit):
+        with fake_bucket_history.transaction():
+            fake_bucket_history["test"] = fake_entry
+            sys.exit(errno.EPERM)
+
+    assert bucket.BucketHistory(path=fake_bucket_history.path) == {"test": fake_entry}
+
+
+def test_bucket_history_transaction_cleanup(fake_bucket_history, fake_entry):
+    with fake_bucket_history.transaction():
+        fake_bucket_history["test"] = fake_entry
+        fake_bucket_history.cleanup()
+
+    assert bucket.BucketHistory(path=fake_bucket_history.path) == {}
 
 
 def test_bucket_history_delete_item(fake_bucket_history, fake_entry):
@@ -74,14 +179,74 @@ def test_bucket_history_get_next_index(fake_bucket_history, fake_entry):
     assert fake_bucket_history.get_next_index() == 3
 
 
+def test_bucket_history_get_next_index_after_delete(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry
+    del fake_bucket_history["test"]
+
+    assert fake_bucket_history.get_next_index() == 3
+    assert bucket.BucketHistory(path=fake_bucket_history.path).get_next_index() == 3
+
+    fake_bucket_history._write()
+    assert bucket.BucketHistory(path=fake_bucket_history.path).get_next_index() == 3
+
+
+def test_bucket_history_get_size(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry._replace(size=10)
+    fake_bucket_history["other"] = fake_entry._replace(index=3, size=5)
+    assert fake_bucket_history.get_size() == 15
+
+    fake_bucket_history["test"] = fake_entry._replace(size=1)
+    del fake_bucket_history["other"]
+    assert fake_bucket_history.get_size() == 1
+    assert bucket.BucketHistory(path=fake_bucket_history.path).get_size() == 1
+
+    fake_bucket_history.cleanup()
+    assert fake_bucket_history.get_size() == 0
+
+
+def test_bucket_history_get_size_unknown(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry._replace(size=10)
+    fake_bucket_history["other"] = fake_entry._replace(index=3)
+
+    assert fake_bucket_history.get_size() is None
+    assert fake_bucket_history.get_unsized() == ["other"]
+
+
+def test_bucket_history_get_key(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry
+    fake_bucket_history["other"] = fake_entry._replace(index=3)
+
+    assert fake_bucket_history.get_key(3) == "other"
+
+    del fake_bucket_history["other"]
+    assert fake_bucket_history.get_key(3) is None
+    assert fake_bucket_history.get_key(2) == "test"
+
+
+def test_bucket_history_get_key_after_rollback(fake_bucket_history, fake_entry):
+    fake_bucket_history["test"] = fake_entry
+
+    with pytest.raises(ValueError):
+        with fake_bucket_history.transaction():
+            fake_bucket_history["test"] = fake_entry._replace(index=3)
+            raise ValueError()
+
+    assert fake_bucket_history.get_key(2) == "test"
+    assert fake_bucket_history.get_key(3) is None
+
+
 def test_bucket_history_cleanup(fake_bucket_history, fake_entry):
     fake_bucket_history["test"] = fake_entry
     fake_bucket_history.cleanup(dry_run=False)
 
     assert fake_bucket_history == {}
+    assert fake_bucket_history.get_next_index() == 1
 
     with io.open(fake_bucket_history.path, mode="rb") as stream_in:
-        assert pickle.load(stream_in) == {}
+        assert pickle.load(stream_in) == (
+            bucket.SNAPSHOT_VERSION,
+            {"data": {}, "counter": 0, "expiry": []},
+        )
 
 
 def test_bucket_history_cleanup_with_dry_run(fake_bucket_history, fake_entry):
@@ -89,9 +254,7 @@ def test_bucket_history_cleanup_with_dry_run(fake_bucket_history, fake_entry):
     fake_bucket_history.cleanup(dry_run=True)
 
     assert fake_bucket_history["test"] == fake_entry
-
-    with io.open(fake_bucket_history.path, mode="rb") as stream_in:
-        assert pickle.load(stream_in) == fake_bucket_history
+    assert bucket.BucketHistory(path=fake_bucket_history.path) == fake_bucket_history
 
 
 def test_bucket_history_show(fake_bucket_history, fake_entry):
@@ -120,6 +283,87 @@ def test_bucket_history_show_with_inner_error(mocker, fake_bucket_history):
     logger_mock.warning.assert_called_with("History is empty.")
 
 
+def fill_history(history, entry):
+    for index, name, size in ((3, "b", 10), (1, "c", 30), (2, "a", None), (4, "a", 20)):
+        history[str(index)] = entry._replace(index=index, name=name, size=size)
+
+
+@pytest.mark.parametrize(
+    "sort, reverse, after, indexes",
+    [
+        ("index", False, None, [1, 2, 3, 4]),
+        ("index", True, None, [4, 3, 2, 1]),
+        ("index", False, 2, [3, 4]),
+        ("index", True, 3, [2, 1]),
+        ("name", False, None, [2, 4, 3, 1]),
+        ("name", False, 4, [3, 1]),
+        ("size", True, 3, [2]),
+    ],
+)
+@pytest.mark.parametrize("history", ["fake_bucket_history", "fake_sqlite_history"])
+def test_bucket_history_get_entries(request, fake_entry, history, sort, reverse, after, indexes):
+    history = request.getfixturevalue(history)
+    fill_history(history, fake_entry)
+
+    entries = history.get_entries(after=after, sort=sort, reverse=reverse)
+    assert [entry.index for entry in entries] == indexes
+    entries = history.get_entries(1, 1, after=after, sort=sort, reverse=reverse)
+    assert [entry.index for entry in entries] == indexes[1:2]
+
+
+def test_bucket_history_get_entries_after_restored(fake_bucket_history, fake_entry, mocker):
+    fill_history(fake_bucket_history, fake_entry)
+    del fake_bucket_history["2"]
+    logger_mock = mocker.patch("myrm.bucket.logger")
+
+    assert [entry.index for entry in fake_bucket_history.get_entries(after=2)] == [3, 4]
+    with pytest.raises(SystemExit) as exit_info:
+        list(fake_bucket_history.get_entries(after=2, sort="name"))
+
+    assert exit_info.value.code == errno.EPERM
+    logger_mock.error.assert_called_with("The determined index don't exist in history.")
+
+
+def test_bucket_history_show_after(fake_bucket_history, fake_entry):
+    fill_history(fake_bucket_history, fake_entry)
+
+    assert fake_bucket_history.show(1, after=3).splitlines()[-1].split()[1] == "4"
+
+
+@pytest.mark.parametrize(
+    "fmt, load",
+    [
+        ("jsonl", lambda text: [json.loads(line) for line in text.splitlines()]),
+        ("json", json.loads),
+        ("csv", lambda text: list(csv.DictReader(io.StringIO(text)))),
+    ],
+)
+def test_write_entries(fake_entry, fmt, load):
+    stream = io.StringIO()
+    bucket.write_entries([fake_entry._replace(timestamp=10.5)] * 2, stream, fmt)
+
+    records = load(stream.getvalue())
+    assert len(records) == 2
+    assert str(records[0]["index"]) == "2"
+    assert str(records[0]["timestamp"]) == "10.5"
+
+
+def test_bucket_history_export(fake_sqlite_history, fake_entry):
+    fill_history(fake_sqlite_history, fake_entry)
+    stream = io.StringIO()
+
+    fake_sqlite_history.export(stream, "json", count=2, page=2, sort="name")
+
+    assert [record["index"] for record in json.loads(stream.getvalue())] == [3, 1]
+
+
+def test_bucket_history_export_empty(fake_bucket_history):
+    stream = io.StringIO()
+    fake_bucket_history.export(stream, "json", after=10)
+
+    assert json.loads(stream.getvalue()) == []
+
+
 def test_bucket_create(fake_bucket):
     fake_bucket.create(dry_run=False)
     assert os.path.isdir(fake_bucket.path)
@@ -130,13 +374,15 @@ def test_bucket_create_with_dry_run(fake_bucket):
     assert not os.path.exists(fake_bucket.path)
 
 
-def test_bucket_get_size_with_error(mocker, fake_bucket):
-    walk_mock = mocker.patch("myrm.bucket.os.walk")
-    walk_mock.side_effect = OSError(errno.EPERM, "")
+def test_bucket_get_size_with_error(mocker, fake_bucket, fs):
+    fs.create_dir(fake_bucket.path)
+
+    scantree_mock = mocker.patch("myrm.bucket.rmlib.scantree")
+    scantree_mock.side_effect = OSError(errno.EPERM, "")
     logger_mock = mocker.patch("myrm.bucket.logger")
 
     with pytest.raises(SystemExit) as exit_info:
-        fake_bucket._get_size("")
+        fake_bucket._get_size(fake_bucket.path)
 
     assert exit_info.value.code == errno.EPERM
     logger_mock.error.assert_called_with("The determined path don't exist on the current machine.")
@@ -146,8 +392,8 @@ def test_bucket_get_size_with_inner_error(mocker, fake_bucket, fs):
     path = "test.txt"
     fs.create_file(path)
 
-    get_mock = mocker.patch("myrm.bucket.os.path.getsize")
-    get_mock.side_effect = IOError(errno.EIO, "")
+    lstat_mock = mocker.patch("myrm.bucket.os.lstat")
+    lstat_mock.side_effect = IOError(errno.EIO, "")
     logger_mock = mocker.patch("myrm.bucket.logger")
 
     with pytest.raises(SystemExit) as exit_info:
@@ -169,6 +415,16 @@ def test_bucket_get_size_dir(fake_bucket, fs):
     assert fake_bucket._get_size(fake_bucket.path) > 0
 
 
+def test_bucket_get_size_tree(fake_bucket, fs):
+    fs.create_file(os.path.join(fake_bucket.path, "a", "b", "test.txt"), contents="test")
+    fs.create_file(os.path.join(fake_bucket.path, "a", "test.txt"), contents="te")
+    fs.create_symlink(os.path.join(fake_bucket.path, "link"), os.path.join("a", "test.txt"))
+
+    assert fake_bucket._get_size(fake_bucket.path) == 6
+    assert fake_bucket._get_size(os.path.join(fake_bucket.path, "link")) == 0
+    assert fake_bucket._get_size(os.path.join(fake_bucket.path, "missing")) == 0
+
+
 def test_bucket_cleanup(fake_bucket, fs):
     fs.create_file(os.path.join(fake_bucket.path, "test"))
     fake_bucket.cleanup(dry_run=False)
@@ -245,11 +501,12 @@ def test_bucket_mv_file(fake_bucket, fake_tree, fs):
 
     path = "test"
     fs.create_file(path)
-    fake_bucket._mv(path, dry_run=False)
+    fake_bucket._mv(path, fake_bucket._reserve(path, 0), dry_run=False)
 
     assert not os.path.exists(path)
     assert os.listdir(fake_bucket.path)
     assert list(fake_bucket.history.values())[0].name == path
+    assert list(fake_bucket.history.values())[0].status == bucket.Status.CORRECT.value
 
 
 def test_bucket_mv_file_with_dry_run(fake_bucket, fake_tree, fs):
@@ -257,11 +514,12 @@ def test_bucket_mv_file_with_dry_run(fake_bucket, fake_tree, fs):
 
     path = "test"
     fs.create_file(path)
-    fake_bucket._mv(path, dry_run=True)
+    fake_bucket._mv(path, fake_bucket._reserve(path, 0), dry_run=True)
 
     assert os.path.exists(path)
     assert not os.listdir(fake_bucket.path)
     assert list(fake_bucket.history.values())[0].name == path
+    assert list(fake_bucket.history.values())[0].status == bucket.Status.CORRECT.value
 
 
 def test_bucket_mv_dir(fake_bucket, fs):
@@ -269,11 +527,12 @@ def test_bucket_mv_dir(fake_bucket, fs):
 
     path = "test"
     fs.create_dir(path)
-    fake_bucket._mv(path, dry_run=False)
+    fake_bucket._mv(path, fake_bucket._reserve(path, 0), dry_run=False)
 
     assert not os.path.exists(path)
     assert os.listdir(fake_bucket.path)
     assert list(fake_bucket.history.values())[0].name == path
+    assert list(fake_bucket.history.values())[0].status == bucket.Status.CORRECT.value
 
 
 def test_bucket_mv_dir_with_dry_run(fake_bucket, fs):
@@ -281,11 +540,12 @@ def test_bucket_mv_dir_with_dry_run(fake_bucket, fs):
 
     path = "test"
     fs.create_dir(path)
-    fake_bucket._mv(path, dry_run=True)
+    fake_bucket._mv(path, fake_bucket._reserve(path, 0), dry_run=True)
 
     assert os.path.exists(path)
     assert not os.listdir(fake_bucket.path)
     assert list(fake_bucket.history.values())[0].name == path
+    assert list(fake_bucket.history.values())[0].status == bucket.Status.CORRECT.value
 
 
 def test_bucket_rm_force_file(fake_bucket, fs):
@@ -296,6 +556,47 @@ def test_bucket_rm_force_file(fake_bucket, fs):
     assert not os.path.exists(path)
 
 
+def test_bucket_rm_force_defer(fake_bucket, fs, mocker):
+    purge_mock = mocker.patch("myrm.bucket.rmlib.purge_in_background")
+    fs.create_file(os.path.join("dir", "test.txt"))
+    fake_bucket.rm("dir", force=True, defer=True)
+
+    assert not os.path.exists("dir")
+    assert len(os.listdir(fake_bucket.staging_path)) == 1
+
+    fake_bucket.shutdown()
+    purge_mock.assert_called_once_with(fake_bucket.staging_path, fake_bucket.workers)
+
+    fake_bucket.purge()
+    assert os.listdir(fake_bucket.staging_path) == [bucket.rmlib.STAGING_LOCK]
+
+
+def test_bucket_rm_force_defer_other_device(fake_bucket, fs, mocker):
+    mocker.patch("myrm.bucket.rmlib.stage", return_value=None)
+    fs.create_file("test")
+    fake_bucket.rm("test", force=True, defer=True)
+
+    assert not os.path.exists("test")
+    assert not fake_bucket.staged
+
+
+def test_bucket_cleanup_defer(fake_bucket, fs, fake_entry):
+    fs.create_file(os.path.join(fake_bucket.path, "test"))
+    fake_bucket.history["test"] = fake_entry
+    fake_bucket.cleanup(defer=True)
+
+    assert fake_bucket.history == {}
+    assert not os.listdir(fake_bucket.path)
+    assert fake_bucket.staged
+
+
+def test_bucket_startup_staged(fake_bucket, fs):
+    fs.create_file(os.path.join(fake_bucket.staging_path, "test"))
+    fake_bucket.startup(maintain=False)
+
+    assert fake_bucket.staged
+
+
 def test_bucket_rm_force_file_with_dry_run(fake_bucket, fs):
     path = "test"
     fs.create_file(path)
@@ -340,6 +641,46 @@ def test_bucket_rm_with_error(fake_bucket, mocker, fake_tree):
     )
 
 
+def test_bucket_rm_uses_accounted_size(fake_bucket, fs, mocker):
+    fake_bucket.create()
+    fs.create_file("test", contents="test")
+    get_size_mock = mocker.spy(fake_bucket, "_get_size")
+
+    fake_bucket.rm("test")
+
+    get_size_mock.assert_called_once_with("test")
+    assert fake_bucket.get_size() == 4
+
+
+def test_bucket_rm_reconcile(fake_bucket, fs, fake_entry, mocker):
+    fake_bucket.create()
+    fake_bucket.maxsize = 10
+    fake_bucket.history["test"] = fake_entry._replace(size=None)
+    fake_bucket.history["sized"] = fake_entry._replace(index=3, size=1)
+    fs.create_file(os.path.join(fake_bucket.path, "test"), contents="test")
+    fs.create_file(os.path.join(fake_bucket.path, "sized"), contents="test")
+    fs.create_file("other", contents="test")
+    get_size_mock = mocker.spy(fake_bucket, "_get_size")
+
+    fake_bucket.rm("other")
+
+    # Only the items which size is unknown are walked.
+    assert not os.path.exists("other")
+    assert fake_bucket.history["test"].size == 4
+    assert fake_bucket.get_size() == 9
+    assert get_size_mock.call_count == 2
+
+
+def test_bucket_get_size_reconcile(fake_bucket, fs):
+    fake_bucket.create()
+    fs.create_file(os.path.join(fake_bucket.path, "test"), contents="test")
+    fake_bucket.check()
+
+    assert fake_bucket.history.get_size() is None
+    assert fake_bucket.get_size() == 4
+    assert fake_bucket.history["test"].size == 4
+
+
 def test_bucket_check(fake_bucket, fs):
     fake_bucket.create()
 
@@ -371,46 +712,63 @@ def test_bucket_check_with_error(fake_bucket, mocker):
     logger_mock.error.assert_called_with("The determined path don't exist on the current machine.")
 
 
-def test_bucket_timeout_cleanup_with_error(fake_bucket, mocker):
-    listdir_mock = mocker.patch("myrm.bucket.os.listdir")
-    listdir_mock.side_effect = OSError(errno.EPERM, "")
-    logger_mock = mocker.patch("myrm.bucket.logger")
-
-    with pytest.raises(SystemExit) as exit_info:
-        fake_bucket.timeout_cleanup()
-
-    assert exit_info.value.code == errno.EPERM
-    logger_mock.error.assert_called_with("The determined path don't exist on the current machine.")
-
-
-def test_bucket_timeout_cleanup_with_inner_error(fake_bucket, mocker, fs):
-    fs.create_file(os.path.join(fake_bucket.path, "test"))
-
-    stat_mock = mocker.patch("myrm.bucket.time.mktime")
-    stat_mock.side_effect = OSError(errno.EPERM, "")
-    logger_mock = mocker.patch("myrm.bucket.logger")
-    fake_bucket.check()
+def test_bucket_timeout_cleanup_missing_item(fake_bucket, fake_entry):
+    fake_bucket.create()
+    fake_bucket.history["test"] = fake_entry._replace(date="2012-12-12 12:12:12 PM")
 
-    with pytest.raises(SystemExit) as exit_info:
-        fake_bucket.timeout_cleanup()
+    fake_bucket.timeout_cleanup()
 
-    assert exit_info.value.code == errno.EPERM
-    logger_mock.error.assert_called_with(
-        "It's impossible to get removed time for the determined path."
-    )
+    assert "test" not in fake_bucket.history
 
 
 def test_bucket_timeout_cleanup(fake_bucket, mocker, fs):
     path = os.path.join(fake_bucket.path, "test")
     fs.create_file(path)
     fake_bucket.storetime = 1
-    mocker.patch("myrm.bucket.time.time").return_value = 100
-    mocker.patch("myrm.bucket.time.mktime").return_value = 10
+    time_mock = mocker.patch("myrm.bucket.time.time")
 
+    time_mock.return_value = 10
     fake_bucket.check()
+    time_mock.return_value = 100
     fake_bucket.timeout_cleanup()
 
     assert not os.path.exists(path)
+    assert fake_bucket.history == {}
+
+
+def test_bucket_history_get_expired(fake_bucket_history, fake_entry, mocker):
+    strptime_mock = mocker.spy(bucket.time, "strptime")
+    fake_bucket_history["old"] = fake_entry._replace(timestamp=10)
+    fake_bucket_history["new"] = fake_entry._replace(index=3, timestamp=30)
+    fake_bucket_history["bad"] = fake_entry._replace(index=4)
+
+    assert fake_bucket_history.get_expired(20) == ["old"]
+    assert fake_bucket_history.get_expired(20) == ["old"]
+
+    # The outdated removal times are skipped.
+    fake_bucket_history["old"] = fake_entry._replace(timestamp=25)
+    fake_bucket_history["new"] = fake_entry._replace(index=3, timestamp=25)
+    assert fake_bucket_history.get_expired(20) == []
+    assert sorted(fake_bucket_history.get_expired(25)) == ["new", "old"]
+
+    del fake_bucket_history["old"]
+    assert fake_bucket_history.get_expired(40) == ["new"]
+    # Only the legacy item without the removal time was parsed.
+    assert strptime_mock.call_count == 1
+
+    history = bucket.BucketHistory(path=fake_bucket_history.path)
+    assert history.get_expired(40) == ["new"]
+
+
+def test_bucket_history_get_expired_legacy(fake_bucket_history, fake_entry):
+    date = "2012-12-12 12:12:12 PM"
+    with io.open(fake_bucket_history.path, mode="wb") as stream_out:
+        pickle.dump({"test": fake_entry._replace(date=date)}, stream_out)
+
+    history = bucket.BucketHistory(path=fake_bucket_history.path)
+
+    assert history["test"].timestamp == bucket.get_timestamp(date)
+    assert history.get_expired(time.time()) == ["test"]
 
 
 def test_bucket_restore_with_index_error(fake_bucket, mocker, fake_entry):
@@ -518,3 +876,1001 @@ def test_bucket_startup(fake_bucket):
 
     assert os.path.isdir(fake_bucket.path)
     assert fake_bucket.path not in fake_bucket.history
+
+
+def test_bucket_lazy_history(fake_bucket, mocker):
+    load_mock = mocker.spy(bucket, "load_history")
+    fake_bucket.startup(maintain=False)
+
+    load_mock.assert_not_called()
+    assert len(fake_bucket.history) == 0
+    load_mock.assert_called_once_with(fake_bucket.history_path)
+
+
+def test_bucket_startup_stamp(fake_bucket, fs, mocker):
+    check_mock = mocker.spy(fake_bucket, "check")
+    cleanup_mock = mocker.spy(fake_bucket, "timeout_cleanup")
+
+    fake_bucket.startup()
+    assert os.path.isfile(fake_bucket.stamp_path)
+    assert check_mock.call_count == 1
+    assert cleanup_mock.call_count == 1
+
+    # Nothing is due, so neither the bucket nor the history is read.
+    other = bucket.Bucket(path=fake_bucket.path, history_path=fake_bucket.history_path)
+    other.startup()
+    assert other._history is None
+
+    # The bucket was changed by hand.
+    fs.create_file(os.path.join(fake_bucket.path, "test"))
+    os.utime(fake_bucket.path, ns=(0, 0))
+    other.startup()
+    assert "test" in other.history
+
+
+def test_bucket_startup_expired(fake_bucket, mocker):
+    fake_bucket.startup()
+
+    cleanup_mock = mocker.spy(fake_bucket, "timeout_cleanup")
+    mocker.patch(
+        "myrm.bucket.time.time",
+        return_value=time.time() + bucket.MAINTENANCE_INTERVAL,
+    )
+    fake_bucket.startup()
+    cleanup_mock.assert_called_once_with()
+
+
+def test_bucket_startup_reconcile(fake_bucket, fs, fake_entry, mocker):
+    fake_bucket.startup()
+    fake_bucket.history["test"] = fake_entry._replace(size=100)
+    fs.create_file(os.path.join(fake_bucket.path, "test"), contents="test")
+    get_size_mock = mocker.spy(fake_bucket, "_get_size")
+
+    # The item changed by hand isn't walked until the maintenance is due.
+    fake_bucket.startup()
+    assert fake_bucket.get_size() == 100
+    get_size_mock.assert_not_called()
+
+    mocker.patch(
+        "myrm.bucket.time.time",
+        return_value=time.time() + bucket.MAINTENANCE_INTERVAL,
+    )
+    fake_bucket.startup()
+    assert fake_bucket.history["test"].size == 4
+    assert fake_bucket.get_size() == 4
+
+
+def test_bucket_shutdown(fake_bucket, fs, mocker):
+    fake_bucket.startup()
+
+    fs.create_file("test.txt")
+    fake_bucket.rm(os.path.abspath("test.txt"))
+    fake_bucket.shutdown()
+
+    check_mock = mocker.spy(fake_bucket, "check")
+    fake_bucket.startup()
+    check_mock.assert_not_called()
+
+
+def test_load_history():
+    assert type(bucket.load_history("history.pkl")) is bucket.BucketHistory
+
+
+def test_load_history_sqlite(tmp_path):
+    path = str(tmp_path / "history.db")
+    assert type(bucket.load_history(path)) is bucket.SQLiteBucketHistory
+
+
+def test_sqlite_bucket_history_write(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry
+    fake_sqlite_history["other"] = fake_entry._replace(index=3)
+    del fake_sqlite_history["test"]
+
+    history = bucket.SQLiteBucketHistory(path=fake_sqlite_history.path)
+    assert history == {"other": fake_entry._replace(index=3)}
+    assert "test" not in history
+    assert len(history) == 1
+
+
+def test_sqlite_bucket_history_transaction(fake_sqlite_history, fake_entry, mocker):
+    mocker.patch("myrm.bucket.LOCK_TIMEOUT", 0.1)
+    other = fake_entry._replace(index=3)
+
+    with fake_sqlite_history.transaction():
+        with fake_sqlite_history.locked():
+            fake_sqlite_history["test"] = fake_entry
+        # The database isn't locked by the batch between its locked sections.
+        bucket.SQLiteBucketHistory(path=fake_sqlite_history.path)["other"] = other
+
+    assert bucket.SQLiteBucketHistory(path=fake_sqlite_history.path) == {
+        "test": fake_entry,
+        "other": other,
+    }
+
+
+def test_sqlite_bucket_history_transaction_deferred(fake_sqlite_history, fake_entry, mocker):
+    mocker.patch("myrm.bucket.LOCK_TIMEOUT", 0.1)
+    fake_sqlite_history["a"] = fake_entry
+    other = fake_entry._replace(index=3)
+
+    with fake_sqlite_history.transaction():
+        fake_sqlite_history["b"] = other
+        del fake_sqlite_history["a"]
+        assert fake_sqlite_history == {"b": other}
+        assert "a" not in fake_sqlite_history
+        # The changes out of the locked sections are saved only when the batch is committed.
+        reader = bucket.SQLiteBucketHistory(path=fake_sqlite_history.path)
+        assert reader == {"a": fake_entry}
+        reader["c"] = fake_entry._replace(index=4)
+
+    assert bucket.SQLiteBucketHistory(path=fake_sqlite_history.path) == {
+        "b": other,
+        "c": fake_entry._replace(index=4),
+    }
+
+
+def test_sqlite_bucket_history_rollback_published(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["a"] = fake_entry
+
+    with pytest.raises(ValueError):
+        with fake_sqlite_history.transaction():
+            fake_sqlite_history["b"] = fake_entry._replace(index=3)
+            del fake_sqlite_history["a"]
+            with fake_sqlite_history.locked():
+                pass
+            assert bucket.SQLiteBucketHistory(path=fake_sqlite_history.path) == {
+                "b": fake_entry._replace(index=3)
+            }
+            raise ValueError()
+
+    assert fake_sqlite_history == {"a": fake_entry}
+    assert bucket.SQLiteBucketHistory(path=fake_sqlite_history.path) == {"a": fake_entry}
+
+
+def test_sqlite_bucket_history_transaction_rollback(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry
+
+    with pytest.raises(ValueError):
+        with fake_sqlite_history.transaction():
+            del fake_sqlite_history["test"]
+            fake_sqlite_history["other"] = fake_entry
+            raise ValueError()
+
+    assert fake_sqlite_history == {"test": fake_entry}
+
+
+def test_sqlite_bucket_history_metadata(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry._replace(digest="a", metadata=(0o100600, 1, 2, 1000))
+
+    history = bucket.SQLiteBucketHistory(path=fake_sqlite_history.path)
+    assert history["test"].metadata == (0o100600, 1, 2, 1000)
+    assert next(history.get_entries()).metadata == (0o100600, 1, 2, 1000)
+
+
+def test_sqlite_bucket_history_delete_missing_item(fake_sqlite_history):
+    with pytest.raises(KeyError):
+        del fake_sqlite_history["test"]
+
+
+def test_sqlite_bucket_history_get_key(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry
+
+    assert fake_sqlite_history.get_key(2) == "test"
+    assert fake_sqlite_history.get_key(22) is None
+
+
+def test_sqlite_bucket_history_get_next_index(fake_sqlite_history, fake_entry):
+    assert fake_sqlite_history.get_next_index() == 1
+
+    fake_sqlite_history["test"] = fake_entry
+    assert fake_sqlite_history.get_indexes() == [2]
+    assert fake_sqlite_history.get_next_index() == 3
+
+    del fake_sqlite_history["test"]
+    assert bucket.SQLiteBucketHistory(path=fake_sqlite_history.path).get_next_index() == 3
+
+    fake_sqlite_history.cleanup()
+    assert fake_sqlite_history.get_next_index() == 1
+
+
+def test_sqlite_bucket_history_get_size(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry._replace(size=10)
+    fake_sqlite_history["other"] = fake_entry._replace(index=3, size=5)
+    fake_sqlite_history["test"] = fake_entry._replace(size=1)
+    assert fake_sqlite_history.get_size() == 6
+
+    fake_sqlite_history["unknown"] = fake_entry._replace(index=4)
+    assert fake_sqlite_history.get_size() is None
+    assert fake_sqlite_history.get_unsized() == ["unknown"]
+
+    del fake_sqlite_history["unknown"]
+    del fake_sqlite_history["other"]
+    assert bucket.SQLiteBucketHistory(path=fake_sqlite_history.path).get_size() == 1
+
+
+def test_sqlite_bucket_history_upgrade(tmp_path, fake_entry):
+    path = str(tmp_path / "history.db")
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        connection.execute(bucket.SQLiteBucketHistory.SCHEMA[0])
+        connection.execute(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, NULL)", ("test", *fake_entry[:5])
+        )
+        connection.commit()
+
+    history = bucket.SQLiteBucketHistory(path=path)
+    assert history == {"test": fake_entry}
+    assert history.get_next_index() == 3
+    assert history.get_size() is None
+
+
+def test_sqlite_bucket_history_get_entries(fake_sqlite_history, fake_entry):
+    for index in (3, 1, 2):
+        fake_sqlite_history[str(index)] = fake_entry._replace(index=index)
+
+    assert [entry.index for entry in fake_sqlite_history.get_entries(2)] == [1, 2]
+    assert [entry.index for entry in fake_sqlite_history.get_entries(2, 2)] == [3]
+    assert fake_sqlite_history.show(2, 2) is not None
+
+
+def test_sqlite_bucket_history_get_expired(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["old"] = fake_entry._replace(date="2012-12-12 12:12:12 PM")
+    fake_sqlite_history["new"] = fake_entry._replace(date="2032-12-12 12:12:12 PM", index=3)
+    fake_sqlite_history["bad"] = fake_entry._replace(index=4)
+
+    assert fake_sqlite_history.get_expired(bucket.get_timestamp("2022-12-12 12:12:12 PM")) == [
+        "old"
+    ]
+
+
+def test_sqlite_bucket_history_timestamp(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry._replace(timestamp=10.5)
+
+    assert fake_sqlite_history["test"].timestamp == 10.5
+    assert fake_sqlite_history.get_expired(10) == []
+    assert fake_sqlite_history.get_expired(11) == ["test"]
+
+
+def test_sqlite_bucket_history_cleanup(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry
+    fake_sqlite_history.cleanup(dry_run=False)
+
+    assert fake_sqlite_history == {}
+    assert bucket.SQLiteBucketHistory(path=fake_sqlite_history.path) == {}
+
+
+def test_sqlite_bucket_history_cleanup_with_dry_run(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["test"] = fake_entry
+    fake_sqlite_history.cleanup(dry_run=True)
+
+    assert fake_sqlite_history["test"] == fake_entry
+
+
+def test_sqlite_bucket_history_read_with_error(mocker, tmp_path):
+    logger_mock = mocker.patch("myrm.bucket.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        bucket.SQLiteBucketHistory(path=str(tmp_path))
+
+    assert exit_info.value.code == errno.EIO
+    logger_mock.error.assert_called_with(
+        "It's impossible to restore the history state on the current machine."
+    )
+
+
+def test_bucket_rm_restore_with_sqlite_history(tmp_path):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.db")
+    )
+    app_bucket.create()
+
+    path = tmp_path / "test.txt"
+    path.write_text("test")
+    app_bucket.rm(str(path))
+
+    assert not path.exists()
+    assert app_bucket.history.get_key(1) is not None
+
+    app_bucket.restore(1)
+
+    assert path.exists()
+    assert app_bucket.history == {}
+
+
+def test_bucket_history_references(fake_bucket_history, fake_entry):
+    fake_bucket_history["a"] = fake_entry._replace(size=10, digest="abc")
+    fake_bucket_history["b"] = fake_entry._replace(index=3, size=10, digest="abc")
+    fake_bucket_history["c"] = fake_entry._replace(index=4, size=5)
+
+    assert fake_bucket_history.get_references("abc") == 2
+    assert fake_bucket_history.get_size() == 15
+
+    del fake_bucket_history["a"]
+    assert fake_bucket_history.get_size() == 15
+    del fake_bucket_history["b"]
+    assert fake_bucket_history.get_references("abc") == 0
+    assert fake_bucket_history.get_size() == 5
+
+
+def test_sqlite_bucket_history_references(fake_sqlite_history, fake_entry):
+    fake_sqlite_history["a"] = fake_entry._replace(size=10, digest="abc")
+    fake_sqlite_history["b"] = fake_entry._replace(index=3, size=10, digest="abc")
+
+    assert fake_sqlite_history.get_references("abc") == 2
+    assert fake_sqlite_history.get_size() == 10
+    assert fake_sqlite_history["b"].digest == "abc"
+
+    del fake_sqlite_history["a"]
+    assert fake_sqlite_history.get_size() == 10
+    del fake_sqlite_history["b"]
+    assert fake_sqlite_history.get_size() == 0
+
+
+@pytest.fixture()
+def fake_dedup_bucket(tmp_path):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.pkl"), dedup=True
+    )
+    app_bucket.create()
+    return app_bucket
+
+
+def test_bucket_rm_dedup(fake_dedup_bucket, tmp_path):
+    paths = [tmp_path / f"{index}.txt" for index in range(3)]
+    for path in paths:
+        path.write_text("test")
+        os.utime(path, ns=(0, 1000))
+    fake_dedup_bucket.hash_files(str(path) for path in paths)
+
+    for path in paths:
+        fake_dedup_bucket.rm(str(path))
+
+    digest = fake_dedup_bucket.history[fake_dedup_bucket.history.get_key(1)].digest
+    stored = fake_dedup_bucket._get_object_path(digest)
+    assert fake_dedup_bucket.digests == {}
+    assert fake_dedup_bucket.history.get_references(digest) == 3
+    assert fake_dedup_bucket.get_size() == 4
+    assert os.stat(stored).st_nlink == 4
+
+
+def test_bucket_rm_dedup_different_metadata(fake_dedup_bucket, tmp_path):
+    for name, mode, mtime in (("a.txt", 0o644, 1000), ("b.txt", 0o600, 2000)):
+        path = tmp_path / name
+        path.write_text("test")
+        path.chmod(mode)
+        os.utime(path, ns=(0, mtime))
+        fake_dedup_bucket.rm(str(path))
+
+    # The items share the content whatever their metadata is, it's restored for every one.
+    assert (
+        fake_dedup_bucket.history.get_references(
+            fake_dedup_bucket.history[fake_dedup_bucket.history.get_key(2)].digest
+        )
+        == 2
+    )
+    assert fake_dedup_bucket.get_size() == 4
+
+    fake_dedup_bucket.restore(2)
+    fake_dedup_bucket.restore(1)
+
+    for name, mode, mtime in (("a.txt", 0o644, 1000), ("b.txt", 0o600, 2000)):
+        info = os.stat(tmp_path / name)
+        assert (stat.S_IMODE(info.st_mode), info.st_mtime_ns, info.st_nlink) == (mode, mtime, 1)
+
+
+def test_bucket_rm_dedup_changed(fake_dedup_bucket, tmp_path):
+    for name in ("a.txt", "b.txt"):
+        (tmp_path / name).write_text("AAAA")
+        os.utime(tmp_path / name, ns=(0, 1000))
+    fake_dedup_bucket.hash_files([str(tmp_path / "a.txt"), str(tmp_path / "b.txt")])
+    # The file is changed after it was hashed, its size is the same.
+    (tmp_path / "b.txt").write_text("CCCC")
+    os.utime(tmp_path / "b.txt", ns=(0, 2000))
+
+    fake_dedup_bucket.rm(str(tmp_path / "a.txt"))
+    fake_dedup_bucket.rm(str(tmp_path / "b.txt"))
+    fake_dedup_bucket.restore(2)
+
+    assert (tmp_path / "b.txt").read_text() == "CCCC"
+    assert fake_dedup_bucket.history[fake_dedup_bucket.history.get_key(1)].digest is not None
+
+
+def test_bucket_rm_dedup_refused(fake_dedup_bucket, tmp_path, mocker):
+    fake_dedup_bucket.maxsize = 6
+    for name in ("a.txt", "b.txt"):
+        (tmp_path / name).write_text("test")
+    fake_dedup_bucket.rm(str(tmp_path / "a.txt"))
+    mocker.patch.object(fake_dedup_bucket, "_share", return_value=None)
+
+    # The space of the content which isn't shared in the end is checked against the quota.
+    with pytest.raises(SystemExit) as exit_info:
+        fake_dedup_bucket.rm(str(tmp_path / "b.txt"))
+
+    assert exit_info.value.code == errno.EPERM
+    assert (tmp_path / "b.txt").read_text() == "test"
+    assert len(fake_dedup_bucket.history) == 1
+    assert fake_dedup_bucket.get_size() == 4
+
+
+def test_bucket_restore_dedup(fake_dedup_bucket, tmp_path):
+    paths = [tmp_path / f"{index}.txt" for index in range(2)]
+    for path in paths:
+        path.write_text("test")
+        os.utime(path, ns=(0, 1000))
+        fake_dedup_bucket.rm(str(path))
+    digest = fake_dedup_bucket.history[fake_dedup_bucket.history.get_key(1)].digest
+
+    fake_dedup_bucket.restore(1)
+    paths[0].write_text("changed")
+
+    # The restored file has its own content, the stored one is still kept for the other item.
+    assert os.stat(paths[0]).st_nlink == 1
+    assert os.stat(fake_dedup_bucket._get_object_path(digest)).st_nlink == 2
+
+    fake_dedup_bucket.restore(2)
+
+    assert paths[1].read_text() == "test"
+    assert not os.path.exists(fake_dedup_bucket._get_object_path(digest))
+
+
+def test_bucket_timeout_cleanup_dedup(fake_dedup_bucket, tmp_path):
+    path = tmp_path / "test.txt"
+    path.write_text("test")
+    fake_dedup_bucket.rm(str(path))
+    digest = fake_dedup_bucket.history[fake_dedup_bucket.history.get_key(1)].digest
+    fake_dedup_bucket.storetime = -1
+
+    fake_dedup_bucket.timeout_cleanup()
+
+    assert fake_dedup_bucket.history == {}
+    assert not os.path.exists(fake_dedup_bucket._get_object_path(digest))
+
+
+def test_bucket_check_dedup(fake_dedup_bucket, tmp_path):
+    path = tmp_path / "test.txt"
+    path.write_text("test")
+    fake_dedup_bucket.rm(str(path))
+    name = fake_dedup_bucket.history.get_key(1)
+    digest = fake_dedup_bucket.history[name].digest
+    orphan = tmp_path / ".myrm-store" / "ab" / "abc"
+    os.makedirs(orphan.parent, exist_ok=True)
+    orphan.write_text("test")
+
+    os.remove(os.path.join(fake_dedup_bucket.path, name))
+    fake_dedup_bucket.check()
+
+    assert fake_dedup_bucket.history == {}
+    assert not os.path.exists(fake_dedup_bucket._get_object_path(digest))
+    assert not orphan.exists()
+
+
+def test_bucket_cleanup_dedup(fake_dedup_bucket, tmp_path):
+    path = tmp_path / "test.txt"
+    path.write_text("test")
+    fake_dedup_bucket.rm(str(path))
+
+    fake_dedup_bucket.cleanup()
+
+    assert not os.path.exists(fake_dedup_bucket.store_path)
+    assert fake_dedup_bucket.history == {}
+
+
+@pytest.fixture()
+def fake_cold_bucket(tmp_path):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"),
+        history_path=str(tmp_path / "history.pkl"),
+        compress_after=settings.SECONDS_IN_DAY,
+    )
+    app_bucket.create()
+    return app_bucket
+
+
+def test_bucket_compress(fake_cold_bucket, tmp_path):
+    for name in ("old.txt", "new.txt"):
+        (tmp_path / name).write_text("test" * 1024)
+        fake_cold_bucket.rm(str(tmp_path / name))
+    key = fake_cold_bucket.history.get_key(1)
+    fake_cold_bucket.history[key] = fake_cold_bucket.history[key]._replace(timestamp=0.0)
+
+    fake_cold_bucket.compress()
+    fake_cold_bucket.compress()
+
+    entry = fake_cold_bucket.history[key + bucket.ARCHIVE_SUFFIX]
+    assert key not in fake_cold_bucket.history
+    assert entry.status == bucket.Status.COMPRESSED.value
+    assert entry.index == 1
+    assert sorted(os.listdir(fake_cold_bucket.path)) == sorted(
+        [key + bucket.ARCHIVE_SUFFIX, fake_cold_bucket.history.get_key(2)]
+    )
+    assert entry.size < 1024
+    assert fake_cold_bucket.get_size() == 4 * 1024 + entry.size
+
+    fake_cold_bucket.restore(1)
+
+    assert (tmp_path / "old.txt").read_text() == "test" * 1024
+    assert sorted(os.listdir(fake_cold_bucket.path)) == [fake_cold_bucket.history.get_key(2)]
+
+
+def test_bucket_compress_incompressible(fake_cold_bucket, tmp_path, mocker):
+    (tmp_path / "random.bin").write_bytes(random.randbytes(1024))
+    fake_cold_bucket.rm(str(tmp_path / "random.bin"))
+    key = fake_cold_bucket.history.get_key(1)
+    fake_cold_bucket.history[key] = fake_cold_bucket.history[key]._replace(timestamp=0.0)
+    pack_mock = mocker.spy(bucket.rmlib, "pack")
+
+    fake_cold_bucket.compress()
+    fake_cold_bucket.compress()
+
+    # The archive which is larger than the item is dropped and the item isn't packed again.
+    pack_mock.assert_called_once()
+    assert fake_cold_bucket.history[key].status == bucket.Status.INCOMPRESSIBLE.value
+    assert os.listdir(fake_cold_bucket.path) == [key]
+    assert fake_cold_bucket.get_size() == 1024
+
+
+def test_bucket_startup_compress(fake_cold_bucket, tmp_path, mocker):
+    (tmp_path / "old.txt").write_text("test" * 1024)
+    fake_cold_bucket.rm(str(tmp_path / "old.txt"))
+    key = fake_cold_bucket.history.get_key(1)
+    timestamp = time.time() - 2 * settings.SECONDS_IN_DAY
+    fake_cold_bucket.history[key] = fake_cold_bucket.history[key]._replace(timestamp=timestamp)
+
+    # The plain run of this program compresses the aged items when the maintenance is due.
+    fake_cold_bucket.startup()
+
+    assert fake_cold_bucket.history.get_key(1) == key + bucket.ARCHIVE_SUFFIX
+
+
+def test_bucket_compress_disabled(fake_bucket, fake_entry):
+    fake_bucket.history["test"] = fake_entry._replace(timestamp=0.0)
+    fake_bucket.compress()
+
+    assert fake_bucket.history["test"].status == bucket.Status.CORRECT.value
+
+
+def test_iter_heap():
+    heap = [5, 3, 8, 1, 9, 2, 7]
+    heapq.heapify(heap)
+    state = list(heap)
+
+    assert list(bucket.iter_heap(heap)) == sorted(heap)
+    assert heap == state
+
+
+@pytest.mark.parametrize("history", ["fake_bucket_history", "fake_sqlite_history"])
+@pytest.mark.parametrize(
+    "policy, expected",
+    [
+        ("oldest", ["a", "b", "c", "d"]),
+        ("largest", ["c", "b", "d", "a"]),
+        ("score", ["b", "c", "a", "d"]),
+    ],
+)
+def test_bucket_history_get_victims(request, history, policy, expected, fake_entry):
+    history = request.getfixturevalue(history)
+    for index, (key, timestamp, size) in enumerate(
+        [("a", 10.0, 1), ("b", 20.0, 50), ("c", 90.0, 100), ("d", 95.0, 10)]
+    ):
+        history[key] = fake_entry._replace(index=index + 1, timestamp=timestamp, size=size)
+    # The outdated values are skipped.
+    history["d"] = history["d"]._replace(timestamp=99.0, size=20)
+
+    assert list(history.get_victims(policy, 100.0)) == expected
+
+
+def test_bucket_history_get_victims_score(fake_bucket_history, fake_entry):
+    generator = random.Random(0)
+    for index in range(200):
+        fake_bucket_history[str(index)] = fake_entry._replace(
+            index=index + 1, timestamp=generator.uniform(0, 1000), size=generator.randint(0, 1000)
+        )
+
+    values = fake_bucket_history.data.items()
+    expected = sorted(values, key=lambda item: (-bucket.get_score(item[1], 1000.0), item[0]))
+
+    assert list(fake_bucket_history.get_victims("score", 1000.0)) == [key for key, _ in expected]
+
+
+@pytest.mark.parametrize("policy", ["oldest", "largest", "score"])
+def test_bucket_rm_eviction(tmp_path, mocker, policy):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"),
+        history_path=str(tmp_path / "history.pkl"),
+        maxsize=100,
+        eviction=policy,
+    )
+    app_bucket.create()
+    for name, size in (("a", 40), ("b", 30), ("c", 20)):
+        (tmp_path / name).write_bytes(b"x" * size)
+        app_bucket.rm(str(tmp_path / name))
+    key = app_bucket.history.get_key(1)
+    app_bucket.history[key] = app_bucket.history[key]._replace(timestamp=time.time() - 10)
+
+    (tmp_path / "d").write_bytes(b"x" * 30)
+    get_size_mock = mocker.spy(app_bucket, "_get_size")
+    locks = []
+    remove = app_bucket._rm
+    mocker.patch.object(
+        app_bucket,
+        "_rm",
+        side_effect=lambda *args: locks.append(app_bucket.history.locks) or remove(*args),
+    )
+    app_bucket.rm(str(tmp_path / "d"))
+
+    # The bucket isn't walked and the victim is removed after the history is unlocked.
+    get_size_mock.assert_called_once_with(str(tmp_path / "d"))
+    assert locks == [0]
+
+    # Only the first item of every order is evicted to free the space.
+    assert sorted(entry.name for entry in app_bucket.history.values()) == ["b", "c", "d"]
+    assert len(os.listdir(app_bucket.path)) == 3
+    assert app_bucket.get_size() == 80
+
+
+def test_bucket_rm_eviction_too_large(tmp_path, mocker):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"),
+        history_path=str(tmp_path / "history.pkl"),
+        maxsize=100,
+        eviction="oldest",
+    )
+    app_bucket.create()
+    (tmp_path / "a").write_bytes(b"x" * 10)
+    app_bucket.rm(str(tmp_path / "a"))
+    (tmp_path / "b").write_bytes(b"x" * 100)
+    logger_mock = mocker.patch("myrm.bucket.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        app_bucket.rm(str(tmp_path / "b"))
+
+    assert exit_info.value.code == errno.EPERM
+    assert len(app_bucket.history) == 1
+    logger_mock.error.assert_called_with(
+        "It's impossible to move item to bucket because the bucket is full."
+    )
+
+
+def remove_files(root, history_name, name, count):
+    app_bucket = bucket.Bucket(
+        path=os.path.join(root, "bucket"), history_path=os.path.join(root, history_name)
+    )
+    for number in range(count):
+        path = os.path.join(root, f"{name}-{number}")
+        with open(path, "wb") as stream_out:
+            stream_out.write(b"x")
+
+        # Every item is saved at once, so the processes interleave and compact the history.
+        with app_bucket.history.transaction():
+            app_bucket.rm(path)
+
+
+def check_files(root, history_name, event):
+    app_bucket = bucket.Bucket(
+        path=os.path.join(root, "bucket"), history_path=os.path.join(root, history_name)
+    )
+    # The bucket is compared with the history while the other processes move the items into it.
+    while not event.is_set():
+        with app_bucket.history.transaction():
+            app_bucket.check()
+
+
+def test_bucket_rm_resume(tmp_path, mocker):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.pkl"), workers=1
+    )
+    app_bucket.create()
+    src = tmp_path / "dir"
+    src.mkdir()
+    for name in ("a.txt", "b.txt", "c.txt"):
+        (src / name).write_text(name)
+    rename = os.rename
+
+    def fake_rename(old, new):
+        # The items of the directory are on another file system.
+        if str(old).startswith(str(src)):
+            raise OSError(errno.EXDEV, "")
+        rename(old, new)
+
+    mocker.patch("myrm.rmlib.os.rename", side_effect=fake_rename)
+    copy = bucket.rmlib._copy
+    calls, interrupted = [], []
+
+    def fake_copy(src, dst):
+        # The first run is interrupted while its second item is copied.
+        if calls and not interrupted:
+            interrupted.append(src)
+            raise KeyboardInterrupt()
+        calls.append(src)
+        copy(src, dst)
+
+    mocker.patch("myrm.rmlib._copy", side_effect=fake_copy)
+
+    with pytest.raises(KeyboardInterrupt):
+        app_bucket.rm(str(src))
+
+    name = app_bucket.history.get_key(1)
+    assert app_bucket.history[name].status == bucket.Status.PARTIAL.value
+    assert len(os.listdir(src)) == 2
+
+    calls.clear()
+    app_bucket.rm(str(src))
+
+    # The second run moves only the rest of the items to the same place.
+    assert len(calls) == 2
+    assert list(app_bucket.history) == [name]
+    assert app_bucket.history[name].status == bucket.Status.CORRECT.value
+    assert sorted(os.listdir(os.path.join(app_bucket.path, name))) == ["a.txt", "b.txt", "c.txt"]
+    assert not src.exists()
+    assert app_bucket.get_size() == 15
+
+
+def test_bucket_rm_missing(tmp_path):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.pkl")
+    )
+    app_bucket.create()
+
+    with pytest.raises(SystemExit) as exit_info:
+        app_bucket.rm(str(tmp_path / "missing"))
+
+    assert exit_info.value.code == errno.ENOENT
+    assert os.listdir(tmp_path / "bucket") == []
+    assert app_bucket.history == {}
+    assert bucket.load_history(str(tmp_path / "history.pkl")) == {}
+
+
+@pytest.mark.parametrize("history_name", ["history.pkl", "history.db"])
+def test_bucket_rm_parallel(tmp_path, mocker, history_name):
+    import multiprocessing
+
+    mocker.patch("myrm.bucket.JOURNAL_THRESHOLD", 8)
+    bucket.Bucket(path=str(tmp_path / "bucket")).create()
+    context = multiprocessing.get_context("fork")
+    event = context.Event()
+    checker = context.Process(target=check_files, args=(str(tmp_path), history_name, event))
+    processes = [
+        context.Process(target=remove_files, args=(str(tmp_path), history_name, name, 20))
+        for name in "abcd"
+    ]
+    checker.start()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    event.set()
+    checker.join()
+
+    history = bucket.load_history(str(tmp_path / history_name))
+    assert [process.exitcode for process in [*processes, checker]] == [0] * 5
+    assert len(history) == 80
+    assert sorted(history.get_indexes()) == list(range(1, 81))
+    assert {entry.status for entry in history.values()} == {bucket.Status.CORRECT.value}
+    assert sorted(history) == sorted(os.listdir(tmp_path / "bucket"))
+    assert history.get_size() == 80
+
+
+def test_bucket_history_merge(tmp_path, fake_entry):
+    path = str(tmp_path / "history.pkl")
+    first = bucket.BucketHistory(path=path)
+    second = bucket.BucketHistory(path=path)
+    first["a"] = fake_entry._replace(index=1)
+
+    with second.transaction():
+        second["b"] = fake_entry._replace(index=1)
+
+    # The index which was given by another process at first is kept by its item.
+    assert second["a"].index == 1
+    assert second["b"].index == 2
+    assert bucket.BucketHistory(path=path) == second
+
+    first.cleanup()
+    with second.locked():
+        assert second == {}
+
+
+def test_bucket_history_rollback_published(tmp_path, fake_entry):
+    path = str(tmp_path / "history.pkl")
+    history = bucket.BucketHistory(path=path)
+    history["a"] = fake_entry
+
+    with pytest.raises(ValueError):
+        with history.transaction():
+            history["b"] = fake_entry._replace(index=3)
+            del history["a"]
+            with history.locked():
+                pass
+            assert bucket.BucketHistory(path=path) == {"b": fake_entry._replace(index=3)}
+            raise ValueError()
+
+    assert history == {"a": fake_entry}
+    assert bucket.BucketHistory(path=path) == {"a": fake_entry}
+
+
+@pytest.fixture()
+def fake_device_bucket(fs):
+    fs.add_mount_point("/mnt/usb")
+    app_bucket = bucket.Bucket(
+        path="/home/bucket", history_path="/home/history.pkl", per_device=True
+    )
+    app_bucket.create()
+    return app_bucket
+
+
+def test_get_mount_point(fs):
+    fs.add_mount_point("/mnt/usb")
+    fs.create_dir("/mnt/usb/a/b")
+
+    assert bucket.get_mount_point("/mnt/usb/a/b") == "/mnt/usb"
+    assert bucket.get_mount_point("/mnt/usb") == "/mnt/usb"
+    assert bucket.get_mount_point("/mnt") == "/"
+
+
+def test_bucket_rm_per_device(fake_device_bucket, fs):
+    fs.create_file("/mnt/usb/a.txt", contents="test")
+    fs.create_file("/home/b.txt", contents="test")
+
+    fake_device_bucket.rm("/mnt/usb/a.txt")
+    fake_device_bucket.rm("/home/b.txt")
+
+    name = fake_device_bucket.history.get_key(1)
+    assert os.path.dirname(name) == os.path.join("/mnt/usb", f".myrm-bucket-{os.getuid()}")
+    assert stat.S_IMODE(os.stat(os.path.dirname(name)).st_mode) == 0o700
+    assert os.stat(name).st_dev == os.stat("/mnt/usb").st_dev
+    assert os.path.isfile(os.path.join("/home/bucket", fake_device_bucket.history.get_key(2)))
+    assert fake_device_bucket.get_device_buckets() == [os.path.dirname(name)]
+    assert fake_device_bucket.get_size() == 8
+
+    # The history covers the items of every bucket together.
+    fake_device_bucket.check()
+    assert len(fake_device_bucket.history) == 2
+
+    fake_device_bucket.restore(1)
+    assert os.path.isfile("/mnt/usb/a.txt")
+    assert not os.path.exists(name)
+
+
+def test_bucket_rm_per_device_without_bucket(fake_device_bucket, fs, mocker):
+    fs.create_file("/mnt/usb/a.txt")
+    mocker.patch("myrm.bucket.os.makedirs", side_effect=PermissionError())
+
+    fake_device_bucket.rm("/mnt/usb/a.txt")
+
+    assert fake_device_bucket.devices == {os.stat("/mnt/usb").st_dev: None}
+    assert os.listdir("/home/bucket") == [fake_device_bucket.history.get_key(1)]
+
+
+@pytest.mark.parametrize("uid, mode", [(0, 0o700), (None, 0o777)])
+def test_bucket_rm_per_device_not_private(fake_device_bucket, fs, mocker, uid, mode):
+    mocker.patch("myrm.bucket.os.getuid", return_value=1000)
+    device_bucket = os.path.join("/mnt/usb", ".myrm-bucket-1000")
+    fs.create_dir(device_bucket, perm_bits=mode)
+    os.chown(device_bucket, 1000 if uid is None else uid, -1)
+    fs.create_file("/mnt/usb/a.txt")
+    logger = mocker.patch("myrm.bucket.logger")
+
+    fake_device_bucket.rm("/mnt/usb/a.txt")
+
+    logger.warning.assert_called_once()
+    assert fake_device_bucket.devices == {os.stat("/mnt/usb").st_dev: None}
+    assert os.listdir("/home/bucket") == [fake_device_bucket.history.get_key(1)]
+    assert os.listdir(device_bucket) == []
+
+
+def test_bucket_rm_force_defer_per_device(fake_device_bucket, fs, mocker, fake_entry):
+    purge_mock = mocker.patch("myrm.bucket.rmlib.purge_in_background")
+    fs.create_file("/mnt/usb/dir/a.txt")
+    fake_device_bucket.rm("/mnt/usb/dir", force=True, defer=True)
+
+    staging = os.path.join("/mnt/usb", f".myrm-staging-{os.getuid()}")
+    assert not os.path.exists("/mnt/usb/dir")
+    assert len(os.listdir(staging)) == 1
+    assert stat.S_IMODE(os.stat(staging).st_mode) == 0o700
+    assert not fake_device_bucket.staged
+
+    fake_device_bucket.shutdown()
+    purge_mock.assert_called_once_with(staging, fake_device_bucket.workers)
+    assert not fake_device_bucket.stagings
+
+    # The items left by the interrupted process are found by the known device bucket.
+    fake_device_bucket.devices.clear()
+    device_bucket = os.path.join("/mnt/usb", f".myrm-bucket-{os.getuid()}")
+    fake_device_bucket.history[os.path.join(device_bucket, "a")] = fake_entry
+    fake_device_bucket.purge()
+    assert os.listdir(staging) == [bucket.rmlib.STAGING_LOCK]
+
+
+def test_bucket_check_per_device(fake_device_bucket, fs, fake_entry):
+    device_bucket = os.path.join("/mnt/usb", f".myrm-bucket-{os.getuid()}")
+    fs.create_dir(device_bucket, perm_bits=0o700)
+    fs.create_file(os.path.join(device_bucket, "a"))
+    fake_device_bucket.devices[os.stat("/mnt/usb").st_dev] = device_bucket
+    # The file system of this bucket isn't mounted now.
+    missing = os.path.join("/mnt/other", f".myrm-bucket-{os.getuid()}", "b")
+    fake_device_bucket.history[missing] = fake_entry
+    # The items of the bucket which other users can write aren't adopted.
+    shared = os.path.join("/mnt/shared", bucket.DEVICE_BUCKET_NAME)
+    fs.create_file(os.path.join(shared, "c"))
+    fake_device_bucket.history[os.path.join(shared, "d")] = fake_entry._replace(index=3)
+
+    fake_device_bucket.check()
+
+    assert sorted(fake_device_bucket.history) == [
+        missing,
+        os.path.join(shared, "d"),
+        os.path.join(device_bucket, "a"),
+    ]
+
+
+def test_bucket_cleanup_per_device(fake_device_bucket, fs):
+    fs.create_file("/mnt/usb/a.txt")
+    fake_device_bucket.rm("/mnt/usb/a.txt")
+
+    fake_device_bucket.cleanup()
+
+    assert fake_device_bucket.history == {}
+    assert fake_device_bucket.devices == {}
+    assert not os.path.exists(os.path.join("/mnt/usb", f".myrm-bucket-{os.getuid()}"))
+
+
+def test_bucket_cleanup_per_device_not_private(fake_device_bucket, fs, fake_entry):
+    shared = os.path.join("/mnt/shared", bucket.DEVICE_BUCKET_NAME)
+    fs.create_file(os.path.join(shared, "a"))
+    fake_device_bucket.history[os.path.join(shared, "a")] = fake_entry
+
+    fake_device_bucket.cleanup()
+
+    assert fake_device_bucket.history == {}
+    assert os.path.isfile(os.path.join(shared, "a"))
+
+
+def test_bucket_restore_many(tmp_path, mocker):
+    app_bucket = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.pkl"), workers=4
+    )
+    app_bucket.create()
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "a.txt").write_text("a")
+    paths = [tmp_path / "dir" / "b.txt", tmp_path / "dir", tmp_path / "c.txt", tmp_path / "d.txt"]
+    for path in paths:
+        if not path.exists():
+            path.write_text("test")
+        app_bucket.rm(str(path))
+    (tmp_path / "d.txt").write_text("new")
+    logger_mock = mocker.patch("myrm.bucket.logger")
+    transaction_spy = mocker.spy(app_bucket.history, "transaction")
+
+    # The directory is restored before the file which was removed from it earlier.
+    assert app_bucket.restore_many([1, 2, 3, 3, 4, 5]) == [4, 5]
+
+    assert (tmp_path / "dir" / "a.txt").read_text() == "a"
+    assert (tmp_path / "dir" / "b.txt").read_text() == "test"
+    assert (tmp_path / "c.txt").read_text() == "test"
+    assert (tmp_path / "d.txt").read_text() == "new"
+    assert [entry.index for entry in app_bucket.history.values()] == [4]
+    assert bucket.BucketHistory(path=app_bucket.history_path) == app_bucket.history
+    assert transaction_spy.call_count == 1
+    logger_mock.warning.assert_any_call("The index %d don't exist in history.", 5)
+    logger_mock.warning.assert_any_call(
+        "Item '%s' can't be restored to its origin.", str(tmp_path / "d.txt")
+    )
+
+
+def test_bucket_restore_many_with_error(fake_bucket, fs, mocker):
+    fake_bucket.create()
+    for name in ("a", "b"):
+        fs.create_file(name)
+        fake_bucket.rm(name)
+    mocker.patch("myrm.bucket.rmlib.mv", side_effect=[SystemExit(errno.EPERM), None])
+
+    assert fake_bucket.restore_many([1, 2]) == [1]
+    assert [entry.index for entry in fake_bucket.history.values()] == [1]
+
+
+def test_bucket_restore_many_with_dry_run(fake_bucket, fs):
+    fake_bucket.create()
+    fs.create_file("a")
+    fake_bucket.rm("a")
+
+    assert fake_bucket.restore_many([1], dry_run=True) == []
+    assert not os.path.exists("a")
+    assert len(fake_bucket.history) == 1
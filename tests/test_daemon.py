@@ -0,0 +1,142 @@
+import errno
+import io
+import logging
+import os
+import threading
+
+import pytest
+
+from myrm import bucket, daemon
+
+
+def fake_show(arguments, bucket_instance):
+    bucket_instance.startup()
+    print(len(bucket_instance.history), arguments.text)
+
+
+def fake_fail(arguments, bucket_instance):
+    logging.getLogger("myrm").error("Test error.")
+    raise SystemExit(errno.EPERM)
+
+
+ARGUMENTS = {"dry_run": False, "logging_level": logging.WARNING, "text": "test"}
+
+
+@pytest.fixture()
+def fake_server(tmp_path):
+    bucket_instance = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.pkl")
+    )
+    server = daemon.Server(
+        str(tmp_path / "myrm.sock"),
+        bucket_instance,
+        {"test": 1},
+        {"show": fake_show, "fail": fake_fail},
+    )
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_request(fake_server):
+    stdout = io.StringIO()
+    code = daemon.request("show", ARGUMENTS, {"test": 1}, fake_server.server_address, stdout)
+
+    assert code == 0
+    assert stdout.getvalue() == "0 test\n"
+    # The bucket was maintained by the daemon between the commands.
+    assert os.path.isdir(fake_server.bucket.path)
+
+
+def test_request_with_error(fake_server):
+    stdout = io.StringIO()
+    code = daemon.request("fail", ARGUMENTS, {"test": 1}, fake_server.server_address, stdout)
+
+    assert code == errno.EPERM
+    assert "Test error." in stdout.getvalue()
+
+
+def test_request_reloads_history(fake_server, fake_entry):
+    daemon.request("show", ARGUMENTS, {"test": 1}, fake_server.server_address, io.StringIO())
+
+    # The history is changed by the program running without the daemon.
+    history = bucket.BucketHistory(path=fake_server.bucket.history_path)
+    history["test"] = fake_entry
+    os.mkdir(os.path.join(fake_server.bucket.path, "test"))
+    os.utime(fake_server.bucket.path, ns=(0, 0))
+
+    stdout = io.StringIO()
+    daemon.request("show", ARGUMENTS, {"test": 1}, fake_server.server_address, stdout)
+    assert stdout.getvalue() == "1 test\n"
+
+
+def test_request_fallback(fake_server, tmp_path):
+    assert daemon.request("show", ARGUMENTS, {"test": 2}, fake_server.server_address) is None
+    assert daemon.request("show", ARGUMENTS, {"test": 1}, str(tmp_path / "missing.sock")) is None
+
+
+def test_request_untrusted(fake_server, mocker):
+    mocker.patch("myrm.daemon.os.getuid", return_value=os.getuid() + 1)
+    logger_mock = mocker.patch("myrm.daemon.logger")
+    stdout = io.StringIO()
+
+    code = daemon.request("show", ARGUMENTS, {"test": 1}, fake_server.server_address, stdout)
+
+    assert code is None
+    assert stdout.getvalue() == ""
+    logger_mock.warning.assert_called_with(
+        "The daemon socket '%s' belongs to another user, it isn't used.",
+        fake_server.server_address,
+    )
+
+
+def test_is_trusted_without_peer_credentials(fake_server, monkeypatch):
+    monkeypatch.delattr(daemon.socket, "SO_PEERCRED", raising=False)
+    connection = daemon._connect(fake_server.server_address)
+
+    with connection:
+        os.chmod(fake_server.server_address, 0o600)
+        assert daemon._is_trusted(connection, fake_server.server_address)
+        os.chmod(fake_server.server_address, 0o666)
+        assert not daemon._is_trusted(connection, fake_server.server_address)
+
+
+def test_request_invalid_command(fake_server):
+    code = daemon.request("missing", ARGUMENTS, {"test": 1}, fake_server.server_address)
+    assert code == errno.EINVAL
+
+
+def test_serve_already_running(fake_server, mocker):
+    logger_mock = mocker.patch("myrm.daemon.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        daemon.serve(fake_server.bucket, {}, {}, fake_server.server_address)
+
+    assert exit_info.value.code == errno.EADDRINUSE
+    logger_mock.error.assert_called_with("The daemon is already running on the current machine.")
+
+
+def test_service_actions_with_error(tmp_path, mocker):
+    bucket_instance = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.pkl")
+    )
+    server = daemon.Server(str(tmp_path / "myrm.sock"), bucket_instance, {"test": 1}, {})
+    mocker.patch.object(bucket_instance, "startup", side_effect=ValueError())
+    reload_spy = mocker.spy(bucket_instance, "reload")
+    logger_mock = mocker.patch("myrm.daemon.logger")
+
+    try:
+        # The daemon keeps serving the commands after the failed maintenance.
+        server.service_actions()
+    finally:
+        server.server_close()
+
+    logger_mock.error.assert_called_once_with(
+        "An unexpected error occurred at this program runtime."
+    )
+    reload_spy.assert_called_once_with()
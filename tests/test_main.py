@@ -0,0 +1,220 @@
+import argparse
+import errno
+import io
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from myrm import __main__ as cli
+
+# The modules which aren't required to start this program and remove the items.
+LAZY_MODULES = (
+    "concurrent.futures",
+    "csv",
+    "datetime",
+    "logging.config",
+    "sqlite3",
+    "subprocess",
+    "tabulate",
+    "uuid",
+)
+# The only modules which are imported to start this program besides the interpreter ones.
+STARTUP_MODULES = (
+    "argparse",
+    "array",
+    "atexit",
+    "bisect",
+    "bz2",
+    "collections",
+    "contextlib",
+    "copyreg",
+    "enum",
+    "errno",
+    "fcntl",
+    "fnmatch",
+    "functools",
+    "gettext",
+    "heapq",
+    "itertools",
+    "json",
+    "keyword",
+    "linecache",
+    "locale",
+    "logging",
+    "lzma",
+    "math",
+    "myrm",
+    "operator",
+    "pickle",
+    "random",
+    "re",
+    "reprlib",
+    "select",
+    "selectors",
+    "shutil",
+    "signal",
+    "socket",
+    "socketserver",
+    "string",
+    "struct",
+    "tempfile",
+    "textwrap",
+    "threading",
+    "token",
+    "tokenize",
+    "traceback",
+    "types",
+    "typing",
+    "warnings",
+    "weakref",
+    "zlib",
+)
+
+
+def get_arguments(**kwargs):
+    arguments = {
+        "FILES": [],
+        "from_file": None,
+        "null": False,
+        "regex": None,
+        "glob": None,
+        "include": [],
+        "exclude": [],
+        "force": False,
+        "defer": False,
+        "confirm": False,
+        "dry_run": False,
+    }
+    arguments.update(kwargs)
+    return argparse.Namespace(**arguments)
+
+
+@pytest.mark.parametrize("null, separator", [(False, b"\n"), (True, b"\0")])
+def test_read_files(fs, mocker, null, separator):
+    mocker.patch("myrm.__main__.READ_CHUNK_SIZE", 3)
+    fs.create_file("list", contents=separator.join([b"a", b"dir/b c", b"", b"/d"]))
+
+    assert list(cli.read_files("list", null)) == [
+        os.path.abspath("a"),
+        os.path.abspath("dir/b c"),
+        "/d",
+    ]
+
+
+def test_read_files_from_stdin(mocker):
+    stdin = mocker.patch("myrm.__main__.sys.stdin")
+    stdin.buffer = io.BufferedReader(io.BytesIO(b"/a\0/b\0"))
+
+    assert list(cli.read_files("-", null=True)) == ["/a", "/b"]
+
+
+def test_read_files_with_error(fs, mocker):
+    logger_mock = mocker.patch("myrm.__main__.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        list(cli.read_files("missing"))
+
+    assert exit_info.value.code == errno.ENOENT
+    logger_mock.error.assert_called_with(
+        "It's impossible to read the list of items on the current machine."
+    )
+
+
+def test_remove_from_file(fake_bucket, fs, mocker):
+    mocker.patch("myrm.__main__.BATCH_SIZE", 2)
+    fake_bucket.startup()
+    commit_mock = mocker.spy(fake_bucket.history, "_commit")
+
+    names = [f"test{index}.txt" for index in range(5)]
+    for name in names:
+        fs.create_file(name)
+    fs.create_file("list", contents="\n".join(names[1:]))
+
+    cli.remove(get_arguments(FILES=[os.path.abspath(names[0])], from_file="list"), fake_bucket)
+
+    assert not any(os.path.exists(name) for name in names)
+    assert sorted(entry.name for entry in fake_bucket.history.values()) == names
+    assert commit_mock.call_count == 3
+
+
+def test_remove_force_from_file(fake_bucket, fs, mocker):
+    load_mock = mocker.spy(cli.bucket, "load_history")
+    fs.create_file("test.txt")
+    fs.create_file("list", contents="test.txt\0", encoding="utf-8")
+
+    cli.remove(get_arguments(from_file="list", null=True, force=True, answer=True), fake_bucket)
+
+    assert not os.path.exists("test.txt")
+    load_mock.assert_not_called()
+
+
+def test_restore_with_error(fake_bucket, fs, mocker):
+    fake_bucket.startup()
+    for name in ("a", "b"):
+        fs.create_file(name)
+        fake_bucket.rm(os.path.abspath(name))
+    fs.create_file("b")
+    logger_mock = mocker.patch("myrm.__main__.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        cli.restore(argparse.Namespace(INDICES=[1, 2, 3], dry_run=False), fake_bucket)
+
+    # The other items are restored before this program stops.
+    assert exit_info.value.code == errno.EPERM
+    assert os.path.exists("a")
+    logger_mock.error.assert_called_with("The items with indexes %s can't be restored.", "2, 3")
+
+
+def test_send_fallback(tmp_path, mocker):
+    path = str(tmp_path / "myrm.sock")
+    # Another user listens on the socket of the daemon.
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    mocker.patch("myrm.daemon.os.getuid", return_value=os.getuid() + 1)
+    arguments = argparse.Namespace(command="show", socket=path, func=None, get_settings=None)
+
+    with listener:
+        assert cli.send(arguments, cli.settings.AppSettings()) is None
+        connection, _ = listener.accept()
+        with connection:
+            assert connection.recv(1024) == b""
+
+
+def get_startup_modules(code):
+    modules = []
+    for command in ("import sys", code):
+        result = subprocess.run(
+            [sys.executable, "-c", f"{command}\nprint(*sys.modules)"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        modules.append(set(result.stdout.split()))
+
+    # Only the public packages imported on top of the interpreter itself are compared.
+    return {name.split(".")[0] for name in modules[1] - modules[0] if not name.startswith("_")}
+
+
+def test_import_modules():
+    modules = get_startup_modules("import sys, myrm.__main__")
+
+    assert not modules & set(LAZY_MODULES)
+    assert modules <= set(STARTUP_MODULES)
+
+
+def test_start_modules():
+    modules = get_startup_modules(
+        "import contextlib, io, sys, myrm.__main__ as cli\n"
+        "sys.argv = ['myrm', '--help']\n"
+        "with contextlib.redirect_stdout(io.StringIO()), contextlib.suppress(SystemExit):\n"
+        "    cli.main()"
+    )
+
+    # Nothing but the parser is prepared before the command is known.
+    assert not modules & set(LAZY_MODULES)
+    assert modules <= set(STARTUP_MODULES)
@@ -0,0 +1,173 @@
+import errno
+import os
+import re
+import sys
+
+import pytest
+
+from myrm import pattern
+
+
+@pytest.mark.parametrize(
+    "glob, path, matched",
+    [
+        ("*.txt", "test.txt", True),
+        ("*.txt", "dir/test.txt", False),
+        ("dir/*.txt", "dir/test.txt", True),
+        ("**/*.txt", "test.txt", True),
+        ("**/*.txt", "a/b/test.txt", True),
+        ("a/**", "a/b/c", True),
+        ("test?.[ch]", "test1.c", True),
+        ("test?.[!ch]", "test1.c", False),
+        ("[a.txt", "[a.txt", True),
+        ("a+b(c).txt", "a+b(c).txt", True),
+    ],
+)
+def test_translate(glob, path, matched):
+    assert bool(re.fullmatch(pattern.translate(glob), path)) is matched
+
+
+def test_glob_contains():
+    assert pattern.Glob("a/*/c.txt").contains("a")
+    assert pattern.Glob("a/*/c.txt").contains("a/b")
+    assert not pattern.Glob("a/*/c.txt").contains("a/b/c")
+    assert not pattern.Glob("a/*/c.txt").contains("b")
+    assert pattern.Glob("a/**/c.txt").contains("a/b/c/d")
+    assert not pattern.Glob("*.txt").contains("a")
+    assert pattern.Glob("*.txt", anchored=False).contains("a/b")
+    assert pattern.Glob("*.txt", anchored=False).match("a/b.txt")
+
+
+def test_matcher():
+    matcher = pattern.Matcher(regex=r".*\.log", include=["app*"], exclude=["*.old.log"])
+
+    assert matcher.match("app.log")
+    assert matcher.match("dir/app.log")
+    assert not matcher.match("app.txt")
+    assert not matcher.match("other.log")
+    assert not matcher.match("app.old.log")
+
+
+def test_matcher_regex_whole_path():
+    matcher = pattern.Matcher(regex=r"data\.csv")
+
+    assert matcher.match("data.csv")
+    assert not matcher.match("mydata.csv.old")
+    assert not matcher.match("dataXcsv")
+    assert not matcher.match("sub/data.csv")
+    assert pattern.Matcher(regex="data.csv").match("dataXcsv")
+
+
+def test_matcher_with_invalid_regex(mocker):
+    logger_mock = mocker.patch("myrm.pattern.logger")
+    matcher = pattern.Matcher(regex="*.txt")
+
+    assert matcher.match("test.txt")
+    assert not matcher.match("dir/test.txt")
+    logger_mock.warning.assert_called_with(
+        "The determined pattern isn't a regular expression, it's used as the glob."
+    )
+
+
+def test_find(fs, mocker):
+    for path in ("a.txt", "b.log", "dir/c.txt", "dir/inner/d.txt", "skip/e.txt", "match.txt/f"):
+        fs.create_file(os.path.join("root", path))
+
+    scandir_mock = mocker.spy(pattern.rmlib.os, "scandir")
+    matcher = pattern.Matcher(glob="**/*.txt", exclude=["skip"])
+
+    assert sorted(pattern.find("root", matcher)) == [
+        os.path.join("root", "a.txt"),
+        os.path.join("root", "dir", "c.txt"),
+        os.path.join("root", "dir", "inner", "d.txt"),
+        os.path.join("root", "match.txt"),
+    ]
+    # The excluded directories aren't scanned, the matched ones only for the excluded items.
+    assert sorted(call.args[0] for call in scandir_mock.call_args_list) == [
+        "root",
+        os.path.join("root", "dir"),
+        os.path.join("root", "dir", "inner"),
+        os.path.join("root", "match.txt"),
+    ]
+
+
+def test_find_pruned(fs, mocker):
+    for path in ("a/b/c.txt", "a/d/c.txt", "e/b/c.txt"):
+        fs.create_file(os.path.join("root", path))
+
+    scandir_mock = mocker.spy(pattern.rmlib.os, "scandir")
+
+    assert list(pattern.find("root", pattern.Matcher(glob="a/b/*.txt"))) == [
+        os.path.join("root", "a", "b", "c.txt")
+    ]
+    assert scandir_mock.call_count == 3
+
+
+def test_find_excluded_inside_matched(fs):
+    for path in ("d/a.txt", "d/sub/important.keep", "d/sub/b.txt", "d/build/c.txt", "e/f.keep"):
+        fs.create_file(os.path.join("root", path))
+
+    # Only the items which don't contain the excluded ones are removed as a whole.
+    assert sorted(pattern.find("root", pattern.Matcher(glob="d", exclude=["*.keep"]))) == [
+        os.path.join("root", "d", "a.txt"),
+        os.path.join("root", "d", "build"),
+        os.path.join("root", "d", "sub", "b.txt"),
+    ]
+    assert sorted(pattern.find("root", pattern.Matcher(regex=".*/build", exclude=["*.keep"]))) == [
+        os.path.join("root", "d", "build"),
+    ]
+    assert os.path.join("root", "e") not in pattern.find(
+        "root", pattern.Matcher(glob="**", exclude=["*.keep"])
+    )
+
+
+def test_find_excluded_deep_inside_matched(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # The directories are created one by one, os.makedirs() is recursive as well.
+    directory = "root"
+    os.mkdir(directory)
+    for name in ("d", *["x"] * (sys.getrecursionlimit() + 100)):
+        directory = os.path.join(directory, name)
+        os.mkdir(directory)
+    for path in (os.path.join(directory, "a.keep"), os.path.join(directory, "b.txt")):
+        open(path, "w").close()
+    open(os.path.join("root", "d", "x", "c.txt"), "w").close()
+
+    try:
+        # The deep trees are split without the recursion.
+        items = sorted(pattern.find("root", pattern.Matcher(glob="d", exclude=["*.keep"])))
+        assert items == sorted(
+            [os.path.join(directory, "b.txt"), os.path.join("root", "d", "x", "c.txt")]
+        )
+    finally:
+        # The temporary directories are removed by pytest recursively.
+        pattern.rmlib.rmdir("root")
+
+
+def test_find_unreadable_inside_matched(fs, mocker):
+    for path in ("d/a.txt", "d/sub/b.keep", "d/locked/c.txt"):
+        fs.create_file(os.path.join("root", path))
+    scandir = os.scandir
+
+    def fake_scandir(path):
+        if path.endswith("locked"):
+            raise PermissionError(errno.EACCES, "Permission denied", path)
+        return scandir(path)
+
+    mocker.patch("myrm.rmlib.os.scandir", side_effect=fake_scandir)
+    logger_mock = mocker.patch("myrm.pattern.logger")
+
+    assert list(pattern.find("root", pattern.Matcher(glob="d", exclude=["*.keep"]))) == [
+        os.path.join("root", "d", "a.txt")
+    ]
+    logger_mock.warning.assert_called()
+
+
+def test_find_with_error(fs, mocker):
+    logger_mock = mocker.patch("myrm.pattern.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        list(pattern.find("missing", pattern.Matcher(glob="*")))
+
+    assert exit_info.value.code == errno.ENOENT
+    logger_mock.error.assert_called_with("The determined path don't exist on the current machine.")
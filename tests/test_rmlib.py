@@ -1,6 +1,9 @@
 import errno
+import fcntl
 import logging
 import os
+import stat
+import threading
 
 import pytest
 
@@ -44,8 +47,8 @@ def test_rm_with_dry_run(fake_tree, caplog, mocker):
 
 
 def test_rmdir_with_error(mocker):
-    walk_mock = mocker.patch("myrm.rmlib.os.walk")
-    walk_mock.side_effect = OSError(errno.EPERM, "")
+    open_mock = mocker.patch("myrm.rmlib.os.open")
+    open_mock.side_effect = OSError(errno.EPERM, "")
     logger_mock = mocker.patch("myrm.rmlib.logger")
 
     with pytest.raises(SystemExit) as exit_info:
@@ -105,6 +108,162 @@ def test_rmdir_root_with_error(fake_tree, mocker):
     )
 
 
+@pytest.mark.parametrize("workers", [1, 4])
+def test_rmdir_parallel(tmp_path, workers):
+    root = tmp_path / "dir"
+    for i in range(6):
+        path = root / str(i) / "a" / "b"
+        path.mkdir(parents=True)
+        (path / "test.txt").write_text("test")
+        (root / str(i) / "test.txt").write_text("test")
+
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "test.txt").write_text("test")
+    (root / "0" / "link").symlink_to(outside)
+
+    rmlib.rmdir(str(root), workers=workers)
+
+    assert not root.exists()
+    assert (outside / "test.txt").exists()
+
+
+def test_rmdir_parallel_deep(tmp_path):
+    root = tmp_path / "dir"
+    path = root.joinpath(*"abcdef")
+    path.mkdir(parents=True)
+    (path / "test.txt").write_text("test")
+
+    rmlib.rmdir(str(root), workers=4)
+
+    assert not root.exists()
+
+
+def test_rmdir_parallel_flat(tmp_path, monkeypatch, mocker):
+    monkeypatch.setattr(rmlib, "UNLINK_BATCH", 2)
+    root = tmp_path / "dir"
+    root.mkdir()
+    for i in range(9):
+        (root / str(i)).write_text("test")
+    threads = set()
+    unlink_at = rmlib._unlink_at
+
+    def fake_unlink_at(dir_fd, names):
+        threads.add(threading.get_ident())
+        unlink_at(dir_fd, names)
+
+    unlink_mock = mocker.patch("myrm.rmlib._unlink_at", side_effect=fake_unlink_at)
+
+    rmlib.rmdir(str(root), workers=4)
+
+    assert not root.exists()
+    # The files of the same directory are unlinked by the workers in batches.
+    assert sorted(len(call.args[1]) for call in unlink_mock.call_args_list) == [1, 2, 2, 2, 2]
+    assert threading.get_ident() not in threads
+
+
+def test_rmdir_with_dry_run_missing(fs, mocker):
+    logger_mock = mocker.patch("myrm.rmlib.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        rmlib.rmdir("test", dry_run=True)
+
+    assert exit_info.value.code == errno.ENOENT
+    logger_mock.error.assert_called_with("The determined path don't exist on the current machine.")
+
+
+@pytest.mark.parametrize("topdown", [True, False])
+def test_scantree(fs, topdown):
+    fs.create_file(os.path.join("dir", "a", "b", "test.txt"))
+    fs.create_file(os.path.join("dir", "c", "test.txt"))
+    fs.create_symlink(os.path.join("dir", "link"), "dir")
+
+    paths = [entry.path for entry in rmlib.scantree("dir", topdown)]
+
+    assert sorted(paths) == sorted(
+        [
+            os.path.join("dir", "a"),
+            os.path.join("dir", "a", "b"),
+            os.path.join("dir", "a", "b", "test.txt"),
+            os.path.join("dir", "c"),
+            os.path.join("dir", "c", "test.txt"),
+            os.path.join("dir", "link"),
+        ]
+    )
+    # The directories are yielded before their content only in the top-down order.
+    for path, content in (("a", os.path.join("a", "b")), ("c", os.path.join("c", "test.txt"))):
+        index = paths.index(os.path.join("dir", path))
+        assert (index < paths.index(os.path.join("dir", content))) is topdown
+
+
+def test_stage(fs):
+    fs.create_file(os.path.join("dir", "test.txt"))
+
+    path = rmlib.stage("dir", "staging")
+
+    assert not os.path.exists("dir")
+    assert os.path.dirname(path) == "staging"
+    assert os.listdir(path) == ["test.txt"]
+
+
+def test_stage_other_device(fs, mocker):
+    fs.create_file("test.txt")
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+
+    assert rmlib.stage("test.txt", "staging") is None
+    assert os.path.exists("test.txt")
+
+
+def test_stage_with_error(fs, mocker):
+    logger_mock = mocker.patch("myrm.rmlib.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        rmlib.stage("missing", "staging")
+
+    assert exit_info.value.code == errno.ENOENT
+    logger_mock.error.assert_called_with(
+        "The determined path can't be removed from the current machine."
+    )
+
+
+def test_purge(tmp_path):
+    staging = tmp_path / "staging"
+    (staging / "a" / "b").mkdir(parents=True)
+    (staging / "a" / "b" / "test.txt").write_text("test")
+    (staging / "test.txt").write_text("test")
+
+    rmlib.purge(str(staging), workers=2)
+
+    assert os.listdir(staging) == [rmlib.STAGING_LOCK]
+
+
+def test_purge_locked(tmp_path):
+    staging = tmp_path / "staging"
+    staging.mkdir()
+    (staging / "test.txt").write_text("test")
+
+    with open(staging / rmlib.STAGING_LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        rmlib.purge(str(staging))
+
+    assert (staging / "test.txt").exists()
+
+
+def test_purge_missing(tmp_path):
+    rmlib.purge(str(tmp_path / "missing"))
+
+    assert not (tmp_path / "missing").exists()
+
+
+def test_purge_in_background(mocker):
+    popen_mock = mocker.patch("subprocess.Popen")
+
+    rmlib.purge_in_background("staging", workers=2)
+
+    assert popen_mock.call_args.args[0][-2:] == ["staging", "2"]
+    assert popen_mock.call_args.kwargs["start_new_session"]
+
+
 def test_mkdir_with_error(mocker):
     makedirs_mock = mocker.patch("myrm.rmlib.os.makedirs")
     makedirs_mock.side_effect = OSError(errno.EPERM, "")
@@ -189,18 +348,31 @@ def test_mv_with_dry_run(caplog, mocker, fs):
     assert os.path.exists(src)
 
 
-def test_mvdir_with_error(mocker):
-    walk_mock = mocker.patch("myrm.rmlib.os.walk")
-    walk_mock.side_effect = OSError(errno.EPERM, "")
+def test_mvdir_with_error(fake_tree, mocker):
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+    scantree_mock = mocker.patch("myrm.rmlib.scantree")
+    scantree_mock.side_effect = OSError(errno.EPERM, "")
     logger_mock = mocker.patch("myrm.rmlib.logger")
 
     with pytest.raises(SystemExit) as exit_info:
-        rmlib.mvdir("", "")
+        rmlib.mvdir(fake_tree[0], "test_dir")
 
     assert exit_info.value.code == errno.EPERM
     logger_mock.error.assert_called_with("The determined path don't exist on the current machine.")
 
 
+def test_mvdir_missing(fs, mocker):
+    logger_mock = mocker.patch("myrm.rmlib.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        rmlib.mvdir("missing", "test_dir")
+
+    # The missing directory isn't merged item by item into the new empty one.
+    assert exit_info.value.code == errno.ENOENT
+    assert not os.path.exists("test_dir")
+    logger_mock.error.assert_called_with("Can't move the determined item to the destination path.")
+
+
 def test_mvdir(fake_tree, mocker, caplog):
     logger_mock = mocker.patch("myrm.rmlib.logger")
     src = fake_tree[0]
@@ -229,3 +401,287 @@ def test_mvdir_with_dry_run(fake_tree, mocker, caplog):
     )
     assert not os.path.exists(dst)
     assert os.path.exists(src)
+
+
+def test_mvdir_single_rename(fake_tree, mocker):
+    rename_mock = mocker.spy(rmlib.os, "rename")
+    scantree_mock = mocker.spy(rmlib, "scantree")
+    src = fake_tree[0]
+    dst = "test_dir"
+
+    rmlib.mvdir(src, dst, dry_run=False)
+
+    rename_mock.assert_called_once_with(src, dst)
+    scantree_mock.assert_not_called()
+    assert os.path.isfile(os.path.join(dst, "test.txt"))
+
+
+def test_mvdir_fallback(fake_tree, fs, mocker):
+    src = fake_tree[0]
+    dst = "test_dir"
+    fs.create_file(os.path.join(fake_tree[2], "inner.txt"))
+
+    rename = os.rename
+
+    def rename_mock(old, new):
+        if old == src:
+            raise OSError(errno.EXDEV, "")
+        rename(old, new)
+
+    mocker.patch("myrm.rmlib.os.rename", side_effect=rename_mock)
+
+    rmlib.mvdir(src, dst, dry_run=False)
+
+    assert os.path.isfile(os.path.join(dst, "test.txt"))
+    assert os.path.isfile(os.path.join(dst, "inner_dir", "inner.txt"))
+    assert not os.path.exists(src)
+
+
+def test_mv_cross_device(tmp_path, mocker):
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+    src = tmp_path / "src.txt"
+    src.write_text("test")
+    src.chmod(0o640)
+    os.utime(src, ns=(1000000000, 1000000000))
+    dst = tmp_path / "dst.txt"
+
+    rmlib.mv(str(src), str(dst))
+
+    assert not src.exists()
+    assert dst.read_text() == "test"
+    assert dst.stat().st_mode & 0o777 == 0o640
+    assert dst.stat().st_mtime_ns == 1000000000
+    assert not os.path.exists(str(dst) + rmlib.PARTIAL_SUFFIX)
+
+
+def test_mv_cross_device_link(tmp_path, mocker):
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+    src = tmp_path / "src"
+    src.symlink_to("target")
+    dst = tmp_path / "dst"
+
+    rmlib.mv(str(src), str(dst))
+
+    assert not os.path.lexists(src)
+    assert os.readlink(dst) == "target"
+
+
+def test_mv_cross_device_resume(tmp_path, mocker):
+    src = tmp_path / "src.txt"
+    src.write_text("test")
+    dst = tmp_path / "dst.txt"
+    dst.write_text("test")
+    os.utime(dst, ns=(src.stat().st_atime_ns, src.stat().st_mtime_ns))
+
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+    copy_mock = mocker.patch("myrm.rmlib._copy_data")
+
+    rmlib.mv(str(src), str(dst))
+
+    copy_mock.assert_not_called()
+    assert not src.exists()
+    assert dst.read_text() == "test"
+
+
+def test_mv_cross_device_replace_different(tmp_path, mocker):
+    src = tmp_path / "src.txt"
+    src.write_text("test")
+    # The other item has the same size and time, but it wasn't copied from this one.
+    dst = tmp_path / "dst.txt"
+    dst.write_text("tset")
+    os.utime(dst, ns=(src.stat().st_atime_ns, src.stat().st_mtime_ns))
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+
+    rmlib.mv(str(src), str(dst))
+
+    assert not src.exists()
+    assert dst.read_text() == "test"
+
+
+def test_mv_cross_device_with_changed_origin(tmp_path, mocker):
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+    src = tmp_path / "src.txt"
+    src.write_text("test")
+    dst = tmp_path / "dst.txt"
+    copy_data = rmlib._copy_data
+
+    def change(fsrc, fdst, size):
+        copy_data(fsrc, fdst, size)
+        # The origin is changed while it's copied.
+        src.write_text("changed")
+
+    mocker.patch("myrm.rmlib._copy_data", side_effect=change)
+    mocker.patch("myrm.rmlib.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        rmlib.mv(str(src), str(dst))
+
+    assert exit_info.value.code == errno.EIO
+    assert src.read_text() == "changed"
+    assert not dst.exists()
+    assert not os.path.exists(str(dst) + rmlib.PARTIAL_SUFFIX)
+
+
+def test_mv_cross_device_with_verify_error(tmp_path, mocker):
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+    mocker.patch("myrm.rmlib._copy_data")
+    logger_mock = mocker.patch("myrm.rmlib.logger")
+    src = tmp_path / "src.txt"
+    src.write_text("test")
+
+    with pytest.raises(SystemExit) as exit_info:
+        rmlib.mv(str(src), str(tmp_path / "dst.txt"))
+
+    assert exit_info.value.code == errno.EIO
+    assert src.exists()
+    logger_mock.error.assert_called_with("Can't move the determined item to the destination path.")
+
+
+@pytest.mark.parametrize("unsupported", [("copy_file_range",), ("copy_file_range", "sendfile")])
+def test_copy_data_fallback(tmp_path, mocker, unsupported):
+    for name in unsupported:
+        mocker.patch(f"myrm.rmlib.os.{name}", side_effect=OSError(errno.ENOSYS, ""), create=True)
+    src = tmp_path / "src.txt"
+    src.write_bytes(b"test" * 1024)
+    dst = tmp_path / "dst.txt"
+
+    with open(src, mode="rb") as stream_in, open(dst, mode="wb") as stream_out:
+        rmlib._copy_data(stream_in.fileno(), stream_out.fileno(), 4 * 1024)
+
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_mvdir_cross_device(tmp_path, mocker):
+    src = tmp_path / "src"
+    (src / "inner").mkdir(parents=True)
+    for index in range(10):
+        (src / f"{index}.txt").write_text(str(index))
+        (src / "inner" / f"{index}.txt").write_text(str(index))
+    (src / "inner").chmod(0o750)
+    dst = tmp_path / "dst"
+    mocker.patch("myrm.rmlib.os.rename", side_effect=OSError(errno.EXDEV, ""))
+
+    rmlib.mvdir(str(src), str(dst), workers=4)
+
+    assert not src.exists()
+    assert sorted(os.listdir(dst)) == sorted([f"{index}.txt" for index in range(10)] + ["inner"])
+    assert (dst / "inner" / "9.txt").read_text() == "9"
+    assert (dst / "inner").stat().st_mode & 0o777 == 0o750
+
+
+def test_hash_file(tmp_path, mocker):
+    mocker.patch("myrm.rmlib.HASH_CHUNK_SIZE", 3)
+    path = tmp_path / "test.txt"
+    path.write_text("test content")
+
+    assert rmlib.hash_file(str(path)) == (
+        "6ae8a75555209fd6c44157c0aed8016e763ff435a19cf186f76863140143ff72"
+    )
+    assert rmlib.hash_file(str(tmp_path / "missing.txt")) is None
+
+
+def test_hash_files(tmp_path):
+    for name in ("a.txt", "b.txt"):
+        (tmp_path / name).write_text("test")
+
+    digests = rmlib.hash_files(
+        [str(tmp_path / name) for name in ("a.txt", "b.txt", "missing.txt")], workers=2
+    )
+
+    assert sorted(digests) == [str(tmp_path / "a.txt"), str(tmp_path / "b.txt")]
+    assert len(set(digests.values())) == 1
+
+
+def test_detach(tmp_path):
+    path = tmp_path / "test.txt"
+    path.write_text("test")
+    link = tmp_path / "link.txt"
+    os.link(path, link)
+
+    rmlib.detach(str(path))
+    path.write_text("changed")
+
+    assert link.read_text() == "test"
+    assert os.stat(link).st_nlink == 1
+    assert sorted(os.listdir(tmp_path)) == ["link.txt", "test.txt"]
+
+
+def test_detach_with_error(tmp_path, mocker):
+    path = tmp_path / "test.txt"
+    path.write_text("test")
+    mocker.patch("myrm.rmlib._copy", side_effect=lambda src, dst: open(dst, "wb").close())
+    mocker.patch("myrm.rmlib.os.replace", side_effect=OSError(errno.EPERM, ""))
+    logger_mock = mocker.patch("myrm.rmlib.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        rmlib.detach(str(path))
+
+    assert exit_info.value.code == errno.EPERM
+    assert os.listdir(tmp_path) == ["test.txt"]
+    logger_mock.error.assert_called_with("Can't move the determined item to the destination path.")
+
+
+def test_pack_unpack(tmp_path):
+    src = tmp_path / "src"
+    (src / "inner").mkdir(parents=True)
+    (src / "inner" / "test.txt").write_text("test" * 1024)
+    (src / "inner" / "test.txt").chmod(0o600)
+    archive = tmp_path / "archive.tar.xz"
+
+    size = rmlib.pack(str(src), str(archive))
+
+    assert size == archive.stat().st_size
+    assert size < 4 * 1024
+    assert not os.path.exists(str(archive) + rmlib.PARTIAL_SUFFIX)
+
+    dst = tmp_path / "dst"
+    rmlib.unpack(str(archive), str(dst))
+
+    assert (dst / "inner" / "test.txt").read_text() == "test" * 1024
+    assert (dst / "inner" / "test.txt").stat().st_mode & 0o777 == 0o600
+    assert sorted(os.listdir(tmp_path)) == ["archive.tar.xz", "dst", "src"]
+
+
+def test_pack_unpack_special_mode(tmp_path):
+    src = tmp_path / "src"
+    (src / "shared").mkdir(parents=True)
+    (src / "shared").chmod(0o1777)
+    (src / "tool").write_text("test")
+    (src / "tool").chmod(0o4777)
+    archive = tmp_path / "archive.tar.xz"
+    rmlib.pack(str(src), str(archive))
+
+    dst = tmp_path / "dst"
+    rmlib.unpack(str(archive), str(dst))
+
+    assert stat.S_IMODE((dst / "tool").stat().st_mode) == 0o4777
+    assert stat.S_IMODE((dst / "shared").stat().st_mode) == 0o1777
+
+
+def test_pack_with_dry_run(tmp_path, caplog):
+    caplog.set_level(logging.INFO, logger="myrm")
+    (tmp_path / "test.txt").write_text("test")
+
+    assert rmlib.pack(str(tmp_path / "test.txt"), str(tmp_path / "test.tar.xz"), True) is None
+    assert os.listdir(tmp_path) == ["test.txt"]
+    assert caplog.messages == [
+        f"Item '{tmp_path / 'test.txt'}' was compressed to '{tmp_path / 'test.tar.xz'}' as the "
+        "destination path."
+    ]
+
+
+def test_pack_with_error(tmp_path):
+    assert rmlib.pack(str(tmp_path / "missing"), str(tmp_path / "test.tar.xz")) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_unpack_with_error(tmp_path, mocker):
+    (tmp_path / "test.tar.xz").write_text("test")
+    logger_mock = mocker.patch("myrm.rmlib.logger")
+
+    with pytest.raises(SystemExit) as exit_info:
+        rmlib.unpack(str(tmp_path / "test.tar.xz"), str(tmp_path / "test.txt"))
+
+    assert exit_info.value.code == errno.EIO
+    assert os.listdir(tmp_path) == ["test.tar.xz"]
+    logger_mock.error.assert_called_with("Can't move the determined item to the destination path.")
@@ -65,12 +65,31 @@ def test_bool_field_with_error(fake_bool_field):
     assert str(exc_info.value) == f"The field must be boolean but received: {type(flag)}."
 
 
+def test_choice_field(fake_choice_field):
+    assert fake_choice_field.test == "a"
+
+    fake_choice_field.test = "b"
+    assert fake_choice_field.test == "b"
+
+
+def test_choice_field_with_error(fake_choice_field):
+    with pytest.raises(settings.ValidationError) as exc_info:
+        fake_choice_field.test = "c"
+
+    assert str(exc_info.value) == "The field must be one of a, b but received: 'c'."
+
+
 def test_app_settings():
     test_settings = {
         "bucket_path": "test",
         "bucket_history_path": "test",
         "bucket_size": 10,
         "bucket_timeout_cleanup": 10,
+        "workers": 2,
+        "bucket_dedup": False,
+        "bucket_compress_after": 0,
+        "bucket_eviction": "none",
+        "bucket_per_device": False,
     }
     app_settings = settings.AppSettings(**test_settings)
     assert app_settings.dump() == test_settings
@@ -132,6 +151,11 @@ def test_load(fs):
         "bucket_history_path": "test",
         "bucket_size": 10,
         "bucket_timeout_cleanup": 101,
+        "workers": 4,
+        "bucket_dedup": False,
+        "bucket_compress_after": 0,
+        "bucket_eviction": "none",
+        "bucket_per_device": False,
     }
 
     with io.open(path, mode="wt", encoding="utf-8") as stream_out:
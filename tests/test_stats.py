@@ -0,0 +1,88 @@
+import io
+import json
+import os
+import threading
+
+from myrm import bucket, rmlib, stats
+
+
+def test_collect(tmp_path):
+    bucket_instance = bucket.Bucket(
+        path=str(tmp_path / "bucket"), history_path=str(tmp_path / "history.pkl")
+    )
+    (tmp_path / "test.txt").write_text("test")
+    original = os.rename, rmlib.mv, bucket.Bucket.rm
+    stream = io.StringIO()
+
+    with stats.collect(stream, "json"):
+        bucket_instance.startup()
+        with bucket_instance.history.transaction():
+            bucket_instance.rm(str(tmp_path / "test.txt"))
+
+    records = json.loads(stream.getvalue())
+    assert records["Bucket.rm"]["calls"] == 1
+    assert records["rmlib.mv"]["syscalls"]["rename"] == 1
+    assert records["Bucket.rm"]["syscalls"]["rename"] == 1
+    assert records["BucketHistory._commit"]["written"] > 0
+    assert records["total"]["written"] >= records["BucketHistory._commit"]["written"]
+    # Nothing is measured after the statistics are collected.
+    assert (os.rename, rmlib.mv, bucket.Bucket.rm) == original
+
+
+def test_collect_threads(tmp_path, mocker):
+    started, finished = threading.Event(), threading.Event()
+    mkdir = os.mkdir
+
+    def fake_mkdir(*args, **kwargs):
+        started.set()
+        finished.wait(10)
+        return mkdir(*args, **kwargs)
+
+    mocker.patch("myrm.rmlib.os.mkdir", side_effect=fake_mkdir)
+    stream = io.StringIO()
+
+    with stats.collect(stream, "json"):
+        worker = threading.Thread(target=rmlib.mkdir, args=(str(tmp_path / "dir"),))
+        worker.start()
+        started.wait(10)
+        # The main thread isn't a part of the phase which runs in the worker one meanwhile.
+        os.listdir(tmp_path)
+        finished.set()
+        worker.join()
+
+    records = json.loads(stream.getvalue())
+    assert records["rmlib.mkdir"]["syscalls"]["mkdir"] == 1
+    assert "listdir" not in records["rmlib.mkdir"]["syscalls"]
+    assert records["total"]["syscalls"]["listdir"] == 1
+    assert records["total"]["syscalls"]["mkdir"] == 1
+
+
+def test_collect_table(fs):
+    stream = io.StringIO()
+
+    with stats.collect(stream):
+        rmlib.mkdir("dir")
+
+    assert stream.getvalue().splitlines()[0].split()[:4] == ["Phase", "Calls", "Seconds", "Written"]
+    assert "rmlib.mkdir" in stream.getvalue()
+
+
+def test_profile(tmp_path):
+    path = str(tmp_path / "profile")
+
+    with stats.profile(path, memory=True):
+        sum(range(10))
+
+    assert os.path.exists(path)
+    assert os.path.exists(path + ".tracemalloc")
+
+
+def test_profile_with_error(tmp_path, mocker):
+    logger_mock = mocker.patch("myrm.stats.logger")
+
+    with stats.profile(str(tmp_path / "missing" / "profile")):
+        pass
+
+    logger_mock.warning.assert_called_with(
+        "It's impossible to save the profile on the current machine."
+    )